@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Week 4 - 切塊 (chunking) 效能比較
+
+比較 `rag_test.PDFProcessor.iter_chunks` 的兩種寫法：
+
+- legacy：整份文件 `re.sub` 合併空白 → `split()` 成詞串列 → 每個視窗 `' '.join`
+- spans：以 numpy 一次算出詞的字元位置，區塊只記錄 (起點, 終點)，交出時才切字串
+
+兩者輸出必須完全相同（嵌入快取與增量索引的區塊 ID 都依賴內文）。
+PDF 文字只擷取一次，之後只量測切塊本身的吞吐量與記憶體峰值（tracemalloc）。
+
+接著比較各個切割策略（`CHUNK_STRATEGIES`）的區塊數、平均 token 數，
+以及超出嵌入模型輸入長度（all-MiniLM-L6-v2 為 256）而被截掉、沒有被嵌入的 token 比例。
+
+使用方式：
+```bash
+python week04_rag/benchmark_chunking.py --data-folder week04_rag/data
+# 把每份文件重複 20 次，模擬長篇文件
+python week04_rag/benchmark_chunking.py --scale 20 --repeat 3
+```
+"""
+
+from __future__ import annotations
+
+import argparse
+import re
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Iterator, List, Tuple
+
+from rag_test import CHUNK_STRATEGIES, Document, PDFProcessor, TokenCounter
+
+
+def legacy_iter_chunks(processor: PDFProcessor, text: str, source: str) -> Iterator[Document]:
+    """改寫前的切塊方式，保留作為比較基準"""
+    text = re.sub(r"\s+", " ", text).strip()
+    words = text.split()
+    step = processor.chunk_size - processor.chunk_overlap
+    chunk_count = 0
+
+    for start in range(0, len(words), step):
+        window = words[start : start + processor.chunk_size]
+        chunk_text = " ".join(window)
+        if len(chunk_text) < 80:
+            continue
+        yield Document(
+            content=chunk_text,
+            metadata={"source": source, "chunk_id": chunk_count, "start_word": start},
+        )
+        chunk_count += 1
+
+
+def measure(
+    chunker: Callable[[str, str], Iterator[Document]],
+    texts: List[Tuple[str, str]],
+    repeat: int,
+) -> Tuple[float, int, int]:
+    """回傳 (最快一次的秒數, 區塊數, 單份文件處理時的最大記憶體峰值 bytes)"""
+    best = float("inf")
+    chunks = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        chunks = sum(1 for source, text in texts for _doc in chunker(text, source))
+        best = min(best, time.perf_counter() - started)
+
+    peak = 0
+    for source, text in texts:
+        tracemalloc.start()
+        for _doc in chunker(text, source):
+            pass
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return best, chunks, peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="比較 legacy 與 spans 兩種切塊方式")
+    parser.add_argument("--data-folder", default="week04_rag/data", help="PDF 資料夾")
+    parser.add_argument("--chunk-size", type=int, default=600)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    parser.add_argument("--scale", type=int, default=1, help="每份文件重複的次數 (default: 1)")
+    parser.add_argument("--repeat", type=int, default=5, help="取最快一次的重複次數 (default: 5)")
+    parser.add_argument(
+        "--embed-max-tokens",
+        type=int,
+        default=256,
+        help="嵌入模型的最大輸入長度，超過的部分會被截掉 (default: 256)",
+    )
+    args = parser.parse_args()
+
+    processor = PDFProcessor(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    pdf_files = sorted(Path(args.data_folder).glob("*.pdf"))
+    if not pdf_files:
+        print(f"{args.data_folder} 中沒有 PDF")
+        return
+
+    texts: List[Tuple[str, str]] = []
+    for pdf_path in pdf_files:
+        text = processor.load_pdf(pdf_path)
+        texts.append((pdf_path.name, "\n".join([text] * args.scale)))
+    total_chars = sum(len(text) for _source, text in texts)
+    print(f"{len(texts)} 份文件，共 {total_chars / 1e6:.2f} M 字元")
+
+    for source, text in texts:
+        legacy = [doc.content for doc in legacy_iter_chunks(processor, text, source)]
+        spans = [doc.content for doc in processor.iter_chunks(text, source)]
+        if legacy != spans:
+            raise SystemExit(f"{source}: 兩種切塊結果不一致")
+
+    chunkers = {
+        "legacy": lambda text, source: legacy_iter_chunks(processor, text, source),
+        "spans": processor.iter_chunks,
+    }
+    print(f"\n{'方法':<8} {'區塊數':>8} {'耗時(ms)':>10} {'區塊/秒':>10} {'MB/秒':>8} {'記憶體峰值(MB)':>14}")
+    for name, chunker in chunkers.items():
+        seconds, chunks, peak = measure(chunker, texts, args.repeat)
+        print(
+            f"{name:<8} {chunks:>8} {seconds * 1000:>10.1f} {chunks / seconds:>10.0f} "
+            f"{total_chars / 1e6 / seconds:>8.1f} {peak / 1e6:>14.2f}"
+        )
+
+    counter = TokenCounter()
+    print(f"\n{'策略':<10} {'區塊數':>8} {'平均tokens':>10} {'總tokens':>10} {'截掉比例':>8} {'耗時(ms)':>10} {'區塊/秒':>10}")
+    for strategy in CHUNK_STRATEGIES:
+        chunker = PDFProcessor(strategy=strategy)
+        seconds, chunks, _peak = measure(chunker.iter_chunks, texts, args.repeat)
+        sizes = [
+            counter.count(doc.content)
+            for source, text in texts
+            for doc in chunker.iter_chunks(text, source)
+        ]
+        total = sum(sizes)
+        truncated = sum(max(size - args.embed_max_tokens, 0) for size in sizes)
+        print(
+            f"{strategy:<10} {chunks:>8} {total / max(chunks, 1):>10.0f} {total:>10} "
+            f"{truncated / max(total, 1):>8.0%} {seconds * 1000:>10.1f} {chunks / seconds:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Week 4 - 嵌入模型效能比較
+
+以 `week04_rag/data` 的 PDF 切出的區塊，比較 `EmbeddingModel` 各推論後端：
+
+- torch：PyTorch（基準）
+- onnx：onnxruntime，向量應與 PyTorch 幾乎相同
+- onnx-int8：動態 int8 量化，允許些微誤差
+
+每個後端回報載入時間與 chunks/秒，並以「與 PyTorch 向量的最小餘弦相似度」
+檢查輸出是否在容許範圍內，超出時以非零狀態碼結束。
+
+指定 `--token-budget` 時，每個後端另外量測「依 token 長度分桶、以 token 預算決定
+批次大小」的嵌入方式，並列出兩種分批各自因補齊而浪費的 token 比例。
+`--mixed` 會把區塊隨機截短，模擬長短混雜的語料。
+`--workers 2 4` 另外量測多行程嵌入（每個行程各載入一份模型）的吞吐量。
+
+需要額外安裝 onnxruntime 與 optimum：
+```bash
+pip install "sentence-transformers[onnx]"
+python week04_rag/benchmark_embedding.py --limit 512 --threads 4
+python week04_rag/benchmark_embedding.py --backends torch --token-budget 8192 --mixed
+python week04_rag/benchmark_embedding.py --backends onnx --workers 2 4 --limit 2000
+```
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from rag_test import EMBEDDING_BACKENDS, EmbeddingModel, EmbeddingStats, PDFProcessor
+
+# 各後端與 PyTorch 向量的最小餘弦相似度下限
+MIN_COSINE: Dict[str, float] = {"onnx": 0.9999, "onnx-int8": 0.98}
+# 分桶與多行程只改變計算方式，輸出應與同一後端單行程、固定分批的結果幾乎相同
+SAME_BACKEND_MIN_COSINE = 0.9999
+
+
+def load_chunks(data_folder: str, limit: int, mixed: bool) -> List[str]:
+    processor = PDFProcessor()
+    chunks: List[str] = []
+    for pdf_path in sorted(Path(data_folder).glob("*.pdf")):
+        text = processor.load_pdf(pdf_path)
+        chunks.extend(doc.content for doc in processor.iter_chunks(text, pdf_path.name))
+    chunks = chunks[:limit]
+    if mixed:
+        rng = np.random.default_rng(0)
+        chunks = [
+            " ".join(words[: rng.integers(8, len(words) + 1)])
+            for words in (chunk.split() for chunk in chunks)
+        ]
+    return chunks
+
+
+def fixed_padding(model: EmbeddingModel, texts: Sequence[str], batch_size: int) -> float:
+    """固定筆數分批時補齊浪費的 token 比例
+
+    sentence-transformers 會先依字元長度排序再分批，這裡照同樣方式估算。
+    """
+    lengths = model.token_lengths(texts)
+    order = np.argsort([-len(text) for text in texts], kind="stable")
+    padded = sum(
+        int(lengths[order[start : start + batch_size]].max()) * len(order[start : start + batch_size])
+        for start in range(0, len(order), batch_size)
+    )
+    return 1 - int(lengths.sum()) / padded
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="比較嵌入模型的 torch / onnx / onnx-int8 後端")
+    parser.add_argument("--data-folder", default="week04_rag/data", help="PDF 資料夾")
+    parser.add_argument("--limit", type=int, default=512, help="最多嵌入的區塊數 (default: 512)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, help="推論使用的 CPU 執行緒數")
+    parser.add_argument("--repeat", type=int, default=3, help="取最快一次的重複次數 (default: 3)")
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        choices=EMBEDDING_BACKENDS,
+        default=list(EMBEDDING_BACKENDS),
+        help="要比較的後端；誤差一律以 torch 的輸出為基準",
+    )
+    parser.add_argument("--onnx-dir", default=".rag_cache/onnx", help="匯出的 ONNX 模型存放位置")
+    parser.add_argument("--token-budget", type=int, help="另外量測依 token 預算分桶的嵌入方式")
+    parser.add_argument("--mixed", action="store_true", help="把區塊隨機截短，模擬長短混雜的語料")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[],
+        help="另外量測的嵌入行程數；--threads 此時為每個行程的執行緒數",
+    )
+    args = parser.parse_args()
+
+    chunks = load_chunks(args.data_folder, args.limit, args.mixed)
+    if not chunks:
+        print(f"{args.data_folder} 中沒有可用的 PDF 區塊")
+        return
+    print(f"{len(chunks)} 個區塊，batch size {args.batch_size}，執行緒 {args.threads or '預設'}")
+
+    # 誤差一律以 PyTorch 的輸出為基準
+    backends = ["torch", *[backend for backend in args.backends if backend != "torch"]]
+    reference: np.ndarray | None = None
+    rows: List[str] = []
+    failed: List[str] = []
+    for backend in backends:
+        started = time.perf_counter()
+        model = EmbeddingModel(
+            query_cache_size=0, backend=backend, threads=args.threads, onnx_dir=args.onnx_dir
+        )
+        load_seconds = time.perf_counter() - started
+
+        fixed: np.ndarray | None = None
+        modes = [(1, None)]
+        if args.token_budget:
+            modes.append((1, args.token_budget))
+        modes.extend((workers, args.token_budget) for workers in args.workers if workers > 1)
+        for workers, token_budget in modes:
+            model.token_budget = token_budget
+            if workers > 1:
+                model.start_pool(workers, args.threads)
+                # 第一次呼叫才會真正啟動行程並載入模型，不列入計時
+                model.encode_corpus(chunks[: args.batch_size * workers * 2], batch_size=args.batch_size)
+            best = float("inf")
+            for _ in range(args.repeat):
+                model.corpus_stats = EmbeddingStats()
+                started = time.perf_counter()
+                vectors = model.encode_corpus(chunks, batch_size=args.batch_size)
+                best = min(best, time.perf_counter() - started)
+            model.close_pool()
+
+            if reference is None:
+                reference = vectors
+            # 向量皆已正規化，內積即餘弦相似度
+            min_cosine = float(np.min(np.sum(vectors * reference, axis=1)))
+            max_error = float(np.max(np.abs(vectors - reference)))
+            if fixed is None:
+                fixed = vectors
+                name = backend
+                padding = fixed_padding(model, chunks, args.batch_size) if args.token_budget else None
+                if backend in MIN_COSINE and min_cosine < MIN_COSINE[backend]:
+                    failed.append(f"{backend}（最小 cos {min_cosine:.4f} < {MIN_COSINE[backend]}）")
+            else:
+                name = backend + ("+分桶" if token_budget else "") + (f"×{workers}行程" if workers > 1 else "")
+                padding = model.corpus_stats.padding_ratio if token_budget else None
+                same_backend_cosine = float(np.min(np.sum(vectors * fixed, axis=1)))
+                if same_backend_cosine < SAME_BACKEND_MIN_COSINE:
+                    failed.append(f"{name}（與單行程固定分批的最小 cos {same_backend_cosine:.4f}）")
+            rows.append(
+                f"{name:<20} {load_seconds:>8.2f} {best:>8.2f} {len(chunks) / best:>8.1f} "
+                f"{min_cosine:>8.4f} {max_error:>10.2e} "
+                f"{'—' if padding is None else f'{padding:.1%}':>8}"
+            )
+
+    print(
+        f"\n{'後端':<20} {'載入(秒)':>8} {'耗時(秒)':>8} {'區塊/秒':>8} "
+        f"{'最小cos':>8} {'最大誤差':>10} {'補齊浪費':>8}"
+    )
+    print("\n".join(rows))
+    if failed:
+        raise SystemExit("輸出超出容許誤差：" + "、".join(failed))
+    print("\n所有後端的輸出都在容許誤差內。")
+
+
+if __name__ == "__main__":
+    main()
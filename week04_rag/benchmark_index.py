@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Week 4 - 向量索引的記憶體與召回率比較
+
+比較 `VectorStore` 在各個維度下的向量儲存格式（`VECTOR_STORAGES`）：
+
+- float32：原始向量（基準）
+- float16：`ScalarQuantizer` 半精度，記憶體 1/2
+- int8：`ScalarQuantizer` 每個維度各自的範圍量化成 256 級，記憶體 1/4
+
+每種格式另外量測 `--rescore` 指定的倍數：先從壓縮索引取 top_k × N 筆候選，
+再以 float32 原始向量重新計分。原始向量另列一欄並計入總大小；以 `VectorStore.load(mmap=True)`
+開啟時它留在磁碟上，只有被選為候選的列會讀進記憶體。
+向量與建立索引時一樣分批加入（`--add-batch`），int8 的範圍估計因此與實際使用時相同。
+召回率以 float32 暴力搜尋的 top-k 為標準答案；查詢向量取自語料中保留、未加入索引的區塊。
+
+`--dims 128 64` 另外以語料學出 PCA（`faiss.PCAMatrix`），把索引中的向量降到這些維度，
+列出「保留的變異比例」與相對原始維度的 recall@k，找出品質還能接受的最小維度。
+
+預設以 `EmbeddingModel` 嵌入 `week04_rag/data` 的 PDF 區塊；
+`--synthetic 200000` 改用隨機產生的正規化向量，方便在大規模下比較：
+```bash
+python week04_rag/benchmark_index.py --rescore 0 4
+python week04_rag/benchmark_index.py --dims 256 128 64 --storages float32
+python week04_rag/benchmark_index.py --synthetic 200000 --index-type hnsw
+```
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+from typing import List
+
+import faiss
+import numpy as np
+
+from rag_test import (
+    INDEX_TYPES,
+    VECTOR_STORAGES,
+    Document,
+    EmbeddingModel,
+    PDFProcessor,
+    VectorStore,
+    recall_at_k,
+)
+
+
+def load_vectors(data_folder: str, synthetic: int, dimension: int, seed: int) -> np.ndarray:
+    """回傳已正規化的 float32 向量"""
+    if synthetic:
+        # 各維度變異數遞減、再加上群聚結構，近似真實嵌入向量的分佈
+        rng = np.random.default_rng(seed)
+        centers = rng.standard_normal((max(synthetic // 1000, 1), dimension))
+        spectrum = 1 / np.sqrt(1 + np.arange(dimension) / 8)
+        vectors = centers[rng.integers(len(centers), size=synthetic)] * spectrum
+        vectors += 0.5 * rng.standard_normal((synthetic, dimension)) * spectrum
+    else:
+        processor = PDFProcessor()
+        chunks: List[str] = []
+        for pdf_path in sorted(Path(data_folder).glob("*.pdf")):
+            text = processor.load_pdf(pdf_path)
+            chunks.extend(doc.content for doc in processor.iter_chunks(text, pdf_path.name))
+        if not chunks:
+            return np.empty((0, dimension), dtype=np.float32)
+        vectors = EmbeddingModel(query_cache_size=0).encode_corpus(chunks)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def index_bytes(index: faiss.Index) -> int:
+    """序列化後的大小，約等於索引常駐記憶體的用量"""
+    return len(faiss.serialize_index(index))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="比較向量索引各儲存格式的記憶體、召回率與延遲")
+    parser.add_argument("--data-folder", default="week04_rag/data", help="PDF 資料夾")
+    parser.add_argument("--synthetic", type=int, default=0, help="改用 N 筆隨機向量 (default: 0)")
+    parser.add_argument("--dimension", type=int, default=384, help="隨機向量的維度 (default: 384)")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat")
+    parser.add_argument("--queries", type=int, default=200, help="保留作為查詢的向量數 (default: 200)")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument(
+        "--add-batch",
+        type=int,
+        default=256,
+        help="每次加入向量庫的筆數，與 rag_test.py 的 --embed-batch-size 相同 (default: 256)",
+    )
+    parser.add_argument(
+        "--rescore",
+        type=int,
+        nargs="+",
+        default=[0, 4],
+        help="要比較的重新計分倍數；0 表示不重新計分 (default: 0 4)",
+    )
+    parser.add_argument(
+        "--dims",
+        type=int,
+        nargs="+",
+        default=[128, 64],
+        help="以 PCA 降到的維度，原始維度一律列為基準 (default: 128 64)",
+    )
+    parser.add_argument(
+        "--storages",
+        nargs="+",
+        choices=VECTOR_STORAGES,
+        default=list(VECTOR_STORAGES),
+        help="要比較的儲存格式",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors = load_vectors(args.data_folder, args.synthetic, args.dimension, args.seed)
+    if len(vectors) <= args.queries:
+        print(f"向量數 {len(vectors)} 不足，無法保留 {args.queries} 筆作為查詢")
+        return
+    rng = np.random.default_rng(args.seed)
+    order = rng.permutation(len(vectors))
+    queries, corpus = vectors[order[: args.queries]], vectors[order[args.queries :]]
+    k = min(args.k, len(corpus))
+    _scores, truth = faiss.knn(queries, corpus, k, metric=faiss.METRIC_INNER_PRODUCT)
+    print(f"{len(corpus)} 筆向量，{corpus.shape[1]} 維，{len(queries)} 個查詢，{args.index_type} 索引")
+
+    full_dimension = corpus.shape[1]
+    dimensions = [full_dimension, *sorted({dim for dim in args.dims if dim < full_dimension}, reverse=True)]
+    documents = [Document(content="") for _ in range(len(corpus))]
+    baseline_bytes = None
+    print(
+        f"\n{'維度':>5} {'保留變異':>8} {'格式':<8} {'重新計分':>8} {'索引(MB)':>9} {'原始向量(MB)':>12} {'相對大小':>8} "
+        f"{'recall@' + str(k):>10} {'查詢(ms)':>9}"
+    )
+    for dimension in dimensions:
+        for storage in args.storages:
+            for rescore in args.rescore:
+                store = VectorStore(full_dimension, storage=storage, rescore=rescore)
+                for start in range(0, len(corpus), args.add_batch):
+                    end = start + args.add_batch
+                    store.add(corpus[start:end], documents[start:end], ids=range(start, min(end, len(corpus))))
+                if args.index_type != "flat" or dimension < full_dimension:
+                    store.build_ann(args.index_type, k=k, dimension=dimension, seed=args.seed)
+
+                started = time.perf_counter()
+                _scores, found = store.search_ids(queries, k)
+                query_ms = 1000 * (time.perf_counter() - started) / len(queries)
+
+                variance = 1.0
+                if store.pca is not None:
+                    eigenvalues = faiss.vector_to_array(store.pca.eigenvalues)
+                    variance = eigenvalues[: store.index_dimension].sum() / eigenvalues.sum()
+                size = index_bytes(store.index)
+                # rescore 時另存一份 float32 原始向量（含 int64 ID）
+                exact_size = len(corpus) * (4 * full_dimension + 8) if rescore else 0
+                baseline_bytes = baseline_bytes or size + exact_size
+                print(
+                    f"{store.index_dimension:>5} {variance:>8.1%} {storage:<8} {rescore or '—':>8} "
+                    f"{size / 1e6:>9.2f} {exact_size / 1e6:>12.2f} {(size + exact_size) / baseline_bytes:>8.0%} "
+                    f"{recall_at_k(truth, found):>10.3f} {query_ms:>9.3f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
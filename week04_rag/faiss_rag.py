@@ -5,9 +5,13 @@ Week 4 - FAISS 版 RAG 系統
 """
 
 import re
+import json
+import time
 import faiss
 import ollama
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict, Any, Tuple
 from pypdf import PdfReader
@@ -22,6 +26,25 @@ class Document:
         self.metadata = metadata or {}
 
 
+def _timed(fn, *args):
+    """執行 fn 並回傳 (結果, 耗時秒數)"""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def _read_pdf_text(pdf_path: str) -> str:
+    """在子行程中讀取單個 PDF（需定義在模組層級才能傳給 ProcessPoolExecutor）"""
+    text = ""
+    with open(pdf_path, 'rb') as file:
+        pdf_reader = PdfReader(file)
+        for page_num, page in enumerate(pdf_reader.pages):
+            page_text = page.extract_text()
+            if page_text:
+                text += f"\n[Page {page_num + 1}]\n{page_text}"
+    return text
+
+
 class VectorStore:
     """FAISS 向量資料庫封裝"""
 
@@ -91,13 +114,80 @@ class VectorStore:
             "total_documents": len(self.documents)
         }
 
+    def save(self, path: str):
+        """將索引與文件儲存到資料夾
+
+        - index.faiss：FAISS 索引（faiss.write_index）
+        - texts.bin + offsets.npy：所有文件內容串成一份 UTF-8 文字，用位移切回每一筆
+        - metadata.json：metadata 以「欄」為單位存放（每個欄位一個串列）
+
+        Args:
+            path: 儲存的資料夾路徑
+        """
+        folder = Path(path)
+        folder.mkdir(parents=True, exist_ok=True)
+        faiss.write_index(self.index, str(folder / "index.faiss"))
+
+        encoded = [doc.content.encode("utf-8") for doc in self.documents]
+        offsets = np.cumsum([0] + [len(text) for text in encoded], dtype=np.int64)
+        (folder / "texts.bin").write_bytes(b"".join(encoded))
+        np.save(folder / "offsets.npy", offsets)
+
+        keys = []
+        for doc in self.documents:
+            keys.extend(key for key in doc.metadata if key not in keys)
+        columns = {key: [doc.metadata.get(key) for doc in self.documents] for key in keys}
+        with open(folder / "metadata.json", "w", encoding="utf-8") as file:
+            json.dump(columns, file, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = False) -> "VectorStore":
+        """從資料夾載入索引與文件
+
+        Args:
+            path: save() 使用的資料夾路徑
+            mmap: 是否以記憶體映射 (IO_FLAG_MMAP_IFC) 開啟索引，
+                  向量留在磁碟上由作業系統分頁快取，多個行程可以共用同一份索引檔
+
+        Returns:
+            載入完成的 VectorStore
+        """
+        folder = Path(path)
+        # IO_FLAG_MMAP 只會映射 IVF 的倒排串列，flat 的向量仍會整份讀進記憶體
+        flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
+        index = faiss.read_index(str(folder / "index.faiss"), flags)
+
+        blob = (folder / "texts.bin").read_bytes()
+        offsets = np.load(folder / "offsets.npy")
+        with open(folder / "metadata.json", encoding="utf-8") as file:
+            columns = json.load(file)
+
+        store = cls(index.d)
+        store.index = index
+        for row in range(len(offsets) - 1):
+            metadata = {
+                key: values[row] for key, values in columns.items() if values[row] is not None
+            }
+            content = blob[offsets[row]:offsets[row + 1]].decode("utf-8")
+            store.documents.append(Document(content, metadata))
+        return store
+
 
 class FAISSRag:
     """使用 FAISS 的 RAG 系統"""
 
-    def __init__(self, model_name: str = "gemma3:1b"):
-        """初始化 RAG 系統"""
+    def __init__(self, model_name: str = "gemma3:1b", query_cache_size: int = 256):
+        """初始化 RAG 系統
+
+        Args:
+            model_name: Ollama 模型名稱
+            query_cache_size: 問題向量快取的筆數上限（LRU），0 表示不快取
+        """
         self.llm_model = model_name
+        # 相同的問題直接取用上次算好的向量，不必再跑一次嵌入模型
+        self.query_cache_size = query_cache_size
+        self.query_cache = OrderedDict()
+        self.query_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
         self.embedding_model = SentenceTransformer(
             "sentence-transformers/all-MiniLM-L6-v2",
             device='cpu'
@@ -109,14 +199,28 @@ class FAISSRag:
 
     def load_pdf(self, pdf_path: str) -> str:
         """讀取單個 PDF 檔案"""
-        text = ""
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PdfReader(file)
-            for page_num, page in enumerate(pdf_reader.pages):
-                page_text = page.extract_text()
-                if page_text:
-                    text += f"\n[Page {page_num + 1}]\n{page_text}"
-        return text
+        return _read_pdf_text(pdf_path)
+
+    def load_pdfs_parallel(self, pdf_files: List[Path], workers: int = 4) -> List[Tuple[Path, str]]:
+        """使用多個行程同時讀取 PDF
+
+        Args:
+            pdf_files: PDF 檔案路徑
+            workers: 同時執行的行程數
+
+        Returns:
+            [(檔案路徑, 文字), ...]，順序與 pdf_files 相同；讀取失敗的檔案會被略過
+        """
+        results = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_read_pdf_text, str(path)) for path in pdf_files]
+            # 依提交順序取回結果，輸出順序固定
+            for pdf_path, future in zip(pdf_files, futures):
+                try:
+                    results.append((pdf_path, future.result()))
+                except Exception as e:
+                    print(f"無法讀取 {pdf_path.name}: {e}")
+        return results
 
     def chunk_text(self, text: str, source: str, chunk_size: int = 500) -> List[Document]:
         """將文字切成小塊"""
@@ -142,9 +246,14 @@ class FAISSRag:
 
         return chunks
 
-    def load_documents(self, data_folder: str = "week04_rag/data"):
-        """載入所有文件並建立索引"""
-        pdf_files = list(Path(data_folder).glob("*.pdf"))
+    def load_documents(self, data_folder: str = "week04_rag/data", workers: int = 1):
+        """載入所有文件並建立索引
+
+        Args:
+            data_folder: PDF 所在資料夾
+            workers: 大於 1 時以多個行程平行讀取 PDF
+        """
+        pdf_files = sorted(Path(data_folder).glob("*.pdf"))
 
         all_documents = []
 
@@ -164,9 +273,12 @@ class FAISSRag:
         else:
             # 載入所有 PDF
             print(f"找到 {len(pdf_files)} 個 PDF 檔案")
-            for pdf_path in pdf_files:
+            if workers > 1:
+                loaded = self.load_pdfs_parallel(pdf_files, workers)
+            else:
+                loaded = [(path, self.load_pdf(str(path))) for path in pdf_files]
+            for pdf_path, text in loaded:
                 print(f"處理: {pdf_path.name}")
-                text = self.load_pdf(str(pdf_path))
                 chunks = self.chunk_text(text, pdf_path.name)
                 all_documents.extend(chunks)
                 print(f"  - 新增 {len(chunks)} 個文字塊")
@@ -194,13 +306,30 @@ class FAISSRag:
         print(f"文件總數: {stats['total_documents']}")
         print("索引建立完成！\n")
 
-    def search(self, query: str, top_k: int = 3) -> List[Tuple[float, Document]]:
-        """搜尋相關文件"""
-        # 將問題轉成向量
+    def encode_query(self, query: str) -> np.ndarray:
+        """將問題轉成向量，重複的問題會直接從 LRU 快取取出"""
+        key = " ".join(query.split())
+        if key in self.query_cache:
+            self.query_cache.move_to_end(key)
+            self.query_cache_stats["hits"] += 1
+            return self.query_cache[key]
+
+        self.query_cache_stats["misses"] += 1
         query_embedding = self.embedding_model.encode(
             [query],
             normalize_embeddings=True
         )
+        if self.query_cache_size > 0:
+            self.query_cache[key] = query_embedding
+            if len(self.query_cache) > self.query_cache_size:
+                self.query_cache.popitem(last=False)  # 移除最久沒用到的問題
+                self.query_cache_stats["evictions"] += 1
+        return query_embedding
+
+    def search(self, query: str, top_k: int = 3) -> List[Tuple[float, Document]]:
+        """搜尋相關文件"""
+        # 將問題轉成向量
+        query_embedding = self.encode_query(query)
 
         # 使用 FAISS 搜尋
         results = self.vector_store.search(query_embedding, top_k)
@@ -211,8 +340,13 @@ class FAISSRag:
 
         return results
 
-    def answer_question(self, question: str) -> str:
-        """使用 RAG 回答問題"""
+    def answer_question(self, question: str, stream: bool = False) -> str:
+        """使用 RAG 回答問題
+
+        Args:
+            question: 問題
+            stream: 是否邊生成邊印出回答（打字機效果），並顯示首個 token 的等待時間
+        """
         print(f"\n問題: {question}")
 
         # 1. 搜尋相關文件
@@ -240,6 +374,8 @@ class FAISSRag:
 
         # 4. 呼叫 LLM
         print("\n生成回答...")
+        if stream:
+            return self._stream_answer(prompt)
         try:
             response = ollama.chat(
                 model=self.llm_model,
@@ -251,13 +387,33 @@ class FAISSRag:
         except Exception as e:
             return f"LLM 呼叫失敗: {e}"
 
-    def compare_with_baseline(self, question: str) -> tuple:
-        """比較有/無 RAG 的回答"""
-        # 使用 RAG 的回答
-        rag_answer = self.answer_question(question)
+    def _stream_answer(self, prompt: str) -> str:
+        """串流模式：收到一段文字就印出一段，最後回傳完整回答"""
+        start = time.perf_counter()
+        first_token_time = None
+        pieces = []
+        try:
+            for chunk in ollama.chat(
+                model=self.llm_model,
+                messages=[{"role": "user", "content": prompt}],
+                stream=True
+            ):
+                piece = chunk['message']['content']
+                if piece and first_token_time is None:
+                    first_token_time = time.perf_counter() - start
+                pieces.append(piece)
+                print(piece, end='', flush=True)
+        except Exception as e:
+            return f"LLM 呼叫失敗: {e}"
+        print()
+
+        total = time.perf_counter() - start
+        if first_token_time is not None:
+            print(f"(首個 token: {first_token_time:.2f} 秒，總耗時: {total:.2f} 秒)")
+        return "".join(pieces)
 
-        # 不使用 RAG 的回答（純 LLM）
-        print("\n生成基準回答（無 RAG）...")
+    def _baseline_answer(self, question: str) -> str:
+        """不使用 RAG 的回答（純 LLM）"""
         try:
             baseline_response = ollama.chat(
                 model=self.llm_model,
@@ -265,10 +421,22 @@ class FAISSRag:
                     {"role": "user", "content": question}
                 ]
             )
-            baseline_answer = baseline_response['message']['content']
+            return baseline_response['message']['content']
         except Exception as e:
-            baseline_answer = f"LLM 呼叫失敗: {e}"
+            return f"LLM 呼叫失敗: {e}"
 
+    def compare_with_baseline(self, question: str) -> tuple:
+        """比較有/無 RAG 的回答；基準回答在背景生成，FAISS 檢索與 RAG 生成照常在主執行緒進行"""
+        start = time.perf_counter()
+        print("\n生成基準回答（無 RAG，背景執行）...")
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            baseline_future = executor.submit(_timed, self._baseline_answer, question)
+            rag_answer, rag_seconds = _timed(self.answer_question, question)
+            baseline_answer, baseline_seconds = baseline_future.result()
+        wall_seconds = time.perf_counter() - start
+
+        print(f"\n耗時：RAG {rag_seconds:.2f} 秒、基準 {baseline_seconds:.2f} 秒，"
+              f"同時執行總耗時 {wall_seconds:.2f} 秒")
         return rag_answer, baseline_answer
 
 
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Week 4 - RAG 非同步服務
+
+`rag_test.py` 的 `RAGPipeline` 是同步的：一個使用者在等 `ollama.chat`，
+其他人就只能排隊。這個檔案把它包成 asyncio 版本：
+
+- 檢索、組提示詞與寫入答案快取丟到執行緒池，不會卡住事件迴圈
+- LLM 呼叫改用 `ollama.AsyncClient`，並以 semaphore 限制同時進行的請求數
+- 以 FastAPI 提供 `POST /ask` 端點，用 uvicorn 啟動
+
+另外附一個「假的」Ollama 伺服器（固定延遲後回傳固定文字），
+可以在沒有 GPU 的環境下量測 N 個同時使用者時的吞吐量。
+
+使用方式：
+```bash
+# 啟動 API（需先啟動 Ollama）
+python week04_rag/rag_server.py serve --data-folder week04_rag/data --port 8000
+curl -X POST localhost:8000/ask -H "Content-Type: application/json" \\
+     -d '{"question": "What is multi-agent debate?"}'
+
+# 以假 LLM 量測 1/4/16 個同時使用者的吞吐量
+python week04_rag/rag_server.py bench --data-folder week04_rag/data --users 1 4 16
+```
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Sequence
+
+import httpx
+import ollama
+import uvicorn
+from fastapi import FastAPI, Request
+from pydantic import BaseModel
+
+from rag_test import EMBEDDING_BACKENDS, MetadataFilter, PreparedAnswer, RAGPipeline, VectorStore
+
+
+class AskRequest(BaseModel):
+    question: str
+    # 只從這些 PDF 檔名中檢索；未指定則搜尋全部
+    sources: List[str] | None = None
+
+
+class AsyncRAGPipeline:
+    """`RAGPipeline` 的 asyncio 包裝，讓多個問題可以同時處理
+
+    檢索（嵌入 + FAISS）、組提示詞與寫入答案快取是 CPU / 磁碟工作，交給執行緒池；生成則透過
+    `ollama.AsyncClient` 非同步等待，同時進行的 LLM 請求數受
+    ``max_concurrent_llm`` 限制，避免把 Ollama 塞爆。
+    """
+
+    def __init__(
+        self,
+        pipeline: RAGPipeline,
+        *,
+        llm_host: str | None = None,
+        max_concurrent_llm: int = 4,
+        retrieval_workers: int = 4,
+    ):
+        if not pipeline.ready:
+            raise RuntimeError("尚未載入知識庫，請先呼叫 prepare_corpus()")
+        self.pipeline = pipeline
+        self.client = ollama.AsyncClient(host=llm_host)
+        self.max_concurrent_llm = max_concurrent_llm
+        self._llm_slots = asyncio.Semaphore(max_concurrent_llm)
+        self._executor = ThreadPoolExecutor(
+            max_workers=retrieval_workers, thread_name_prefix="rag-retrieval"
+        )
+
+    async def ask(self, question: str, where: MetadataFilter | None = None) -> Dict[str, Any]:
+        """回傳答案、參考來源、上下文裁切統計與各階段耗時（毫秒）"""
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(
+            self._executor, self.pipeline.prepare_answer, question, where
+        )
+        timings: Dict[str, Any] = {"retrieval_ms": 1000 * (time.perf_counter() - started)}
+
+        if prepared.answer is not None:
+            answer = prepared.answer
+            if prepared.cached:
+                timings["cached"] = True
+        else:
+            try:
+                answer = await self._generate(prepared, timings)
+            except Exception as exc:  # pragma: no cover - 依賴外部服務
+                answer = self.pipeline.llm_error(exc)
+            else:
+                await loop.run_in_executor(
+                    self._executor, self.pipeline.remember_answer, prepared, answer
+                )
+                answer = answer or "(無回應)"
+
+        timings["total_ms"] = 1000 * (time.perf_counter() - started)
+        packing = prepared.packing
+        return {
+            "answer": answer,
+            "sources": [
+                {"source": doc.metadata.get("source"), "chunk_id": doc.metadata.get("chunk_id")}
+                for doc in prepared.contexts
+            ],
+            "packing": None
+            if packing is None
+            else {
+                "tokens": packing.tokens,
+                "original_tokens": packing.original_tokens,
+                "trimmed": packing.trimmed,
+                "dropped": packing.dropped,
+            },
+            "timings": timings,
+        }
+
+    async def _generate(self, prepared: PreparedAnswer, timings: Dict[str, Any]) -> str:
+        """回傳 LLM 的回答（可能是空字串）；連線失敗時拋出例外"""
+        queued = time.perf_counter()
+        async with self._llm_slots:
+            timings["llm_queue_ms"] = 1000 * (time.perf_counter() - queued)
+            generating = time.perf_counter()
+            try:
+                response = await self.client.chat(**prepared.request)
+            finally:
+                timings["llm_ms"] = 1000 * (time.perf_counter() - generating)
+        return response.get("message", {}).get("content", "").strip()
+
+    async def close(self) -> None:
+        """關閉 LLM 連線與執行緒池；需在使用這個物件的事件迴圈中呼叫"""
+        try:
+            await self.client.close()
+        finally:
+            self._executor.shutdown(wait=False)
+
+
+# ----------------------------------------------------------------------
+# FastAPI 應用程式
+# ----------------------------------------------------------------------
+
+def create_app(rag: AsyncRAGPipeline) -> FastAPI:
+    app = FastAPI(title="Week 4 RAG API")
+    app.state.rag = rag
+
+    @app.get("/health")
+    async def health() -> Dict[str, Any]:
+        return {"status": "ok", "documents": len(rag.pipeline.corpus)}
+
+    @app.post("/ask")
+    async def ask(body: AskRequest) -> Dict[str, Any]:
+        where = MetadataFilter.where(source=body.sources) if body.sources else None
+        return await rag.ask(body.question, where)
+
+    return app
+
+
+def create_stub_llm_app(delay: float = 0.5, answer: str = "這是假 LLM 的固定回答。") -> FastAPI:
+    """模擬 Ollama `/api/chat` 的假伺服器：等待 ``delay`` 秒後回傳固定答案"""
+    app = FastAPI(title="Stub LLM")
+
+    @app.post("/api/chat")
+    async def chat(request: Request) -> Dict[str, Any]:
+        payload = await request.json()
+        await asyncio.sleep(delay)
+        return {
+            "model": payload.get("model", "stub"),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "message": {"role": "assistant", "content": answer},
+            "done": True,
+            "done_reason": "stop",
+            "eval_count": len(answer),
+            "eval_duration": int(delay * 1e9),
+        }
+
+    return app
+
+
+def _start_background_server(app: FastAPI, host: str, port: int) -> uvicorn.Server:
+    """在背景執行緒啟動 uvicorn，等到開始接受連線才回傳"""
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="stub-llm", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+# ----------------------------------------------------------------------
+# 壓力測試
+# ----------------------------------------------------------------------
+
+async def run_load_test(
+    app: FastAPI, questions: Sequence[str], users: int, requests_per_user: int
+) -> Dict[str, float]:
+    """模擬 ``users`` 個使用者同時連續發問，回傳吞吐量與延遲分位數"""
+    latencies: List[float] = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://rag", timeout=None) as client:
+
+        async def user(user_id: int) -> None:
+            for turn in range(requests_per_user):
+                question = questions[(user_id + turn) % len(questions)]
+                sent = time.perf_counter()
+                response = await client.post("/ask", json={"question": question})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - sent)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(user_id) for user_id in range(users)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "users": users,
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": 1000 * statistics.median(latencies),
+        "p95_ms": 1000 * latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+    }
+
+
+async def _bench(
+    rag: AsyncRAGPipeline, questions: Sequence[str], users: int, requests_per_user: int
+) -> Dict[str, float]:
+    """以 ``rag`` 跑一輪壓力測試，結束或失敗後都會關閉它的 LLM 連線與執行緒池"""
+    try:
+        return await run_load_test(create_app(rag), questions, users, requests_per_user)
+    finally:
+        await rag.close()
+
+
+# ----------------------------------------------------------------------
+# 指令列介面
+# ----------------------------------------------------------------------
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Week 4 RAG 非同步服務")
+    parser.add_argument("--data-folder", default="data", help="PDF 資料來源的資料夾（預設: data）")
+    parser.add_argument("--index-dir", help="向量索引資料夾；已存在時直接以 mmap 載入")
+    parser.add_argument("--top-k", type=int, default=3, help="檢索的參考段落數量 (default: 3)")
+    parser.add_argument("--cache-dir", default=".rag_cache", help="嵌入向量快取資料夾")
+    parser.add_argument(
+        "--max-concurrent-llm",
+        type=int,
+        default=4,
+        help="同時送往 LLM 的請求上限 (default: 4)",
+    )
+    parser.add_argument(
+        "--retrieval-workers",
+        type=int,
+        default=4,
+        help="處理嵌入與 FAISS 搜尋的執行緒數 (default: 4)",
+    )
+    parser.add_argument(
+        "--embedding-backend",
+        choices=EMBEDDING_BACKENDS,
+        default="torch",
+        help="嵌入模型的推論後端 (default: torch)",
+    )
+    parser.add_argument("--embed-threads", type=int, help="嵌入模型使用的 CPU 執行緒數")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="啟動 FastAPI 服務")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--llm-host", help="Ollama 位址（預設使用 OLLAMA_HOST 或 localhost:11434）")
+
+    bench = subparsers.add_parser("bench", help="以假 LLM 伺服器量測吞吐量")
+    bench.add_argument("--users", type=int, nargs="+", default=[1, 4, 16], help="同時使用者數")
+    bench.add_argument("--requests-per-user", type=int, default=5)
+    bench.add_argument("--stub-delay", type=float, default=0.5, help="假 LLM 每次回答的延遲秒數")
+    bench.add_argument("--stub-port", type=int, default=11500)
+    return parser
+
+
+def _build_pipeline(args: argparse.Namespace) -> RAGPipeline:
+    pipeline = RAGPipeline(
+        data_folder=args.data_folder,
+        retriever_top_k=args.top_k,
+        cache_dir=args.cache_dir,
+        index_dir=args.index_dir,
+        embedding_backend=args.embedding_backend,
+        embed_threads=args.embed_threads,
+    )
+    if args.index_dir and VectorStore.exists(args.index_dir):
+        pipeline.load_index(args.index_dir)
+    else:
+        pipeline.prepare_corpus()
+    return pipeline
+
+
+def main() -> None:
+    args = build_arg_parser().parse_args()
+    pipeline = _build_pipeline(args)
+
+    if args.command == "serve":
+        rag = AsyncRAGPipeline(
+            pipeline,
+            llm_host=args.llm_host,
+            max_concurrent_llm=args.max_concurrent_llm,
+            retrieval_workers=args.retrieval_workers,
+        )
+        uvicorn.run(create_app(rag), host=args.host, port=args.port)
+        return
+
+    stub = _start_background_server(
+        create_stub_llm_app(delay=args.stub_delay), "127.0.0.1", args.stub_port
+    )
+    questions = [
+        "What is multi-agent debate?",
+        "How do agents reach consensus?",
+        "What are the limitations of debate?",
+        "Multi-Agent Debate 的流程是什麼？",
+    ]
+    print(f"\n假 LLM 延遲 {args.stub_delay} 秒，同時 LLM 請求上限 {args.max_concurrent_llm}")
+    print(f"{'使用者':>6} {'請求數':>6} {'吞吐量(req/s)':>14} {'p50(ms)':>10} {'p95(ms)':>10}")
+    try:
+        for users in args.users:
+            rag = AsyncRAGPipeline(
+                pipeline,
+                llm_host=f"http://127.0.0.1:{args.stub_port}",
+                max_concurrent_llm=args.max_concurrent_llm,
+                retrieval_workers=args.retrieval_workers,
+            )
+            result = asyncio.run(_bench(rag, questions, users, args.requests_per_user))
+            print(
+                f"{result['users']:>6} {result['requests']:>6} {result['throughput']:>14.2f} "
+                f"{result['p50_ms']:>10.0f} {result['p95_ms']:>10.0f}"
+            )
+    finally:
+        stub.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
@@ -19,23 +19,83 @@ python week04_rag/rag_test.py
 
 # 自訂問題或資料夾
 python week04_rag/rag_test.py -q "Multi-Agent Debate 的流程是什麼？" --data-folder my_papers
+
+# 嵌入向量預設快取在 .rag_cache/，第二次啟動只會計算新的區塊
+python week04_rag/rag_test.py --cache-dir /tmp/rag_cache
+
+# 將索引存到資料夾，之後啟動只處理新增、變更或刪除的 PDF
+python week04_rag/rag_test.py --index-dir rag_index
+
+# 服務行程不檢查 PDF，直接以 mmap 載入索引（多個行程可共用同一份索引檔）
+python week04_rag/rag_test.py --index-dir rag_index --no-sync
+
+# 以 4 個行程平行擷取 PDF 文字（大型 PDF 會再依頁面拆分）
+python week04_rag/rag_test.py --workers 4
+
+# 大型語料改用近似索引（auto 依區塊數量挑選），並印出相對暴力搜尋的 recall@k
+python week04_rag/rag_test.py --index-type hnsw --ef-search 128
+
+# 逐字顯示回答，並列出首個 token 時間與 tokens/秒
+python week04_rag/rag_test.py --stream
+
+# 關鍵字（模型名稱、論文編號）較多的問題：BM25 + 向量混合檢索，再以 cross-encoder 重排序
+python week04_rag/rag_test.py --retrieval hybrid --rerank-model cross-encoder/ms-marco-MiniLM-L-6-v2
+
+# 中文或排版複雜的文件：以句子為單位切成約 256 tokens 的區塊，並只檢索第 3-5 頁
+python week04_rag/rag_test.py --chunk-strategy sentences --pages 3-5
+
+# 只有 CPU 的機器：以 onnxruntime 執行 int8 量化的嵌入模型，固定使用 4 個執行緒
+python week04_rag/rag_test.py --embedding-backend onnx-int8 --embed-threads 4
+
+# 索引向量以 int8 儲存（約 1/4 記憶體），前 4 倍候選再以 float32 原始向量重新計分
+python week04_rag/rag_test.py --index-dir rag_index --vector-storage int8 --rescore 4
+
+# 以 PCA 把索引降到 128 維（投影矩陣存成 rag_index/pca.faiss），並印出相對 384 維的 recall@k
+python week04_rag/rag_test.py --index-dir rag_index --pca-dim 128
 ```
 """
 
 from __future__ import annotations
 
 import argparse
+import atexit
+import functools
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import queue
 import textwrap
+import threading
+import time
 import re
+import unicodedata
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Sequence, Tuple
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
 
 import faiss
 import numpy as np
 import ollama
 from pypdf import PdfReader
-from sentence_transformers import SentenceTransformer
+from sentence_transformers import CrossEncoder, SentenceTransformer
 
 
 @dataclass
@@ -46,63 +106,853 @@ class Document:
     metadata: Dict[str, Any] = field(default_factory=dict)
 
 
+@dataclass
+class PDFExtraction:
+    """單一 PDF 的擷取結果；失敗時 ``error`` 不為 None，``text`` 為空字串"""
+
+    path: Path
+    text: str = ""
+    error: Exception | None = None
+
+
+def _extract_pages(pdf_path: str, start: int = 0, stop: int | None = None) -> List[Tuple[int, str]]:
+    """擷取第 ``start`` 到 ``stop`` 頁（不含）的文字，回傳 (頁碼, 文字)
+
+    定義在模組層級，才能交給 ProcessPoolExecutor 在子行程執行。
+    """
+    pages: List[Tuple[int, str]] = []
+    with open(pdf_path, "rb") as file:
+        reader = PdfReader(file)
+        stop = len(reader.pages) if stop is None else min(stop, len(reader.pages))
+        for page_index in range(start, stop):
+            page_text = reader.pages[page_index].extract_text() or ""
+            pages.append((page_index + 1, page_text))
+    return pages
+
+
+T = TypeVar("T")
+
+
+def _prefetch(items: Iterable[T], depth: int) -> Iterator[T]:
+    """在背景執行緒中先行產生 ``items``，最多暫存 ``depth`` 筆
+
+    讓上游（PDF 擷取、切割）與下游（嵌入計算）在時間上重疊；
+    佇列有上限，所以記憶體用量不會隨語料大小成長。
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=max(depth, 1))
+    finished = object()
+    failures: List[BaseException] = []
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except BaseException as exc:  # 交給主執行緒重新拋出
+            failures.append(exc)
+        finally:
+            put(finished)
+
+    worker = threading.Thread(target=produce, name="rag-prefetch", daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is finished:
+                break
+            yield item
+        if failures:
+            raise failures[0]
+    finally:
+        stop.set()
+        worker.join()
+
+
+def _batched(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def _join_pages(pages: Iterable[Tuple[int, str]]) -> str:
+    text = "".join(
+        f"\n[Page {page_num}]\n{page_text}" for page_num, page_text in pages if page_text.strip()
+    )
+    return text.strip()
+
+
+# 與 str.split() / str.isspace() 相同的空白字元；查表時超出範圍的字元一律視為非空白
+_WHITESPACE = np.zeros(0x3001 + 1, dtype=bool)
+_WHITESPACE[
+    [0x09, 0x0A, 0x0B, 0x0C, 0x0D, 0x1C, 0x1D, 0x1E, 0x1F, 0x20, 0x85, 0xA0, 0x1680]
+    + list(range(0x2000, 0x200B))
+    + [0x2028, 0x2029, 0x202F, 0x205F, 0x3000]
+] = True
+
+
+def word_spans(text: str, block_chars: int = 1 << 18) -> Tuple[np.ndarray, np.ndarray]:
+    """一次算出每個詞的 (起點, 終點) 字元位置，切法與 ``text.split()`` 相同
+
+    以 numpy 查表找出空白與非空白的交界，不會建立任何詞字串；
+    每次只處理 ``block_chars`` 個字元，暫存陣列的大小不隨文件長度成長。
+    """
+    # 位置用 int32 即可涵蓋 2G 字元，詞位置陣列只佔一半記憶體
+    dtype = np.int32 if len(text) < 2**31 else np.int64
+    starts: List[np.ndarray] = []
+    ends: List[np.ndarray] = []
+    previous = np.zeros(1, dtype=bool)
+    for offset in range(0, len(text), block_chars):
+        block = text[offset : offset + block_chars]
+        if block.isascii():
+            codes = np.frombuffer(block.encode("ascii"), dtype=np.uint8)
+        else:
+            codes = np.frombuffer(block.encode("utf-32-le"), dtype=np.uint32)
+        # 超出查表範圍的字元夾到最後一格（非空白）
+        is_word = ~np.take(_WHITESPACE, codes, mode="clip")
+        edges = np.diff(is_word.view(np.int8), prepend=previous.view(np.int8))
+        starts.append((np.flatnonzero(edges == 1) + offset).astype(dtype))
+        ends.append((np.flatnonzero(edges == -1) + offset).astype(dtype))
+        previous = is_word[-1:]
+    if previous[0]:
+        ends.append(np.array([len(text)], dtype=dtype))
+    if not starts:
+        return np.zeros(0, dtype=dtype), np.zeros(0, dtype=dtype)
+    return np.concatenate(starts), np.concatenate(ends)
+
+
+def collapsed_offsets(
+    word_starts: np.ndarray, word_ends: np.ndarray, positions: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """原文字元位置換算成 (所在詞序號, 在 ``" ".join(text.split())`` 中的字元位置)
+
+    落在空白中的位置對應到下一個詞的開頭。合併空白後的位置不受原文空白多寡影響，
+    CJK 這類不以空白分詞的文字也能以它判斷區塊是否重疊。
+    """
+    lengths = (word_ends - word_starts).astype(np.int64)
+    collapsed_starts = np.concatenate(([0], np.cumsum(lengths[:-1]))) + np.arange(len(lengths))
+    words = np.searchsorted(word_ends, positions, side="right")
+    if not len(lengths):
+        return words, np.zeros(len(words), dtype=np.int64)
+    inside = np.minimum(words, len(lengths) - 1)
+    offsets = np.maximum(positions - word_starts[inside], 0)
+    return words, collapsed_starts[inside] + offsets
+
+
+def window_spans(
+    starts: np.ndarray, ends: np.ndarray, size: int, step: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """把詞（或 token）位置切成重疊視窗，回傳 (起始序號, 起點字元, 終點字元)"""
+    first = np.arange(0, len(starts), step)
+    last = np.minimum(first + size, len(starts)) - 1
+    return first, starts[first], ends[last]
+
+
+def pack_spans(
+    begins: np.ndarray, ends: np.ndarray, sizes: np.ndarray, max_tokens: int, overlap_tokens: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """把連續的片段（句子、段落）依序裝進不超過 ``max_tokens`` 的區塊
+
+    每個片段本身不可超過 ``max_tokens``。新區塊開頭會重複上一塊結尾的幾個片段，
+    重複部分不超過 ``overlap_tokens``，且一定留得下下一個新片段。
+    """
+    sizes = sizes.tolist()
+    chunk_begins: List[int] = []
+    chunk_ends: List[int] = []
+    first = 0
+    while first < len(sizes):
+        last, used = first, sizes[first]
+        while last + 1 < len(sizes) and used + sizes[last + 1] <= max_tokens:
+            last += 1
+            used += sizes[last]
+        chunk_begins.append(int(begins[first]))
+        chunk_ends.append(int(ends[last]))
+        if last + 1 == len(sizes):
+            break
+        following, carried = last + 1, 0
+        while (
+            following - 1 > first
+            and carried + sizes[following - 1] <= overlap_tokens
+            and carried + sizes[following - 1] + sizes[last + 1] <= max_tokens
+        ):
+            following -= 1
+            carried += sizes[following]
+        first = following
+    return np.array(chunk_begins, dtype=np.int64), np.array(chunk_ends, dtype=np.int64)
+
+
+# load_pdf 在每頁開頭插入的頁碼標記
+_PAGE_MARKER = re.compile(r"\[Page (\d+)\]")
+
+
+def page_markers(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """``[Page N]`` 標記在 ``text`` 中的 (起點字元, 頁碼)"""
+    markers = [(match.start(), int(match.group(1))) for match in _PAGE_MARKER.finditer(text)]
+    if not markers:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    starts, numbers = zip(*markers)
+    return np.array(starts, dtype=np.int64), np.array(numbers, dtype=np.int64)
+
+
+def split_pages(text: str) -> Tuple[str, np.ndarray, np.ndarray]:
+    """移除 ``[Page N]`` 標記，回傳 (內文, 各頁起點字元, 頁碼)
+
+    頁與頁之間以空行相接，句子與段落切割不會把兩頁的文字黏成一句。
+    """
+    fragments = _PAGE_MARKER.split(text)
+    pages = [(None, fragments[0])] + [
+        (int(number), body) for number, body in zip(fragments[1::2], fragments[2::2])
+    ]
+    parts: List[str] = []
+    starts: List[int] = []
+    numbers: List[int] = []
+    offset = 0
+    for number, body in pages:
+        body = body.strip()
+        if not body:
+            continue
+        if parts:
+            offset += 2
+        if number is not None:
+            starts.append(offset)
+            numbers.append(number)
+        parts.append(body)
+        offset += len(body)
+    return "\n\n".join(parts), np.array(starts, dtype=np.int64), np.array(numbers, dtype=np.int64)
+
+
+def _pages_at(page_starts: np.ndarray, page_numbers: np.ndarray, offsets: np.ndarray) -> List[int | None]:
+    """每個字元位置所在的頁碼；第一個標記之前的位置沒有頁碼"""
+    index = np.searchsorted(page_starts, offsets, side="right") - 1
+    return [int(page_numbers[i]) if i >= 0 else None for i in index.tolist()]
+
+
+# tiktoken 無法使用時的粗估：CJK 每字一個 token，英文單字、數字、標點各算一個
+_FALLBACK_TOKEN = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]|[A-Za-z]+|\d+|[^\sA-Za-z\d]")
+# 同一個編碼只載入（或失敗提示）一次；None 代表改用粗估
+_ENCODINGS: Dict[str, Any] = {}
+
+
+class TokenCounter:
+    """以 tiktoken 計算 token，載入失敗（未安裝或離線無法下載編碼表）時改用粗估"""
+
+    def __init__(self, encoding_name: str = "cl100k_base"):
+        if encoding_name not in _ENCODINGS:
+            try:
+                import tiktoken
+
+                _ENCODINGS[encoding_name] = tiktoken.get_encoding(encoding_name)
+            except Exception as exc:  # pragma: no cover - 依安裝與網路環境而定
+                print(f"無法載入 tiktoken 編碼 {encoding_name}（{exc.__class__.__name__}），改用粗估 token 數。")
+                _ENCODINGS[encoding_name] = None
+        self._encoding = _ENCODINGS[encoding_name]
+
+    @property
+    def name(self) -> str:
+        """實際使用的編碼名稱，粗估時為 "regex"（寫入索引設定，切法不同時會重建）"""
+        return self._encoding.name if self._encoding is not None else "regex"
+
+    def count(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return len(_FALLBACK_TOKEN.findall(text))
+
+    def spans(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """每個 token 的 (起點, 終點) 字元位置"""
+        if self._encoding is not None:
+            tokens = self._encoding.encode_ordinary(text)
+            _decoded, offsets = self._encoding.decode_with_offsets(tokens)
+            starts = np.array(offsets, dtype=np.int64)
+            return starts, np.append(starts[1:], len(text)).astype(np.int64)
+        bounds = np.fromiter(
+            itertools.chain.from_iterable(match.span() for match in _FALLBACK_TOKEN.finditer(text)),
+            dtype=np.int64,
+        )
+        return bounds[0::2], bounds[1::2]
+
+
+CHUNK_STRATEGIES = ("words", "tokens", "sentences", "recursive")
+# 各策略的預設 (chunk_size, chunk_overlap)；words 以詞為單位，其餘以 token 為單位
+CHUNK_DEFAULTS: Dict[str, Tuple[int, int]] = {
+    "words": (600, 100),
+    "tokens": (256, 32),
+    "sentences": (256, 32),
+    "recursive": (256, 32),
+}
+# 句尾：英文句點、問號、驚嘆號（可再接引號或括號）後接空白，中文句末標點，或空行
+_SENTENCE_END = re.compile(r"[.!?][\"')\]]*(?=\s)|[。！？；]+|\n\s*\n")
+# 與 RecursiveCharacterTextSplitter 預設相同的順序，另外加上中文句號；全都切不開時以 token 硬切
+RECURSIVE_SEPARATORS = ("\n\n", "\n", "。", ". ", " ")
+
+
 class PDFProcessor:
-    """負責載入 PDF 並切割成文字區塊"""
+    """負責載入 PDF 並切割成文字區塊
+
+    ``strategy`` 決定切法：
 
-    def __init__(self, chunk_size: int = 600, chunk_overlap: int = 100):
+    - ``words``：依空白切詞後取固定詞數的重疊視窗（中文沒有空格，整段會被當成一個詞）
+    - ``tokens``：固定 token 數的重疊視窗
+    - ``sentences``：以句子為單位裝滿 token 預算，不會在句子中間切斷
+    - ``recursive``：依段落、換行、句號、空白的順序遞迴切開後再裝填
+
+    除了 ``words``，``chunk_size`` 與 ``chunk_overlap`` 都以 token 計算。
+    每個區塊的 metadata 會記錄起訖頁碼 ``page`` / ``page_end``。
+    """
+
+    # 過短段落容易產生噪音，直接跳過；token 策略以 token 數判斷，中文短句才不會被誤刪
+    min_chunk_chars = 80
+    min_chunk_tokens = 20
+
+    def __init__(
+        self,
+        chunk_size: int | None = None,
+        chunk_overlap: int | None = None,
+        max_workers: int = 1,
+        pages_per_task: int = 50,
+        strategy: str = "words",
+        encoding_name: str = "cl100k_base",
+    ):
+        if strategy not in CHUNK_STRATEGIES:
+            raise ValueError(f"未知的切割策略 {strategy}，可用：{', '.join(CHUNK_STRATEGIES)}")
+        default_size, default_overlap = CHUNK_DEFAULTS[strategy]
+        chunk_size = chunk_size if chunk_size is not None else default_size
+        chunk_overlap = chunk_overlap if chunk_overlap is not None else default_overlap
         if chunk_overlap >= chunk_size:
             raise ValueError("chunk_overlap 必須小於 chunk_size")
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.strategy = strategy
+        self.tokens = TokenCounter(encoding_name) if strategy != "words" else None
+        self.max_workers = max_workers
+        # 超過此頁數的 PDF 會被拆成多個頁面區段，平均分給各個行程
+        self.pages_per_task = pages_per_task
+
+    @property
+    def settings(self) -> Dict[str, Any]:
+        """影響切割結果的參數，寫入增量索引的設定"""
+        settings: Dict[str, Any] = {
+            "chunk_strategy": self.strategy,
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+        }
+        if self.tokens is not None:
+            settings["tokenizer"] = self.tokens.name
+        return settings
 
     def load_pdf(self, pdf_path: Path) -> str:
         """讀取 PDF 檔案並回傳完整文字"""
-        text = ""
-        with pdf_path.open("rb") as file:
-            reader = PdfReader(file)
-            for page_num, page in enumerate(reader.pages, start=1):
-                page_text = page.extract_text() or ""
-                if page_text.strip():
-                    text += f"\n[Page {page_num}]\n{page_text}"
-        return text.strip()
+        return _join_pages(_extract_pages(str(pdf_path)))
+
+    def load_pdfs(self, pdf_paths: Sequence[Path]) -> List[PDFExtraction]:
+        """擷取多個 PDF，回傳順序與 ``pdf_paths`` 相同"""
+        return list(self.iter_pdfs(pdf_paths))
+
+    def iter_pdfs(self, pdf_paths: Sequence[Path]) -> Iterator[PDFExtraction]:
+        """逐一產生 PDF 擷取結果；``max_workers > 1`` 時以多個行程平行處理
+
+        產生順序與 ``pdf_paths`` 相同，且最多只預先處理 ``2 * max_workers``
+        個檔案，避免所有文字同時留在記憶體。單一檔案失敗只會記錄在該檔的
+        ``error``，不影響其他檔案。
+        """
+        if self.max_workers <= 1:
+            for pdf_path in pdf_paths:
+                try:
+                    yield PDFExtraction(pdf_path, self.load_pdf(pdf_path))
+                except Exception as exc:  # pragma: no cover - 以防外部錯誤
+                    yield PDFExtraction(pdf_path, error=exc)
+            return
+        if not pdf_paths:
+            return
+
+        # 可能在背景執行緒（串流建索引）中建立，此時主執行緒正在跑 PyTorch；
+        # fork 會複製到其他執行緒持有的鎖，與嵌入行程池一樣改用 spawn
+        with ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            remaining = iter(pdf_paths)
+            in_flight: Deque[Tuple[Path, List[Future] | Exception]] = deque()
+
+            def submit_next() -> bool:
+                pdf_path = next(remaining, None)
+                if pdf_path is None:
+                    return False
+                try:
+                    with pdf_path.open("rb") as file:
+                        page_count = len(PdfReader(file).pages)
+                except Exception as exc:  # pragma: no cover - 以防外部錯誤
+                    in_flight.append((pdf_path, exc))
+                    return True
+                futures = [
+                    executor.submit(_extract_pages, str(pdf_path), start, start + self.pages_per_task)
+                    for start in range(0, max(page_count, 1), self.pages_per_task)
+                ]
+                in_flight.append((pdf_path, futures))
+                return True
+
+            while len(in_flight) < 2 * self.max_workers and submit_next():
+                pass
+            while in_flight:
+                pdf_path, tasks = in_flight.popleft()
+                yield self._collect_pages(pdf_path, tasks)
+                submit_next()
+
+    @staticmethod
+    def _collect_pages(pdf_path: Path, tasks: List[Future] | Exception) -> PDFExtraction:
+        if isinstance(tasks, Exception):
+            return PDFExtraction(pdf_path, error=tasks)
+        pages: List[Tuple[int, str]] = []
+        for future in tasks:
+            try:
+                pages.extend(future.result())
+            except Exception as exc:  # pragma: no cover - 以防外部錯誤
+                for other in tasks:
+                    other.cancel()
+                return PDFExtraction(pdf_path, error=exc)
+        return PDFExtraction(pdf_path, _join_pages(pages))
 
     def chunk_text(self, text: str, source: str) -> List[Document]:
         """將長文本切成帶有重疊的區塊"""
-        text = re.sub(r"\s+", " ", text).strip()
-        words = text.split()
-        if not words:
-            return []
+        return list(self.iter_chunks(text, source))
 
+    def chunk_spans(self, text: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """各區塊的 (起始詞序號, 合併空白後的起點, 起點字元, 終點字元)，需要內文時再從 ``text`` 切出
+
+        ``words`` 以外的策略應傳入 ``split_pages`` 去除頁碼標記後的內文。
+        前兩欄供 ContextPacker 判斷同一份文件的區塊是否重疊。
+        """
         step = self.chunk_size - self.chunk_overlap
-        chunks: List[Document] = []
+        word_starts, word_ends = word_spans(text)
+        if self.strategy == "words":
+            _first, begins, ends = window_spans(word_starts, word_ends, self.chunk_size, step)
+            return (*collapsed_offsets(word_starts, word_ends, begins), begins, ends)
+
+        token_starts, token_ends = self.tokens.spans(text)
+        if self.strategy == "tokens":
+            _first, begins, ends = window_spans(token_starts, token_ends, self.chunk_size, step)
+        else:
+            if self.strategy == "sentences":
+                edges = [0, *(match.end() for match in _SENTENCE_END.finditer(text)), len(text)]
+                pieces = [
+                    piece
+                    for begin, end in zip(edges, edges[1:])
+                    for piece in self._split_by_tokens(begin, end, token_starts)
+                ]
+            else:
+                pieces = self._split_recursive(text, 0, len(text), RECURSIVE_SEPARATORS, token_starts)
+            pieces = [(begin, end) for begin, end in pieces if end > begin]
+            if not pieces:
+                empty = np.zeros(0, dtype=np.int64)
+                return empty, empty, empty, empty
+            piece_begins, piece_ends = (np.array(column, dtype=np.int64) for column in zip(*pieces))
+            sizes = np.searchsorted(token_starts, piece_ends) - np.searchsorted(token_starts, piece_begins)
+            begins, ends = pack_spans(piece_begins, piece_ends, sizes, self.chunk_size, self.chunk_overlap)
+        return (*collapsed_offsets(word_starts, word_ends, begins), begins, ends)
+
+    def _split_by_tokens(self, begin: int, end: int, token_starts: np.ndarray) -> List[Tuple[int, int]]:
+        """把超過 ``chunk_size`` 個 token 的片段硬切成數段"""
+        first, stop = np.searchsorted(token_starts, [begin, end]).tolist()
+        if stop - first <= self.chunk_size:
+            return [(begin, end)]
+        cuts = token_starts[first + self.chunk_size : stop : self.chunk_size].tolist()
+        edges = [begin, *cuts, end]
+        return list(zip(edges, edges[1:]))
+
+    def _split_recursive(
+        self,
+        text: str,
+        begin: int,
+        end: int,
+        separators: Sequence[str],
+        token_starts: np.ndarray,
+    ) -> List[Tuple[int, int]]:
+        """依序嘗試 ``separators``，直到每個片段都不超過 ``chunk_size`` 個 token"""
+        first, stop = np.searchsorted(token_starts, [begin, end]).tolist()
+        if stop - first <= self.chunk_size:
+            return [(begin, end)]
+        if not separators:
+            return self._split_by_tokens(begin, end, token_starts)
+
+        separator, rest = separators[0], separators[1:]
+        edges = [begin]
+        position = text.find(separator, begin, end)
+        while position != -1:
+            # 分隔符號留在前一段的結尾
+            edges.append(position + len(separator))
+            position = text.find(separator, edges[-1], end)
+        if edges[-1] != end:
+            edges.append(end)
+        return [
+            piece
+            for piece_begin, piece_end in zip(edges, edges[1:])
+            for piece in self._split_recursive(text, piece_begin, piece_end, rest, token_starts)
+        ]
+
+    def iter_chunks(self, text: str, source: str) -> Iterator[Document]:
+        """``chunk_text`` 的產生器版本，切好一塊就交出一塊
 
-        for start in range(0, len(words), step):
-            window = words[start : start + self.chunk_size]
-            chunk_text = " ".join(window)
-            if len(chunk_text) < 80:  # 過短段落容易產生噪音，直接跳過
+        切割位置只計算一次；每個區塊在交出時才從原文切出並合併空白，
+        重疊部分不會預先複製多份。
+        """
+        if self.strategy == "words":
+            # words 策略保留原文（含頁碼標記），區塊內容與舊版完全相同
+            page_starts, page_numbers = page_markers(text)
+        else:
+            text, page_starts, page_numbers = split_pages(text)
+        start_words, start_chars, begins, ends = self.chunk_spans(text)
+        first_pages = _pages_at(page_starts, page_numbers, begins)
+        last_pages = _pages_at(page_starts, page_numbers, ends - 1)
+
+        chunk_id = 0
+        for start_word, start_char, begin, end, page, page_end in zip(
+            start_words.tolist(),
+            start_chars.tolist(),
+            begins.tolist(),
+            ends.tolist(),
+            first_pages,
+            last_pages,
+        ):
+            content = " ".join(text[begin:end].split())
+            if (
+                len(content) < self.min_chunk_chars
+                if self.tokens is None
+                else self.tokens.count(content) < self.min_chunk_tokens
+            ):
                 continue
-            chunks.append(
-                Document(
-                    content=chunk_text,
-                    metadata={
-                        "source": source,
-                        "chunk_id": len(chunks),
-                        "start_word": start,
-                    },
-                )
-            )
-        return chunks
+            metadata: Dict[str, Any] = {
+                "source": source,
+                "chunk_id": chunk_id,
+                "start_word": start_word,
+                "start_char": start_char,
+                "end_char": start_char + len(content),
+            }
+            if page is not None:
+                metadata["page"] = page
+                metadata["page_end"] = page_end
+            yield Document(content=content, metadata=metadata)
+            chunk_id += 1
+
+
+class QueryEmbeddingCache:
+    """查詢向量的 LRU 快取，可另外設定存活時間 (TTL)
+
+    鍵是正規化後的問題文字（NFKC + 合併空白），重複的問題不必再跑一次
+    transformer。多個執行緒可以同時使用。
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: float | None = None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: "OrderedDict[str, Tuple[float, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(unicodedata.normalize("NFKC", text).split())
+
+    def get(self, key: str) -> np.ndarray | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl_seconds is not None:
+                if time.monotonic() - entry[0] > self.ttl_seconds:
+                    del self._entries[key]
+                    self.expirations += 1
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, vector: np.ndarray) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+@dataclass
+class EmbeddingStats:
+    """語料嵌入的累計統計（``EmbeddingModel.encode_corpus``）
+
+    ``padded_tokens`` 是每批補齊到最長文字後、模型實際計算的 token 數；
+    只有依 token 預算分批時才會統計。
+    """
+
+    texts: int = 0
+    batches: int = 0
+    tokens: int = 0
+    padded_tokens: int = 0
+    seconds: float = 0.0
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.texts / self.seconds if self.seconds else 0.0
+
+    @property
+    def padding_ratio(self) -> float:
+        return 1 - self.tokens / self.padded_tokens if self.padded_tokens else 0.0
+
+    def summary(self) -> str:
+        text = (
+            f"嵌入 {self.texts} 個區塊、{self.batches} 批，耗時 {self.seconds:.2f} 秒"
+            f"（{self.chunks_per_second:.1f} 區塊/秒）"
+        )
+        if self.padded_tokens:
+            text += f"，補齊浪費 {self.padding_ratio:.1%} 的 token"
+        return text
 
 
 class EmbeddingModel:
-    """使用 sentence-transformers 產生文本向量"""
+    """使用 sentence-transformers 產生文本向量
+
+    ``backend`` 決定推論方式：
+
+    - ``torch``：PyTorch（預設）
+    - ``onnx``：匯出成 ONNX 後以 onnxruntime 執行，向量與 PyTorch 幾乎相同
+    - ``onnx-int8``：再做動態 int8 量化，更快也更省記憶體，向量有些微誤差
 
-    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
-        print(f"載入嵌入模型: {model_name} (CPU mode)")
-        self.model = SentenceTransformer(model_name, device="cpu")
+    ONNX 模型第一次使用時匯出到 ``onnx_dir``，之後直接載入。
+    ``threads`` 指定推論使用的 CPU 執行緒數，未指定則由函式庫自行決定。
+    ``token_budget`` 指定時，語料改依 token 長度分桶、以補齊後的 token 數決定每批大小。
+    呼叫 ``start_pool`` 後，語料改由多個行程一起嵌入（查詢仍在本行程計算）。
+    """
+
+    def __init__(
+        self,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        query_cache_size: int = 1024,
+        query_cache_ttl: float | None = None,
+        *,
+        backend: str = "torch",
+        threads: int | None = None,
+        onnx_dir: str | Path = ".rag_cache/onnx",
+        token_budget: int | None = None,
+    ):
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"未知的嵌入後端 {backend}，可用：{', '.join(EMBEDDING_BACKENDS)}")
+        print(f"載入嵌入模型: {model_name} (CPU mode, {backend})")
+        self.model_name = model_name
+        self.backend = backend
+        self.threads = threads
+        self.token_budget = token_budget
+        self.onnx_dir = Path(onnx_dir)
+        self.corpus_stats = EmbeddingStats()
+        self._pool: ProcessPoolExecutor | None = None
+        self.pool_workers = 0
+        if backend == "torch":
+            if threads:
+                import torch
+
+                torch.set_num_threads(threads)
+            self.model = SentenceTransformer(model_name, device="cpu")
+        else:
+            self.model = self._load_onnx(self.onnx_dir)
         self.dimension = self.model.get_sentence_embedding_dimension()
+        self.query_cache = (
+            QueryEmbeddingCache(query_cache_size, query_cache_ttl) if query_cache_size > 0 else None
+        )
 
-    def encode(self, texts: Sequence[str], batch_size: int = 32) -> np.ndarray:
+    @property
+    def model_id(self) -> str:
+        """向量快取與索引設定使用的名稱；int8 量化後的向量與原模型不同，必須分開存放"""
+        return f"{self.model_name}@int8" if self.backend == "onnx-int8" else self.model_name
+
+    def _load_onnx(self, onnx_dir: Path) -> SentenceTransformer:
+        try:
+            import onnxruntime
+            from sentence_transformers import export_dynamic_quantized_onnx_model
+        except ImportError as exc:
+            raise RuntimeError(
+                'ONNX 後端需要 onnxruntime 與 optimum：pip install "sentence-transformers[onnx]"'
+            ) from exc
+
+        local_dir = onnx_dir / self.model_name.replace("/", "__")
+        if not (local_dir / "modules.json").exists():
+            print(f"第一次使用 ONNX 後端，匯出模型到 {local_dir}")
+            SentenceTransformer(self.model_name, device="cpu", backend="onnx").save(str(local_dir))
+
+        model_kwargs: Dict[str, Any] = {"provider": "CPUExecutionProvider"}
+        if self.backend == "onnx-int8":
+            # 量化設定依 CPU 指令集而定：ARM 用 arm64，x86 用幾乎所有機器都支援的 avx2
+            config = "arm64" if platform.machine().lower() in ("arm64", "aarch64") else "avx2"
+            model_kwargs["file_name"] = f"onnx/model_qint8_{config}.onnx"
+            if not (local_dir / model_kwargs["file_name"]).exists():
+                print(f"動態量化為 int8（{config}）")
+                export_dynamic_quantized_onnx_model(
+                    SentenceTransformer(str(local_dir), device="cpu", backend="onnx"),
+                    config,
+                    str(local_dir),
+                )
+        if self.threads:
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = self.threads
+            session_options.inter_op_num_threads = 1
+            model_kwargs["session_options"] = session_options
+        return SentenceTransformer(
+            str(local_dir), device="cpu", backend="onnx", model_kwargs=model_kwargs
+        )
+
+    def encode(
+        self, texts: Sequence[str], batch_size: int = 32, *, use_query_cache: bool = False
+    ) -> np.ndarray:
+        """產生正規化後的向量；``use_query_cache=True`` 時先查詢向量快取
+
+        只有查詢（使用者問題）才適合走快取，語料區塊請使用預設值。
+        """
+        if not use_query_cache or self.query_cache is None:
+            return self._encode(texts, batch_size)
+
+        output = np.empty((len(texts), self.dimension), dtype=np.float32)
+        missing: Dict[str, List[int]] = {}
+        for position, text in enumerate(texts):
+            key = QueryEmbeddingCache.normalize(text)
+            cached = self.query_cache.get(key)
+            if cached is None:
+                missing.setdefault(key, []).append(position)
+            else:
+                output[position] = cached
+
+        if missing:
+            keys = list(missing)
+            vectors = self._encode([texts[missing[key][0]] for key in keys], batch_size)
+            for key, vector in zip(keys, vectors):
+                output[missing[key]] = vector
+                self.query_cache.put(key, vector.copy())
+        return output
+
+    def encode_corpus(self, texts: Sequence[str], batch_size: int = 32) -> np.ndarray:
+        """嵌入語料區塊並累計 ``corpus_stats``
+
+        未設定 ``token_budget`` 時與 ``encode`` 相同，每批固定 ``batch_size`` 筆。
+        設定時先算出每段的 token 數，由短到長分成長度相近的桶，每批「筆數 × 最長長度」
+        不超過預算：短區塊可以一次算很多筆，也幾乎不必補齊；最後再依原本順序放回。
+        """
+        started = time.perf_counter()
+        if self._pool is not None and len(texts) > batch_size:
+            embeddings = self._encode_in_pool(texts, batch_size)
+        elif self.token_budget is None:
+            embeddings = self._encode(texts, batch_size)
+            self.corpus_stats.batches += math.ceil(len(texts) / batch_size)
+        else:
+            embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+            lengths = self.token_lengths(texts)
+            for batch in self._token_batches(lengths, self.token_budget):
+                embeddings[batch] = self._encode([texts[i] for i in batch.tolist()], len(batch))
+                self.corpus_stats.batches += 1
+                self.corpus_stats.tokens += int(lengths[batch].sum())
+                self.corpus_stats.padded_tokens += int(lengths[batch].max()) * len(batch)
+        self.corpus_stats.texts += len(texts)
+        self.corpus_stats.seconds += time.perf_counter() - started
+        return embeddings
+
+    def start_pool(self, workers: int, threads_per_worker: int | None = None) -> None:
+        """啟動 ``workers`` 個嵌入行程，每個行程各載入一份模型
+
+        每個行程固定使用 ``threads_per_worker`` 個執行緒（預設平分 CPU 核心），
+        避免多個行程各自開滿執行緒互相搶 CPU。
+        """
+        if self._pool is not None:
+            return
+        threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        print(f"啟動 {workers} 個嵌入行程，每個使用 {threads} 個執行緒")
+        # 父行程已載入 PyTorch / OpenMP，fork 之後可能卡死，因此改用 spawn
+        self._pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_embedding_worker,
+            initargs=(self.model_name, self.backend, threads, str(self.onnx_dir), self.token_budget),
+        )
+        self.pool_workers = workers
+
+    def close_pool(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+            self.pool_workers = 0
+
+    def _encode_in_pool(self, texts: Sequence[str], batch_size: int) -> np.ndarray:
+        """把 ``texts`` 平分給各行程，依原順序接回單一 float32 陣列"""
+        bounds = np.linspace(0, len(texts), self.pool_workers + 1).astype(int).tolist()
+        futures = [
+            self._pool.submit(_embed_in_worker, list(texts[start:stop]), batch_size)
+            for start, stop in zip(bounds, bounds[1:])
+            if stop > start
+        ]
+        parts: List[np.ndarray] = []
+        for future in futures:
+            vectors, stats = future.result()
+            parts.append(vectors)
+            self.corpus_stats.batches += stats.batches
+            self.corpus_stats.tokens += stats.tokens
+            self.corpus_stats.padded_tokens += stats.padded_tokens
+        return np.concatenate(parts).astype(np.float32, copy=False)
+
+    def token_lengths(self, texts: Sequence[str]) -> np.ndarray:
+        """每段文字截斷到模型上限後的 token 數（含 [CLS]/[SEP]）"""
+        encoded = self.model.tokenizer(
+            list(texts), truncation=True, max_length=self.model.max_seq_length
+        )
+        return np.fromiter(map(len, encoded["input_ids"]), dtype=np.int64, count=len(texts))
+
+    @staticmethod
+    def _token_batches(
+        lengths: np.ndarray, token_budget: int, bucket_ratio: float = 1.25
+    ) -> List[np.ndarray]:
+        """依長度由短到長分批，回傳每批在 ``lengths`` 中的位置
+
+        同一批的最長與最短長度相差不超過 ``bucket_ratio`` 倍，補齊後的 token 數
+        （筆數 × 最長長度）不超過 ``token_budget``；每批至少一筆。
+        """
+        order = np.argsort(lengths, kind="stable")
+        batches: List[np.ndarray] = []
+        start = 0
+        for end, position in enumerate(order.tolist(), start=1):
+            # 由短到長排序，新加入的一筆就是這批最長的
+            longest = lengths[position]
+            if end - start > 1 and (
+                (end - start) * longest > token_budget
+                or longest > bucket_ratio * lengths[order[start]]
+            ):
+                batches.append(order[start : end - 1])
+                start = end - 1
+        if start < len(order):
+            batches.append(order[start:])
+        return batches
+
+    def _encode(self, texts: Sequence[str], batch_size: int = 32) -> np.ndarray:
         embeddings = self.model.encode(
             list(texts),
             batch_size=batch_size,
@@ -113,34 +963,1964 @@ class EmbeddingModel:
         return embeddings.astype(np.float32)
 
 
-class VectorStore:
-    """FAISS 向量資料庫的封裝，使用 Inner Product 做相似度"""
+# 嵌入行程各自持有的模型，由 _init_embedding_worker 在行程啟動時載入
+_WORKER_EMBEDDER: EmbeddingModel | None = None
+
+
+def _init_embedding_worker(
+    model_name: str, backend: str, threads: int, onnx_dir: str, token_budget: int | None
+) -> None:
+    """ProcessPoolExecutor 的 initializer：載入模型並固定執行緒數"""
+    global _WORKER_EMBEDDER
+    # tokenizer 自己的執行緒池也關掉，每個行程只用分配到的執行緒
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _WORKER_EMBEDDER = EmbeddingModel(
+        model_name,
+        query_cache_size=0,
+        backend=backend,
+        threads=threads,
+        onnx_dir=onnx_dir,
+        token_budget=token_budget,
+    )
+
+
+def _embed_in_worker(texts: List[str], batch_size: int) -> Tuple[np.ndarray, EmbeddingStats]:
+    """在嵌入行程中計算一段語料，連同這次的統計一起回傳"""
+    _WORKER_EMBEDDER.corpus_stats = EmbeddingStats()
+    vectors = _WORKER_EMBEDDER.encode_corpus(texts, batch_size)
+    return vectors, _WORKER_EMBEDDER.corpus_stats
+
+
+class Reranker:
+    """Cross-encoder 重排序：對 (問題, 段落) 逐對評分，比向量相似度更準但也更慢
+
+    - 所有問題的候選段落合併後分批 ``predict``，各問題名次較前的候選先評
+    - 評過分的 (問題, 段落內容) 會記在 LRU 快取，重複問題不必再算
+    - ``budget_ms`` 為每個問題最多能多花的時間：每批開始前依實測的每對耗時決定這批評幾對，
+      超過期限就停止；沒評到的候選保留原本的檢索（融合）順序，排在重排序結果之後
+    """
+
+    def __init__(
+        self,
+        model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+        *,
+        budget_ms: float | None = 200.0,
+        batch_size: int = 32,
+        cache_size: int = 4096,
+    ):
+        print(f"載入重排序模型: {model_name} (CPU mode)")
+        self.model_name = model_name
+        self.model = CrossEncoder(model_name, device="cpu")
+        self.budget_ms = budget_ms
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self._scores: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 以截斷長度 (max_length) 的假段落暖機並量測每對的耗時，寧可高估；之後每批再以指數平均更新
+        max_length = getattr(self.model, "max_length", None) or 512
+        pair = ("warm up", " ".join(["warm"] * max_length))
+        self.model.predict([pair], show_progress_bar=False)
+        started = time.perf_counter()
+        self.model.predict([pair] * batch_size, batch_size=batch_size, show_progress_bar=False)
+        self._pair_ms = 1000 * (time.perf_counter() - started) / batch_size
+
+    @staticmethod
+    def _key(question: str, doc: Document) -> Tuple[str, str]:
+        digest = hashlib.blake2b(doc.content.encode("utf-8"), digest_size=12).hexdigest()
+        return QueryEmbeddingCache.normalize(question), digest
+
+    def rerank_many(
+        self,
+        questions: Sequence[str],
+        candidates: Sequence[Sequence[Tuple[float, Document]]],
+        top_k: int,
+    ) -> List[List[Tuple[float, Document]]]:
+        """回傳每個問題重排序後的前 ``top_k`` 筆 (分數, 文件)"""
+        scores: List[Dict[int, float]] = [{} for _ in questions]
+        pending: Dict[Tuple[str, str], List[Tuple[int, int]]] = {}
+        with self._lock:
+            for q, (question, results) in enumerate(zip(questions, candidates)):
+                for rank, (_score, doc) in enumerate(results):
+                    key = self._key(question, doc)
+                    cached = self._scores.get(key)
+                    if cached is not None:
+                        self._scores.move_to_end(key)
+                        scores[q][rank] = cached
+                        self.hits += 1
+                    else:
+                        pending.setdefault(key, []).append((q, rank))
+
+        # 依 (名次, 問題) 排序：時間用完時，每個問題都已評過名次最前的候選
+        ordered_pairs = sorted(pending.items(), key=lambda item: item[1][0][::-1])
+        deadline = None
+        if self.budget_ms is not None:
+            deadline = time.perf_counter() + self.budget_ms * len(questions) / 1000
+        done = 0
+        while done < len(ordered_pairs):
+            size = self.batch_size
+            if deadline is not None:
+                remaining_ms = 1000 * (deadline - time.perf_counter())
+                if remaining_ms <= 0 and done:
+                    break
+                # 至少評一對，避免預算過小時完全沒有重排序
+                size = min(size, max(1, int(remaining_ms / max(self._pair_ms, 1e-3))))
+            batch = ordered_pairs[done : done + size]
+            pairs = []
+            for _key, positions in batch:
+                q, rank = positions[0]
+                pairs.append((questions[q], candidates[q][rank][1].content))
+            started = time.perf_counter()
+            predicted = self.model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+            pair_ms = 1000 * (time.perf_counter() - started) / len(pairs)
+            with self._lock:
+                self._pair_ms = 0.8 * self._pair_ms + 0.2 * pair_ms
+                for (key, positions), score in zip(batch, predicted):
+                    for q, rank in positions:
+                        scores[q][rank] = float(score)
+                    self._scores[key] = float(score)
+                    self._scores.move_to_end(key)
+            done += len(batch)
+
+        with self._lock:
+            self.misses += done
+            self.skipped += len(ordered_pairs) - done
+            while len(self._scores) > self.cache_size:
+                self._scores.popitem(last=False)
+
+        reranked: List[List[Tuple[float, Document]]] = []
+        for results, scored in zip(candidates, scores):
+            order = sorted(scored, key=scored.get, reverse=True)
+            order += [rank for rank in range(len(results)) if rank not in scored]
+            reranked.append(
+                [
+                    (scored.get(rank, results[rank][0]), results[rank][1])
+                    for rank in order[:top_k]
+                ]
+            )
+        return reranked
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._scores),
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped": self.skipped,
+            "pair_ms": self._pair_ms,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class EmbeddingCache:
+    """以 (模型名稱, 文字雜湊) 為鍵的磁碟向量快取
+
+    每個模型各自一個子目錄：
+    - ``vectors.f32``：連續存放的 float32 向量，讀取時以 memmap 開啟，不需整份載入
+    - ``keys.txt``：每行一個文字的 SHA-1，與 ``vectors.f32`` 的列一一對應
+    - ``meta.json``：模型名稱與向量維度
+
+    新向量只會附加在檔尾，因此已算過的區塊永遠不必重新嵌入。
+    """
+
+    def __init__(self, cache_dir: Path | str, model_name: str, dimension: int):
+        model_digest = hashlib.sha1(model_name.encode("utf-8")).hexdigest()[:16]
+        self.root = Path(cache_dir) / model_digest
+        self.model_name = model_name
+        self.dimension = dimension
+        self.hits = 0
+        self.misses = 0
+
+        self._vectors_path = self.root / "vectors.f32"
+        self._keys_path = self.root / "keys.txt"
+        self._meta_path = self.root / "meta.json"
+        self._rows: Dict[str, int] = {}
+        self._vectors = np.empty((0, dimension), dtype=np.float32)
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._open()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    @staticmethod
+    def text_key(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _open(self) -> None:
+        meta = {"model_name": self.model_name, "dimension": self.dimension}
+        if self._meta_path.exists():
+            stored = json.loads(self._meta_path.read_text(encoding="utf-8"))
+            if stored.get("dimension") != self.dimension:
+                # 維度不同代表模型已更換，舊快取不可再用
+                self._vectors_path.unlink(missing_ok=True)
+                self._keys_path.unlink(missing_ok=True)
+        self._meta_path.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+
+        keys: List[str] = []
+        if self._keys_path.exists():
+            keys = self._keys_path.read_text(encoding="utf-8").split()
+        row_bytes = 4 * self.dimension
+        stored_bytes = self._vectors_path.stat().st_size if self._vectors_path.exists() else 0
+
+        count = min(len(keys), stored_bytes // row_bytes)
+        if count != len(keys) or count * row_bytes != stored_bytes:
+            # 上次寫入中斷時，兩個檔案可能不一致：截斷到共同長度
+            keys = keys[:count]
+            self._keys_path.write_text("".join(f"{key}\n" for key in keys), encoding="utf-8")
+            with self._vectors_path.open("ab") as file:
+                file.truncate(count * row_bytes)
+
+        self._rows = {key: row for row, key in enumerate(keys)}
+        self._map_vectors(count)
+
+    def _map_vectors(self, count: int) -> None:
+        if count == 0:
+            self._vectors = np.empty((0, self.dimension), dtype=np.float32)
+            return
+        self._vectors = np.memmap(
+            self._vectors_path, dtype=np.float32, mode="r", shape=(count, self.dimension)
+        )
 
-    def __init__(self, dimension: int):
+    def _append(self, keys: Sequence[str], vectors: np.ndarray) -> None:
+        # 先寫向量再寫鍵值：中斷時最多留下多餘的向量，下次開啟會被截斷
+        with self._vectors_path.open("ab") as file:
+            file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with self._keys_path.open("a", encoding="utf-8") as file:
+            file.write("".join(f"{key}\n" for key in keys))
+        start = len(self._rows)
+        for offset, key in enumerate(keys):
+            self._rows[key] = start + offset
+        self._map_vectors(len(self._rows))
+
+    def get_or_encode(
+        self, texts: Sequence[str], encode_fn: Callable[[Sequence[str]], np.ndarray]
+    ) -> np.ndarray:
+        """回傳 ``texts`` 的向量；只有快取中沒有的文字才會交給 ``encode_fn``"""
+        output = np.empty((len(texts), self.dimension), dtype=np.float32)
+        hit_positions: List[int] = []
+        hit_rows: List[int] = []
+        missing: Dict[str, List[int]] = {}
+        for position, text in enumerate(texts):
+            key = self.text_key(text)
+            row = self._rows.get(key)
+            if row is None:
+                missing.setdefault(key, []).append(position)
+            else:
+                hit_positions.append(position)
+                hit_rows.append(row)
+
+        if hit_rows:
+            output[hit_positions] = self._vectors[np.asarray(hit_rows)]
+        self.hits += len(hit_positions)
+
+        if missing:
+            missing_keys = list(missing)
+            new_vectors = encode_fn([texts[missing[key][0]] for key in missing_keys])
+            for key, vector in zip(missing_keys, new_vectors):
+                output[missing[key]] = vector
+            self._append(missing_keys, new_vectors)
+            self.misses += len(missing_keys)
+        return output
+
+
+class SemanticAnswerCache:
+    """以「問題向量相似度 + 檢索到的區塊」查找過去答案的快取
+
+    命中條件有兩個：與某個舊問題的餘弦相似度 >= ``threshold``，而且這次
+    檢索到的區塊與當時完全相同。兩者都成立時，直接回傳當時的答案，
+    省下整個 LLM 生成。容量滿了會淘汰最久沒用到的答案；``corpus_version``
+    改變（重新建立索引）時整個快取失效。
+
+    給定 ``path`` 時會寫入磁碟：每累積 ``flush_every`` 筆新答案才整份寫一次，
+    程式結束時再寫入剩下的；每個檔案都先寫暫存檔再改名，不會留下寫到一半的快取。
+    """
+
+    def __init__(
+        self,
+        dimension: int,
+        *,
+        threshold: float = 0.95,
+        max_entries: int = 1000,
+        path: str | Path | None = None,
+        flush_every: int = 16,
+    ):
         self.dimension = dimension
-        self.index = faiss.IndexFlatIP(dimension)
-        self.documents: List[Document] = []
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.path = Path(path) if path is not None else None
+        self.flush_every = flush_every
+        self.corpus_version: str | None = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._vectors = np.zeros((max_entries, dimension), dtype=np.float32)
+        self._entries: List[Dict[str, Any] | None] = [None] * max_entries
+        self._tick = 0
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        # 寫檔另用一把鎖：依序寫入，且寫檔時不擋住 lookup / store
+        self._save_lock = threading.Lock()
+        if self.path is not None:
+            if (self.path / "answers.json").exists():
+                self._load()
+            atexit.register(self.flush)
+
+    def __len__(self) -> int:
+        return sum(entry is not None for entry in self._entries)
+
+    def invalidate(self, corpus_version: str) -> None:
+        """語料版本不同時清空快取（索引重建後舊答案可能引用到舊內容）"""
+        with self._lock:
+            if corpus_version == self.corpus_version:
+                return
+            if len(self):
+                print("語料已更新，清除答案快取。")
+            self._entries = [None] * self.max_entries
+            self.corpus_version = corpus_version
+        self.save()
+
+    def lookup(self, query_vector: np.ndarray, context_keys: Sequence[str]) -> Dict[str, Any] | None:
+        with self._lock:
+            slots = np.array([slot for slot, entry in enumerate(self._entries) if entry], dtype=np.int64)
+            if slots.size:
+                similarities = self._vectors[slots] @ query_vector.reshape(-1)
+                passing = similarities >= self.threshold
+                for slot in slots[passing][np.argsort(-similarities[passing])]:
+                    entry = self._entries[slot]
+                    if entry["context_keys"] == list(context_keys):
+                        self._tick += 1
+                        entry["last_used"] = self._tick
+                        self.hits += 1
+                        return entry
+            self.misses += 1
+            return None
+
+    def store(
+        self, question: str, query_vector: np.ndarray, answer: str, context_keys: Sequence[str]
+    ) -> None:
+        with self._lock:
+            free = [slot for slot, entry in enumerate(self._entries) if entry is None]
+            if free:
+                slot = free[0]
+            else:
+                slot = min(range(self.max_entries), key=lambda s: self._entries[s]["last_used"])
+                self.evictions += 1
+            self._tick += 1
+            self._vectors[slot] = query_vector.reshape(-1)
+            self._entries[slot] = {
+                "question": question,
+                "answer": answer,
+                "context_keys": list(context_keys),
+                "last_used": self._tick,
+            }
+            self._unsaved += 1
+            due = self._unsaved >= self.flush_every
+        if due:
+            self.save()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def flush(self) -> None:
+        """有尚未寫入磁碟的答案時才寫入"""
+        if self._unsaved:
+            self.save()
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                slots = [slot for slot, entry in enumerate(self._entries) if entry is not None]
+                payload = {
+                    "corpus_version": self.corpus_version,
+                    "entries": [dict(self._entries[slot]) for slot in slots],
+                }
+                vectors = self._vectors[slots]
+                self._unsaved = 0
+            self.path.mkdir(parents=True, exist_ok=True)
+            _save_array(self.path / "vectors.npy", vectors)
+            _save_text(self.path / "answers.json", json.dumps(payload, ensure_ascii=False))
+
+    def _load(self) -> None:
+        payload = json.loads((self.path / "answers.json").read_text(encoding="utf-8"))
+        vectors = np.load(self.path / "vectors.npy")
+        # 兩個檔案之間中斷時列數會對不上，當作沒有快取
+        if vectors.ndim != 2 or vectors.shape != (len(payload["entries"]), self.dimension):
+            return
+        self.corpus_version = payload["corpus_version"]
+        # 容量變小時只保留最近用過的答案
+        order = sorted(
+            range(len(payload["entries"])), key=lambda row: -payload["entries"][row]["last_used"]
+        )[: self.max_entries]
+        for slot, row in enumerate(order):
+            self._entries[slot] = payload["entries"][row]
+            self._vectors[slot] = vectors[row]
+        self._tick = max((entry["last_used"] for entry in payload["entries"]), default=0)
+
+
+_MISSING_INT = np.iinfo(np.int64).min
+
+
+def _replace_file(path: Path, write: Callable[[Any], None]) -> None:
+    """先寫到暫存檔再改名：其他行程以 mmap 開啟中的舊檔不會被截斷"""
+    partial = path.with_name(path.name + ".tmp")
+    with open(partial, "wb") as handle:
+        write(handle)
+    os.replace(partial, path)
+
+
+def _save_array(path: Path, array: np.ndarray) -> None:
+    _replace_file(path, lambda handle: np.save(handle, array))
+
+
+def _save_text(path: Path, text: str) -> None:
+    _replace_file(path, lambda handle: handle.write(text.encode("utf-8")))
+
+
+class _Column:
+    """可附加的一維 numpy 陣列：容量不足時倍增，攤提後每筆新增為 O(1)
+
+    從磁碟以 mmap 載入的唯讀陣列，第一次新增時才複製到記憶體。
+    """
+
+    def __init__(self, data: np.ndarray):
+        self._data = data
+        self._size = len(data)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._data[: self._size]
+
+    def extend(self, values: Sequence[Any] | np.ndarray) -> None:
+        values = np.asarray(values, dtype=self._data.dtype)
+        needed = self._size + len(values)
+        if needed > len(self._data) or not self._data.flags.writeable:
+            grown = np.empty(max(needed, 2 * len(self._data), 1024), dtype=self._data.dtype)
+            grown[: self._size] = self._data[: self._size]
+            self._data = grown
+        self._data[self._size : needed] = values
+        self._size = needed
+
+
+class DocumentStore:
+    """欄式文件庫：取代每個區塊一個 ``Document`` 物件加一個 metadata dict
+
+    - 所有內文接成一段 UTF-8 位元組，``offsets[i]:offsets[i+1]`` 是第 i 列
+    - 整數 metadata（chunk_id、start_word…）各存一個 int64 陣列
+    - 其他 metadata（source…）存成「唯一值表 + int32 代碼」
+    - 文件 ID 另存一份排序過的陣列，以二分搜尋找到所在列
+
+    用法與 ``Dict[int, Document]`` 相同（``len``、``in``、``[]``、``items()``），
+    但 ``Document`` 只在被取用時才由欄位組出來。刪除只標記該列，存檔時才真正移除。
+    ``load(mmap=True)`` 直接映射磁碟檔案，多個行程可共用同一份文字與欄位。
+    """
+
+    def __init__(self) -> None:
+        self._blob = _Column(np.empty(0, dtype=np.uint8))
+        self._offsets = _Column(np.zeros(1, dtype=np.int64))
+        self._ids = _Column(np.empty(0, dtype=np.int64))
+        self._alive = _Column(np.empty(0, dtype=bool))
+        self._columns: Dict[str, _Column] = {}
+        # 類別欄位：欄位名稱 -> (JSON 編碼後的唯一值表, 值 -> 代碼)
+        self._categories: Dict[str, Tuple[List[str], Dict[str, int]]] = {}
+        self._sorted_ids = np.empty(0, dtype=np.int64)
+        self._sorted_rows = np.empty(0, dtype=np.int64)
+        self._count = 0
+
+    # ------------------------------------------------------------------
+    # Mapping 介面
+    # ------------------------------------------------------------------
+    def __len__(self) -> int:
+        return self._count
+
+    def __bool__(self) -> bool:
+        return self._count > 0
+
+    def __contains__(self, doc_id: object) -> bool:
+        try:
+            return self._row(int(doc_id)) >= 0
+        except (TypeError, ValueError):
+            return False
+
+    def __getitem__(self, doc_id: int) -> Document:
+        row = self._row(int(doc_id))
+        if row < 0:
+            raise KeyError(doc_id)
+        return self._view(row)
+
+    def get(self, doc_id: int, default: Document | None = None) -> Document | None:
+        row = self._row(int(doc_id))
+        return default if row < 0 else self._view(row)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids().tolist())
+
+    def keys(self) -> Iterator[int]:
+        return iter(self)
+
+    def values(self) -> Iterator[Document]:
+        for row in np.flatnonzero(self._alive.values):
+            yield self._view(int(row))
+
+    def items(self) -> Iterator[Tuple[int, Document]]:
+        ids = self._ids.values
+        for row in np.flatnonzero(self._alive.values):
+            yield int(ids[row]), self._view(int(row))
+
+    def ids(self) -> np.ndarray:
+        """所有現存文件的 ID（依加入順序）"""
+        return self._ids.values[self._alive.values]
+
+    # ------------------------------------------------------------------
+    # 新增與刪除
+    # ------------------------------------------------------------------
+    def add(self, ids: np.ndarray, documents: Sequence[Document]) -> None:
+        """加入新文件；``ids`` 不可與既有文件重複（取代請先 ``remove``）"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if ids.size == 0:
+            return
+        if self.contains_many(ids).any():
+            raise ValueError("文件 ID 已存在，請先刪除再加入")
+
+        first_row = len(self._ids)
+        encoded = [doc.content.encode("utf-8") for doc in documents]
+        lengths = np.fromiter((len(blob) for blob in encoded), dtype=np.int64, count=len(encoded))
+        self._offsets.extend(self._offsets.values[-1] + np.cumsum(lengths))
+        self._blob.extend(np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        self._ids.extend(ids)
+        self._alive.extend(np.ones(len(ids), dtype=bool))
+
+        keys: List[str] = []
+        for doc in documents:
+            keys.extend(key for key in doc.metadata if key not in keys)
+        for key in keys:
+            self._append_column(key, [doc.metadata.get(key) for doc in documents], first_row)
+        for key in self._columns.keys() - set(keys):
+            self._append_column(key, [None] * len(documents), first_row)
+
+        # 把新 ID 併入排序陣列：O(n) 的搬移，不必每批都重新排序
+        order = np.argsort(ids, kind="stable")
+        positions = np.searchsorted(self._sorted_ids, ids[order])
+        self._sorted_ids = np.insert(self._sorted_ids, positions, ids[order])
+        self._sorted_rows = np.insert(self._sorted_rows, positions, first_row + order)
+        self._count += len(ids)
+
+    def remove(self, ids: Sequence[int] | np.ndarray) -> np.ndarray:
+        """刪除文件，回傳實際存在而被刪除的 ID"""
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        positions = self._positions(ids)
+        found = positions >= 0
+        self._alive.values[self._sorted_rows[positions[found]]] = False
+        self._sorted_ids = np.delete(self._sorted_ids, positions[found])
+        self._sorted_rows = np.delete(self._sorted_rows, positions[found])
+        self._count -= int(found.sum())
+        return ids[found]
+
+    def contains_many(self, ids: np.ndarray) -> np.ndarray:
+        return self._positions(np.asarray(ids, dtype=np.int64)) >= 0
+
+    # ------------------------------------------------------------------
+    # 查詢
+    # ------------------------------------------------------------------
+    def select(self, where: "MetadataFilter") -> np.ndarray:
+        """以欄位向量化計算符合條件的文件 ID（已排序）"""
+        mask = self._alive.values.copy()
+        if where.sources is not None:
+            mask &= self._value_mask("source", where.sources)
+        for key, low, high in where.ranges:
+            mask &= self._range_mask(key, low, high)
+        return np.sort(self._ids.values[mask])
+
+    def fingerprint(self) -> str:
+        """由所有 (ID, 內容) 計算的版本字串，任何區塊變動都會讓它改變"""
+        digest = hashlib.blake2b(digest_size=16)
+        blob, offsets = self._blob.values, self._offsets.values
+        for doc_id, row in zip(self._sorted_ids.tolist(), self._sorted_rows.tolist()):
+            digest.update(doc_id.to_bytes(8, "little", signed=True))
+            digest.update(hashlib.blake2b(blob[offsets[row] : offsets[row + 1]].tobytes()).digest())
+        return digest.hexdigest()
+
+    def _positions(self, ids: np.ndarray) -> np.ndarray:
+        """每個 ID 在排序陣列中的位置，不存在時為 -1"""
+        positions = np.searchsorted(self._sorted_ids, ids)
+        clipped = np.minimum(positions, max(len(self._sorted_ids) - 1, 0))
+        found = (positions < len(self._sorted_ids)) & (
+            self._sorted_ids[clipped] == ids if len(self._sorted_ids) else False
+        )
+        return np.where(found, positions, -1)
+
+    def _row(self, doc_id: int) -> int:
+        position = self._positions(np.array([doc_id], dtype=np.int64))[0]
+        return -1 if position < 0 else int(self._sorted_rows[position])
+
+    def _view(self, row: int) -> Document:
+        offsets = self._offsets.values
+        content = self._blob.values[offsets[row] : offsets[row + 1]].tobytes().decode("utf-8")
+        metadata: Dict[str, Any] = {}
+        for key, column in self._columns.items():
+            value = column.values[row]
+            if key in self._categories:
+                if value >= 0:
+                    metadata[key] = json.loads(self._categories[key][0][value])
+            elif value != _MISSING_INT:
+                metadata[key] = int(value)
+        return Document(content=content, metadata=metadata)
+
+    def _value_mask(self, key: str, allowed: Iterable[Any]) -> np.ndarray:
+        column = self._columns.get(key)
+        if column is None:
+            return np.zeros(len(self._ids), dtype=bool)
+        if key in self._categories:
+            lookup = self._categories[key][1]
+            codes = [lookup[k] for k in (json.dumps(v, ensure_ascii=False) for v in allowed) if k in lookup]
+            return np.isin(column.values, codes)
+        return np.isin(column.values, [v for v in allowed if isinstance(v, int)])
+
+    def _range_mask(self, key: str, low: float | None, high: float | None) -> np.ndarray:
+        column = self._columns.get(key)
+        if column is None:
+            return np.zeros(len(self._ids), dtype=bool)
+
+        def in_range(values: np.ndarray) -> np.ndarray:
+            mask = np.ones(len(values), dtype=bool)
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values <= high
+            return mask
+
+        if key not in self._categories:
+            values = column.values
+            return (values != _MISSING_INT) & in_range(values)
+        # 類別欄位只對數值型的唯一值判斷，再換算回代碼
+        table = [json.loads(value) for value in self._categories[key][0]]
+        numeric = [
+            (code, value)
+            for code, value in enumerate(table)
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        ]
+        codes = [code for code, value in numeric if in_range(np.array([value]))[0]]
+        return np.isin(column.values, codes)
+
+    def _append_column(self, key: str, values: List[Any], first_row: int) -> None:
+        is_int = all(
+            value is None or (isinstance(value, int) and not isinstance(value, bool)) for value in values
+        )
+        if key not in self._columns:
+            if is_int:
+                self._columns[key] = _Column(np.full(first_row, _MISSING_INT, dtype=np.int64))
+            else:
+                self._columns[key] = _Column(np.full(first_row, -1, dtype=np.int32))
+                self._categories[key] = ([], {})
+        elif key not in self._categories and not is_int:
+            self._to_category(key)
+
+        column = self._columns[key]
+        if key not in self._categories:
+            column.extend([_MISSING_INT if value is None else value for value in values])
+            return
+        table, lookup = self._categories[key]
+        codes = np.full(len(values), -1, dtype=np.int32)
+        # 同一批通常來自同一份 PDF，相同字串只需編碼一次
+        batch_codes: Dict[str, int] = {}
+        for row, value in enumerate(values):
+            if value is None:
+                continue
+            if isinstance(value, str) and value in batch_codes:
+                codes[row] = batch_codes[value]
+                continue
+            encoded = json.dumps(value, ensure_ascii=False)
+            if encoded not in lookup:
+                lookup[encoded] = len(table)
+                table.append(encoded)
+            codes[row] = lookup[encoded]
+            if isinstance(value, str):
+                batch_codes[value] = codes[row]
+        column.extend(codes)
+
+    def _to_category(self, key: str) -> None:
+        """整數欄位出現非整數值時，改成類別欄位"""
+        values = self._columns[key].values
+        table: List[str] = []
+        lookup: Dict[str, int] = {}
+        codes = np.full(len(values), -1, dtype=np.int32)
+        for value in np.unique(values[values != _MISSING_INT]).tolist():
+            lookup[json.dumps(value)] = len(table)
+            table.append(json.dumps(value))
+            codes[values == value] = lookup[json.dumps(value)]
+        self._columns[key] = _Column(codes)
+        self._categories[key] = (table, lookup)
+
+    # ------------------------------------------------------------------
+    # 存檔與載入
+    # ------------------------------------------------------------------
+    def save(self, directory: Path) -> None:
+        """寫入 texts.bin / offsets.npy / ids.npy / meta_N.npy / documents.json，只保留現存的列"""
+        alive = self._alive.values
+        rows = np.flatnonzero(alive)
+        offsets = self._offsets.values
+        blob = self._blob.values
+        if len(rows) < len(alive):
+            # 以差分陣列標出要保留的位元組範圍，不必逐列切片
+            delta = np.zeros(len(blob) + 1, dtype=np.int64)
+            np.add.at(delta, offsets[rows], 1)
+            np.add.at(delta, offsets[rows + 1], -1)
+            blob = blob[np.cumsum(delta[:-1]) > 0]
+            lengths = offsets[rows + 1] - offsets[rows]
+            offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+
+        _replace_file(directory / "texts.bin", blob.tofile)
+        _save_array(directory / "offsets.npy", offsets)
+        _save_array(directory / "ids.npy", self._ids.values[rows])
+
+        columns: Dict[str, Dict[str, Any]] = {}
+        for number, (key, column) in enumerate(self._columns.items()):
+            filename = f"meta_{number}.npy"
+            _save_array(directory / filename, column.values[rows])
+            if key in self._categories:
+                columns[key] = {"kind": "category", "file": filename, "values": self._categories[key][0]}
+            else:
+                columns[key] = {"kind": "int", "file": filename}
+
+        schema = {"count": len(rows), "columns": columns}
+        _save_text(directory / "documents.json", json.dumps(schema, ensure_ascii=False, indent=2))
+
+    @classmethod
+    def load(cls, directory: Path, *, mmap: bool = False) -> "DocumentStore":
+        schema = json.loads((directory / "documents.json").read_text(encoding="utf-8"))
+        mmap_mode = "r" if mmap else None
+        store = cls()
+        blob_path = directory / "texts.bin"
+        if mmap and blob_path.stat().st_size > 0:
+            store._blob = _Column(np.memmap(blob_path, dtype=np.uint8, mode="r"))
+        else:
+            store._blob = _Column(np.fromfile(blob_path, dtype=np.uint8))
+        store._offsets = _Column(np.load(directory / "offsets.npy", mmap_mode=mmap_mode))
+        ids = np.load(directory / "ids.npy")
+        store._ids = _Column(ids)
+        store._alive = _Column(np.ones(len(ids), dtype=bool))
+        for key, spec in schema["columns"].items():
+            store._columns[key] = _Column(np.load(directory / spec["file"], mmap_mode=mmap_mode))
+            if spec["kind"] == "category":
+                table = list(spec["values"])
+                store._categories[key] = (table, {value: code for code, value in enumerate(table)})
+        store._sorted_rows = np.argsort(ids, kind="stable")
+        store._sorted_ids = ids[store._sorted_rows]
+        store._count = len(ids)
+        if schema["count"] != len(ids) or len(store._offsets) != len(ids) + 1:
+            raise ValueError(f"文件數 ({schema['count']}) 與 ID 數 ({len(ids)}) 不一致")
+        return store
+
+
+INDEX_TYPES = ("flat", "ivf", "ivfpq", "hnsw")
+# 向量在索引中的儲存格式：float16 / int8 由 faiss 的 ScalarQuantizer 壓縮
+VECTOR_STORAGES = ("float32", "float16", "int8")
+_SQ_CODECS = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8"}
+RETRIEVAL_MODES = ("dense", "hybrid")
+
+
+@dataclass(frozen=True)
+class MetadataFilter:
+    """檢索時的 metadata 條件，所有條件都要符合
+
+    ``sources`` 限定來源檔名；``ranges`` 為 (欄位, 下限, 上限) 的閉區間，
+    ``None`` 代表不設限。實際比對由 ``DocumentStore.select`` 以欄位陣列一次完成。
+    建議用 ``MetadataFilter.where`` 建立::
+
+        MetadataFilter.where(source="2305.14325v1.pdf", chunk_id=(0, 10))
+    """
+
+    sources: FrozenSet[str] | None = None
+    ranges: Tuple[Tuple[str, float | None, float | None], ...] = ()
+
+    @classmethod
+    def where(
+        cls,
+        *,
+        source: str | Iterable[str] | None = None,
+        **ranges: Tuple[float | None, float | None],
+    ) -> "MetadataFilter":
+        if isinstance(source, str):
+            source = [source]
+        return cls(
+            sources=frozenset(source) if source is not None else None,
+            ranges=tuple((key, low, high) for key, (low, high) in sorted(ranges.items())),
+        )
+
 
-    def add(self, embeddings: np.ndarray, documents: Iterable[Document]) -> None:
+def choose_index_type(num_vectors: int) -> str:
+    """依語料大小挑選索引：小語料暴力搜尋最準也夠快，大語料才改用近似索引"""
+    if num_vectors < 20_000:
+        return "flat"
+    if num_vectors < 1_000_000:
+        return "hnsw"
+    return "ivfpq"
+
+
+def recall_at_k(truth: np.ndarray, found: np.ndarray) -> float:
+    """平均每個查詢的 top-k 中，有多少比例與精確結果相同"""
+    k = truth.shape[1]
+    hits = sum(len(set(t.tolist()) & set(f.tolist()) - {-1}) for t, f in zip(truth, found))
+    return hits / (k * len(truth)) if len(truth) else 1.0
+
+
+@dataclass
+class IndexReport:
+    """近似索引與暴力搜尋的比較結果（時間為每個查詢的平均毫秒）"""
+
+    index_type: str
+    factory: str
+    vectors: int
+    k: int
+    recall: float
+    flat_ms: float
+    ann_ms: float
+    # 索引中向量的維度（有 PCA 降維時小於嵌入維度）
+    dimension: int
+
+
+class VectorStore:
+    """FAISS 向量資料庫的封裝，使用 Inner Product 做相似度
+
+    索引外層包一層 ``IndexIDMap2``：每個向量都有一個 int64 ID，
+    可以依 ID 刪除或取代某個檔案的區塊，而不必重建整個索引。
+
+    預設是暴力搜尋的 ``IndexFlatIP``；語料變大後可呼叫 ``build_ann``
+    換成 IVF-Flat、IVF-PQ 或 HNSW 近似索引，以 ``nprobe`` / ``ef_search``
+    在召回率與延遲之間取捨。IVF 索引本身就能存 ID，因此不再包
+    ``IndexIDMap2``（刪除後 IDMap 的對照表會與 IVF 錯位）。
+
+    ``storage`` 為 ``float16`` / ``int8`` 時，flat、IVF 與 HNSW 的向量改以
+    ``ScalarQuantizer`` 壓縮（每個維度各自的範圍），記憶體分別只需 1/2 與 1/4。
+    ``rescore > 0`` 時另存一份 float32 原始向量，搜尋先從壓縮索引取
+    ``top_k * rescore`` 筆候選，再以原始向量重新計分；以 ``load(mmap=True)``
+    開啟時這份向量留在磁碟上，只有被選為候選的列會讀進記憶體。
+    int8 要先看過足夠的向量才能估計各維度的範圍：訓練前加入的向量先暫存，
+    累積到 ``sq_train_size`` 筆、或第一次搜尋 / 刪除 / 存檔時，才以全部暫存的向量訓練並寫入索引。
+
+    ``build_ann(dimension=128)`` 以語料學出 PCA 投影（``faiss.PCAMatrix``），
+    索引只存降維後的向量；之後新增的向量與查詢都經過同一個投影，
+    投影矩陣另存為 ``pca.faiss``。``dimension`` 一律指嵌入向量原本的維度。
+    """
+
+    # int8 的 ScalarQuantizer 最多以這麼多筆暫存向量估計各維度的範圍
+    sq_train_size = 20_000
+    # matching_ids 最多快取幾個篩選條件；條件可由 API 使用者任意指定，不能無限成長
+    filter_cache_size = 64
+
+    def __init__(
+        self,
+        dimension: int,
+        *,
+        nprobe: int = 16,
+        ef_search: int = 64,
+        storage: str = "float32",
+        rescore: int = 0,
+    ):
+        if storage not in VECTOR_STORAGES:
+            raise ValueError(f"未知的向量儲存格式 {storage}，可用：{', '.join(VECTOR_STORAGES)}")
+        self.dimension = dimension
+        self.storage = storage
+        self.rescore = rescore
+        self.index_type = "flat"
+        self.factory = _SQ_CODECS[storage]
+        self.index = self._with_ids(
+            faiss.index_factory(dimension, self.factory, faiss.METRIC_INNER_PRODUCT)
+        )
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.documents = DocumentStore()
+        # 重新計分用的 float32 原始向量
+        self._exact = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension)) if rescore > 0 else None
+        self.pca: faiss.PCAMatrix | None = None
+        self._next_id = 0
+        # 最近用過的篩選條件符合的 ID（LRU，最多 filter_cache_size 個），向量庫有增刪時清空
+        self._filter_ids: "OrderedDict[MetadataFilter, np.ndarray]" = OrderedDict()
+        self._filter_lock = threading.Lock()
+        # 索引尚未訓練時暫存的 (向量, ID)
+        self._pending: List[Tuple[np.ndarray, np.ndarray]] = []
+        # load(mmap=True) 的索引直接映射唯讀檔案，第一次增刪前要先複製到記憶體
+        self._mapped = False
+
+    def add(
+        self,
+        embeddings: np.ndarray,
+        documents: Iterable[Document],
+        ids: Sequence[int] | None = None,
+    ) -> None:
+        """加入向量；未指定 ``ids`` 時自動配發遞增的 ID"""
         if embeddings.ndim != 2 or embeddings.shape[1] != self.dimension:
             raise ValueError("嵌入維度與索引不一致")
         if embeddings.size == 0:
             return
-        self.index.add(embeddings)
-        self.documents.extend(list(documents))
+        documents = list(documents)
+        if len(documents) != embeddings.shape[0]:
+            raise ValueError("向量數量與文件數量不一致")
 
-    def search(self, query: np.ndarray, top_k: int = 3) -> List[Tuple[float, Document]]:
-        if not self.documents:
-            return []
+        if ids is None:
+            id_array = np.arange(self._next_id, self._next_id + len(documents), dtype=np.int64)
+        else:
+            id_array = np.asarray(ids, dtype=np.int64)
+            if len(id_array) != len(documents) or len(set(id_array.tolist())) != len(id_array):
+                raise ValueError("ids 必須與文件一一對應且不可重複")
+            # 相同 ID 視為取代，避免中斷後重跑時出現重複向量
+            self.remove(id_array)
+
+        self._detach_mapped()
+        vectors = self._project(embeddings)
+        if self._pending or not self._base_index().is_trained:
+            self._pending.append((vectors, id_array))
+            if sum(len(pending_ids) for _vectors, pending_ids in self._pending) >= self.sq_train_size:
+                self._train_pending()
+        else:
+            self.index.add_with_ids(vectors, id_array)
+        if self._exact is not None:
+            self._exact.add_with_ids(embeddings, id_array)
+        self.documents.add(id_array, documents)
+        self._filter_ids.clear()
+        self._next_id = max(self._next_id, int(id_array.max()) + 1)
+
+    def remove(self, ids: Sequence[int]) -> int:
+        """依 ID 刪除向量與文件，回傳實際刪除的筆數"""
+        id_array = np.unique(np.asarray(ids, dtype=np.int64))
+        id_array = id_array[self.documents.contains_many(id_array)]
+        if id_array.size == 0:
+            return 0
+        self._detach_mapped()
+        self._train_pending()
+        if self.index_type == "hnsw":
+            # HNSW 不支援刪除：取出其餘向量後以相同設定重建
+            self._rebuild_without(id_array)
+        elif self._is_ivf:
+            # 以 Hashtable 對照 ID 的 IVF 只接受 IDSelectorArray，不必重新訓練群中心
+            self.index.remove_ids(faiss.IDSelectorArray(id_array.size, faiss.swig_ptr(id_array)))
+        else:
+            self.index.remove_ids(faiss.IDSelectorBatch(id_array))
+        if self._exact is not None:
+            self._exact.remove_ids(faiss.IDSelectorBatch(id_array))
+        self.documents.remove(id_array)
+        self._filter_ids.clear()
+        return int(id_array.size)
+
+    def search(
+        self, query: np.ndarray, top_k: int = 3, where: MetadataFilter | None = None
+    ) -> List[Tuple[float, Document]]:
         if query.ndim == 1:
             query = query.reshape(1, -1)
-        distances, indices = self.index.search(query, min(top_k, len(self.documents)))
-        results: List[Tuple[float, Document]] = []
-        for score, idx in zip(distances[0], indices[0]):
-            if idx < 0 or idx >= len(self.documents):
+        return self.search_batch(query[:1], top_k, where)[0]
+
+    def search_batch(
+        self, queries: np.ndarray, top_k: int = 3, where: MetadataFilter | None = None
+    ) -> List[List[Tuple[float, Document]]]:
+        """一次搜尋多個查詢向量 (n_queries, dimension)，回傳每個查詢各自的結果
+
+        所有查詢只呼叫一次 ``index.search``，FAISS 會以矩陣乘法批次計算。
+        """
+        if queries.ndim == 1:
+            queries = queries.reshape(1, -1)
+        if not self.documents:
+            return [[] for _ in range(len(queries))]
+        distances, indices = self.search_ids(queries, top_k, where)
+        batch_results: List[List[Tuple[float, Document]]] = []
+        for row_scores, row_ids in zip(distances, indices):
+            results: List[Tuple[float, Document]] = []
+            for score, idx in zip(row_scores, row_ids):
+                document = self.documents.get(int(idx))
+                if document is None:
+                    continue
+                results.append((float(score), document))
+            batch_results.append(results)
+        return batch_results
+
+    def search_ids(
+        self, queries: np.ndarray, top_k: int = 3, where: MetadataFilter | None = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """回傳 FAISS 原始的 (分數, ID) 矩陣；找不到的位置 ID 為 -1
+
+        指定 ``where`` 時以 ``IDSelector`` 交給 FAISS 在搜尋中略過不符合的向量，
+        而不是先取 top-k 再過濾，因此只要符合的區塊夠多就一定拿得到 k 筆。
+        有 float32 原始向量時，先多取 ``rescore`` 倍的候選再重新計分。
+        """
+        self._train_pending()
+        top_k = max(1, min(top_k, len(self.documents)))
+        num_candidates = top_k
+        if self._exact is not None:
+            num_candidates = min(top_k * self.rescore, len(self.documents))
+        index_queries = self._project_queries(queries)
+        if where is None:
+            distances, ids = self.index.search(index_queries, num_candidates)
+            return self._finish_search(queries, distances, ids, top_k)
+
+        allowed = self.matching_ids(where)
+        if allowed.size == 0:
+            return (
+                np.full((len(queries), 1), -np.inf, dtype=np.float32),
+                np.full((len(queries), 1), -1, dtype=np.int64),
+            )
+        top_k = min(top_k, int(allowed.size))
+        num_candidates = min(num_candidates, int(allowed.size))
+        selector = faiss.IDSelectorBatch(allowed)
+        distances, ids = self.index.search(
+            index_queries, num_candidates, params=self._search_params(selector)
+        )
+        short = (ids < 0).any(axis=1)
+        if short.any():
+            # IVF 只掃 nprobe 群、HNSW 只走 efSearch 個候選，條件嚴格時可能湊不滿 k 筆，
+            # 這些查詢改用完整掃描再搜一次
+            retry = self._search_params(selector, exhaustive=True)
+            distances[short], ids[short] = self.index.search(
+                index_queries[short], num_candidates, params=retry
+            )
+        return self._finish_search(queries, distances, ids, top_k)
+
+    def _project_queries(self, queries: np.ndarray) -> np.ndarray:
+        """查詢只乘上投影矩陣 ``A``，不減去語料平均
+
+        索引存的是 ``A (x - mean)``，與 ``A q`` 的內積近似 ``x·q - mean·q``；
+        對同一個查詢而言只差一個常數，排序與原始空間相同。
+        """
+        if self.pca is None:
+            return queries
+        matrix = faiss.vector_to_array(self.pca.A).reshape(self.pca.d_out, self.dimension)
+        return np.ascontiguousarray(queries @ matrix.T, dtype=np.float32)
+
+    def _finish_search(
+        self, queries: np.ndarray, distances: np.ndarray, ids: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """有原始向量時重新計分；降維索引補回 ``mean·q``，讓分數仍是原始空間的內積"""
+        if self._exact is not None:
+            return self._rescore(queries, ids, top_k)
+        if self.pca is not None:
+            distances += (queries @ faiss.vector_to_array(self.pca.mean))[:, None]
+        return distances, ids
+
+    def _detach_mapped(self) -> None:
+        """把 mmap 開啟的唯讀索引複製到記憶體；直接在映射上增刪會讓 FAISS 寫入唯讀頁面而崩潰"""
+        if not self._mapped:
+            return
+        self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+        if self._exact is not None:
+            self._exact = faiss.deserialize_index(faiss.serialize_index(self._exact))
+        self.set_search_params()
+        self._mapped = False
+
+    def _train_pending(self) -> None:
+        """以所有暫存的向量訓練 ScalarQuantizer，再把它們寫入索引"""
+        if not self._pending:
+            return
+        vectors = np.concatenate([pending for pending, _ids in self._pending])
+        ids = np.concatenate([pending_ids for _vectors, pending_ids in self._pending])
+        self._pending = []
+        base = self._base_index()
+        if not base.is_trained:
+            base.train(vectors)
+        self.index.add_with_ids(vectors, ids)
+
+    def _project(self, vectors: np.ndarray) -> np.ndarray:
+        return vectors if self.pca is None else self.pca.apply(vectors)
+
+    def _rescore(
+        self, queries: np.ndarray, candidates: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """以 float32 原始向量重新計算候選的內積，每個查詢取前 ``top_k`` 筆"""
+        found = candidates >= 0
+        scores = np.full(candidates.shape, -np.inf, dtype=np.float32)
+        if found.any():
+            vectors = self._exact.reconstruct_batch(candidates[found])
+            rows = np.nonzero(found)[0]
+            scores[found] = np.einsum("ij,ij->i", vectors, queries[rows])
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :top_k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(candidates, order, axis=1)
+
+    def matching_ids(self, where: MetadataFilter) -> np.ndarray:
+        """符合條件的文件 ID（已排序）；最近用過的條件會快取到下次增刪為止"""
+        with self._filter_lock:
+            allowed = self._filter_ids.get(where)
+            if allowed is not None:
+                self._filter_ids.move_to_end(where)
+                return allowed
+        allowed = self.documents.select(where)
+        with self._filter_lock:
+            self._filter_ids[where] = allowed
+            while len(self._filter_ids) > self.filter_cache_size:
+                self._filter_ids.popitem(last=False)
+        return allowed
+
+    def _search_params(
+        self, selector: faiss.IDSelector, *, exhaustive: bool = False
+    ) -> faiss.SearchParameters:
+        if self._is_ivf:
+            nprobe = self._base_index().nlist if exhaustive else self.nprobe
+            return faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+        if self.index_type == "hnsw":
+            ef_search = max(self.ef_search, len(self.documents)) if exhaustive else self.ef_search
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+        return faiss.SearchParameters(sel=selector)
+
+    def fingerprint(self) -> str:
+        """由所有 (ID, 內容) 計算的版本字串，任何區塊變動都會讓它改變"""
+        return self.documents.fingerprint()
+
+    # ------------------------------------------------------------------
+    # 近似最近鄰 (ANN) 索引
+    # ------------------------------------------------------------------
+    @property
+    def _is_ivf(self) -> bool:
+        return self.index_type in ("ivf", "ivfpq")
+
+    def _base_index(self) -> faiss.Index:
+        if self._is_ivf:
+            return self.index
+        return faiss.downcast_index(self.index.index)
+
+    @staticmethod
+    def _with_ids(base: faiss.Index) -> faiss.Index:
+        """讓索引可以用自訂 ID 新增、刪除與取回向量"""
+        if isinstance(base, faiss.IndexIVF):
+            base.set_direct_map_type(faiss.DirectMap.Hashtable)
+            return base
+        return faiss.IndexIDMap2(base)
+
+    def set_search_params(self, *, nprobe: int | None = None, ef_search: int | None = None) -> None:
+        """調整查詢時的搜尋範圍：IVF 掃描的群數 / HNSW 的候選佇列長度"""
+        if nprobe is not None:
+            self.nprobe = nprobe
+        if ef_search is not None:
+            self.ef_search = ef_search
+        base = self._base_index()
+        if self._is_ivf:
+            base.nprobe = self.nprobe
+        elif self.index_type == "hnsw":
+            base.hnsw.efSearch = self.ef_search
+
+    @property
+    def index_dimension(self) -> int:
+        """索引中向量的維度；有 PCA 降維時小於 ``dimension``"""
+        return self.dimension if self.pca is None else self.pca.d_out
+
+    def _exact_vectors_and_ids(self) -> Tuple[np.ndarray, np.ndarray]:
+        """重新計分用的 float32 原始向量（嵌入原本的維度）與 ID"""
+        ids = faiss.vector_to_array(self._exact.id_map)
+        if len(ids) == 0:
+            return np.empty((0, self.dimension), dtype=np.float32), ids
+        return self._exact.index.reconstruct_n(0, len(ids)), ids
+
+    def _vectors_and_ids(self) -> Tuple[np.ndarray, np.ndarray]:
+        """取回索引中（降維後）的所有向量與 ID
+
+        有 float32 原始向量時由原始向量投影；否則 PQ / ScalarQuantizer 索引取回的是壓縮後的近似值。
+        """
+        self._train_pending()
+        if self._exact is not None:
+            vectors, ids = self._exact_vectors_and_ids()
+            return self._project(vectors), ids
+        if not self._is_ivf:
+            ids = faiss.vector_to_array(self.index.id_map)
+            base = self._base_index()
+            if base.ntotal == 0:
+                return np.empty((0, self.index_dimension), dtype=np.float32), ids
+            return base.reconstruct_n(0, base.ntotal), ids
+
+        invlists = self.index.invlists
+        ids = np.concatenate(
+            [np.empty(0, dtype=np.int64)]
+            + [
+                faiss.rev_swig_ptr(invlists.get_ids(list_no), invlists.list_size(list_no)).copy()
+                for list_no in range(invlists.nlist)
+                if invlists.list_size(list_no)
+            ]
+        )
+        if len(ids) == 0:
+            return np.empty((0, self.index_dimension), dtype=np.float32), ids
+        return self.index.reconstruct_batch(ids), ids
+
+    def _factory_string(
+        self,
+        index_type: str,
+        num_vectors: int,
+        nlist: int | None,
+        pq_m: int | None,
+        hnsw_m: int,
+        dimension: int,
+    ) -> str | None:
+        """回傳 faiss.index_factory 的描述字串；資料太少無法訓練時回傳 None
+
+        flat / ivf / hnsw 依 ``storage`` 決定向量的編碼（Flat / SQfp16 / SQ8），
+        ivfpq 本身就是壓縮過的編碼，不受影響。
+        """
+        codec = _SQ_CODECS[self.storage]
+        if index_type == "flat":
+            return codec
+        if index_type == "hnsw":
+            return f"HNSW{hnsw_m}" if codec == "Flat" else f"HNSW{hnsw_m},{codec}"
+        if index_type in ("ivf", "ivfpq"):
+            # faiss 建議每個群中心至少有 39 個訓練點
+            nlist = nlist or int(4 * math.sqrt(num_vectors))
+            nlist = max(1, min(nlist, num_vectors // 39))
+            if index_type == "ivf":
+                return f"IVF{nlist},{codec}"
+            if num_vectors < 1_000:  # PQ 每個子空間要訓練 256 個中心
+                return None
+            if pq_m is None:
+                pq_m = next(m for m in range(max(dimension // 8, 1), 0, -1) if dimension % m == 0)
+            return f"IVF{nlist},PQ{pq_m}"
+        raise ValueError(f"未知的索引類型 {index_type}，可用：{', '.join(INDEX_TYPES)}")
+
+    def _new_base_index(self, factory: str, train_vectors: np.ndarray) -> faiss.Index:
+        base = faiss.index_factory(train_vectors.shape[1], factory, faiss.METRIC_INNER_PRODUCT)
+        if not base.is_trained:
+            base.train(train_vectors)
+        if factory.startswith("HNSW"):
+            base.hnsw.efConstruction = max(40, self.ef_search)
+        return base
+
+    def _rebuild_without(self, removed_ids: np.ndarray) -> None:
+        vectors, ids = self._vectors_and_ids()
+        keep = ~np.isin(ids, removed_ids)
+        index = self._with_ids(self._new_base_index(self.factory, vectors[keep]))
+        if keep.any():
+            index.add_with_ids(vectors[keep], ids[keep])
+        self.index = index
+        self.set_search_params()
+
+    def build_ann(
+        self,
+        index_type: str = "auto",
+        *,
+        k: int = 10,
+        num_queries: int = 200,
+        train_size: int = 100_000,
+        nlist: int | None = None,
+        pq_m: int | None = None,
+        hnsw_m: int = 32,
+        dimension: int | None = None,
+        seed: int = 0,
+    ) -> IndexReport:
+        """將目前的向量改存進近似索引，並回報相對於暴力搜尋的 recall@k
+
+        ``index_type`` 為 ``auto`` 時依向量數量自動挑選。IVF / PQ 需要訓練，
+        只從語料中隨機抽取最多 ``train_size`` 筆向量。查詢樣本取自語料本身。
+        向量的壓縮格式與重新計分沿用建立時的 ``storage`` / ``rescore``。
+
+        ``dimension`` 小於嵌入維度時，以同一批訓練向量學出 PCA 投影，索引只存降維後的向量；
+        ``None`` 沿用目前的維度。recall 一律以原始維度的暴力搜尋為標準答案。
+        """
+        self._train_pending()
+        dimension = dimension or self.index_dimension
+        if self._exact is not None:
+            originals, ids = self._exact_vectors_and_ids()
+        elif self.pca is None:
+            originals, ids = self._vectors_and_ids()
+        else:
+            # 已降維又沒有原始向量：只能沿用目前的投影，recall 也只能在降維後的空間計算
+            if dimension != self.index_dimension:
+                raise ValueError("索引已降維且沒有保留原始向量（rescore=0），無法改變維度，請重新建立索引")
+            originals = None
+            vectors, ids = self._vectors_and_ids()
+        num_vectors = len(ids)
+
+        rng = np.random.default_rng(seed)
+        train_rows = np.sort(rng.choice(num_vectors, size=min(num_vectors, train_size), replace=False))
+        pca = self.pca
+        if originals is not None:
+            pca = self._train_pca(originals[train_rows], dimension)
+            vectors = originals if pca is None else pca.apply(originals)
+
+        index_type = choose_index_type(num_vectors) if index_type == "auto" else index_type
+        factory = self._factory_string(index_type, num_vectors, nlist, pq_m, hnsw_m, vectors.shape[1])
+        if factory is None:
+            print(f"向量數 {num_vectors} 太少，無法訓練 {index_type} 索引，維持暴力搜尋。")
+            index_type = "flat"
+            factory = self._factory_string(index_type, num_vectors, nlist, pq_m, hnsw_m, vectors.shape[1])
+
+        index = self._with_ids(self._new_base_index(factory, vectors[train_rows]))
+        if num_vectors:
+            index.add_with_ids(vectors, ids)
+
+        self.index, self.index_type, self.factory, self.pca = index, index_type, factory, pca
+        self.set_search_params()
+
+        k = max(1, min(k, num_vectors))
+        query_rows = rng.choice(num_vectors, size=min(num_vectors, num_queries), replace=False)
+        if len(query_rows) == 0:
+            return IndexReport(index_type, factory, num_vectors, k, 1.0, 0.0, 0.0, self.index_dimension)
+
+        reference = originals if originals is not None else vectors
+        queries = reference[query_rows]
+        started = time.perf_counter()
+        _scores, truth_rows = faiss.knn(queries, reference, k, metric=faiss.METRIC_INNER_PRODUCT)
+        flat_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        if originals is not None:
+            _scores, found = self.search_ids(queries, k)
+        else:
+            _scores, found = self.index.search(queries, k)
+        ann_seconds = time.perf_counter() - started
+
+        return IndexReport(
+            index_type=index_type,
+            factory=factory,
+            vectors=num_vectors,
+            k=k,
+            recall=recall_at_k(ids[truth_rows], found),
+            flat_ms=1000 * flat_seconds / len(queries),
+            ann_ms=1000 * ann_seconds / len(queries),
+            dimension=self.index_dimension,
+        )
+
+    def _train_pca(self, train_vectors: np.ndarray, dimension: int) -> faiss.PCAMatrix | None:
+        """學出降到 ``dimension`` 維的 PCA；不需降維或訓練資料太少時回傳 None"""
+        if dimension >= self.dimension:
+            return None
+        if len(train_vectors) <= dimension:
+            print(f"向量數 {len(train_vectors)} 太少，無法學出 {dimension} 維的 PCA，維持 {self.dimension} 維。")
+            return None
+        pca = faiss.PCAMatrix(self.dimension, dimension)
+        pca.train(train_vectors)
+        return pca
+
+    # ------------------------------------------------------------------
+    # 儲存與載入
+    # ------------------------------------------------------------------
+    def save(self, path: str | Path) -> None:
+        """將索引與文件寫入 ``path`` 資料夾（index.faiss + 欄式文件檔，以及選用的 exact.faiss / pca.faiss）"""
+        directory = Path(path)
+        directory.mkdir(parents=True, exist_ok=True)
+        self._train_pending()
+        partial = directory / "index.faiss.tmp"
+        faiss.write_index(self.index, str(partial))
+        os.replace(partial, directory / "index.faiss")
+        index_info = {
+            "index_type": self.index_type,
+            "factory": self.factory,
+            "nprobe": self.nprobe,
+            "ef_search": self.ef_search,
+            "storage": self.storage,
+            "rescore": self.rescore,
+            "dimension": self.dimension,
+            "projection": self.pca.d_out if self.pca is not None else None,
+        }
+        if self._exact is not None:
+            partial = directory / "exact.faiss.tmp"
+            faiss.write_index(self._exact, str(partial))
+            os.replace(partial, directory / "exact.faiss")
+        if self.pca is not None:
+            # 查詢與之後新增的向量都要經過同一個投影，與索引放在一起
+            partial = directory / "pca.faiss.tmp"
+            faiss.write_VectorTransform(self.pca, str(partial))
+            os.replace(partial, directory / "pca.faiss")
+        _save_text(directory / "index.json", json.dumps(index_info))
+        self.documents.save(directory)
+
+    @classmethod
+    def load(cls, path: str | Path, *, mmap: bool = False) -> "VectorStore":
+        """從 ``save`` 產生的資料夾載入；``mmap=True`` 時以記憶體映射開啟索引與文件欄位，
+
+        多個行程可共用同一份索引檔，而不必各自複製一份到記憶體。
+        mmap 開啟的索引是唯讀的，第一次 ``add`` / ``remove`` 時才會整份複製到記憶體。
+        """
+        directory = Path(path)
+        # IO_FLAG_MMAP 只會映射 IVF 的倒排串列；IO_FLAG_MMAP_IFC 連 flat / SQ / HNSW 的向量也直接映射
+        flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
+        index = faiss.read_index(str(directory / "index.faiss"), flags)
+        documents = DocumentStore.load(directory, mmap=mmap)
+        if index.ntotal != len(documents):
+            raise ValueError(
+                f"索引向量數 ({index.ntotal}) 與文件數 ({len(documents)}) 不一致"
+            )
+
+        index_info = json.loads((directory / "index.json").read_text(encoding="utf-8"))
+        store = cls(
+            index_info.get("dimension", index.d),
+            nprobe=index_info["nprobe"],
+            ef_search=index_info["ef_search"],
+            storage=index_info.get("storage", "float32"),
+            rescore=index_info.get("rescore", 0),
+        )
+        if store._exact is not None:
+            store._exact = faiss.read_index(str(directory / "exact.faiss"), flags)
+        if index_info.get("projection"):
+            store.pca = faiss.read_VectorTransform(str(directory / "pca.faiss"))
+        store.index = index
+        store._mapped = mmap
+        store.index_type = index_info["index_type"]
+        store.factory = index_info["factory"]
+        store.set_search_params()
+        store.documents = documents
+        ids = documents.ids()
+        store._next_id = int(ids.max()) + 1 if len(ids) else 0
+        return store
+
+    @staticmethod
+    def exists(path: str | Path) -> bool:
+        directory = Path(path)
+        return (directory / "index.faiss").exists() and (directory / "documents.json").exists()
+
+
+# 英文、數字與論文編號（如 2305.14325v1、gpt-4）視為一個詞；中日韓文字以二元組 (bigram) 切分
+_LATIN_TOKEN = re.compile(r"[a-z0-9]+(?:[._\-][a-z0-9]+)*")
+_CJK_RUN = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """BM25 使用的斷詞：適用中英夾雜的文字
+
+    含連字號或句點的詞（multi-agent）除了整個詞，也會加入各個部分，
+    讓查詢 "multi agent" 也能命中。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens: List[str] = []
+    for token in _LATIN_TOKEN.findall(text):
+        tokens.append(token)
+        parts = re.split(r"[._\-]", token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class BM25Index:
+    """以 CSR 格式儲存的 BM25 倒排索引
+
+    每個詞的 posting（文件位置）連續存放在 ``postings``，``indptr[t]:indptr[t+1]``
+    是詞 t 的範圍；BM25 權重在建立時就算好，查詢只需把各詞的權重加總。
+    ``ids`` 對應到 ``VectorStore`` 的文件 ID，兩邊的結果可以直接融合。
+    """
+
+    def __init__(
+        self,
+        vocabulary: Dict[str, int],
+        indptr: np.ndarray,
+        postings: np.ndarray,
+        weights: np.ndarray,
+        ids: np.ndarray,
+        fingerprint: str,
+    ):
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.postings = postings
+        self.weights = weights
+        self.ids = ids
+        self.fingerprint = fingerprint
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(
+        cls,
+        documents: Dict[int, Document],
+        *,
+        fingerprint: str = "",
+        k1: float = 1.5,
+        b: float = 0.75,
+    ) -> "BM25Index":
+        vocabulary: Dict[str, int] = {}
+        term_rows: List[int] = []
+        doc_cols: List[int] = []
+        term_freqs: List[int] = []
+        lengths = np.zeros(len(documents), dtype=np.float32)
+        for position, doc in enumerate(documents.values()):
+            counts = Counter(tokenize(doc.content))
+            lengths[position] = sum(counts.values())
+            for term, tf in counts.items():
+                term_rows.append(vocabulary.setdefault(term, len(vocabulary)))
+                doc_cols.append(position)
+                term_freqs.append(tf)
+
+        rows = np.asarray(term_rows, dtype=np.int64)
+        order = np.argsort(rows, kind="stable")
+        postings = np.asarray(doc_cols, dtype=np.int32)[order]
+        tf = np.asarray(term_freqs, dtype=np.float32)[order]
+        doc_freq = np.bincount(rows, minlength=len(vocabulary))
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(doc_freq, out=indptr[1:])
+
+        n_docs = max(len(documents), 1)
+        idf = np.log1p((n_docs - doc_freq + 0.5) / (doc_freq + 0.5)).astype(np.float32)
+        avg_length = float(lengths.mean()) if len(lengths) else 1.0
+        norm = k1 * (1 - b + b * lengths[postings] / max(avg_length, 1e-6))
+        weights = np.repeat(idf, doc_freq) * tf * (k1 + 1) / (tf + norm)
+        ids = np.fromiter(documents, dtype=np.int64, count=len(documents))
+        return cls(vocabulary, indptr, postings, weights.astype(np.float32), ids, fingerprint)
+
+    def search(
+        self, query: str, top_k: int = 3, allowed_ids: np.ndarray | None = None
+    ) -> List[Tuple[float, int]]:
+        """回傳 (BM25 分數, 文件 ID)，只包含至少命中一個詞的文件
+
+        ``allowed_ids`` 限定候選文件（例如 metadata 篩選的結果）。
+        """
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, stop = self.indptr[term_id], self.indptr[term_id + 1]
+            scores[self.postings[start:stop]] += self.weights[start:stop]
+        if allowed_ids is not None:
+            scores[~np.isin(self.ids, allowed_ids)] = 0.0
+
+        hits = np.flatnonzero(scores)
+        if hits.size > top_k:
+            hits = hits[np.argpartition(scores[hits], -top_k)[-top_k:]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(float(scores[pos]), int(self.ids[pos])) for pos in hits]
+
+    def save(self, path: str | Path) -> None:
+        """每個檔案都先寫暫存檔再改名；vocabulary.json（含語料版本）最後寫入"""
+        directory = Path(path)
+        directory.mkdir(parents=True, exist_ok=True)
+        _save_array(directory / "indptr.npy", self.indptr)
+        _save_array(directory / "postings.npy", self.postings)
+        _save_array(directory / "weights.npy", self.weights)
+        _save_array(directory / "ids.npy", self.ids)
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        payload = {"fingerprint": self.fingerprint, "terms": terms}
+        _save_text(directory / "vocabulary.json", json.dumps(payload, ensure_ascii=False))
+
+    @classmethod
+    def load(cls, path: str | Path) -> "BM25Index":
+        directory = Path(path)
+        payload = json.loads((directory / "vocabulary.json").read_text(encoding="utf-8"))
+        return cls(
+            {term: term_id for term_id, term in enumerate(payload["terms"])},
+            np.load(directory / "indptr.npy", mmap_mode="r"),
+            np.load(directory / "postings.npy", mmap_mode="r"),
+            np.load(directory / "weights.npy", mmap_mode="r"),
+            np.load(directory / "ids.npy"),
+            payload["fingerprint"],
+        )
+
+    @staticmethod
+    def stored_fingerprint(path: str | Path) -> str | None:
+        vocabulary_path = Path(path) / "vocabulary.json"
+        if not vocabulary_path.exists():
+            return None
+        return json.loads(vocabulary_path.read_text(encoding="utf-8")).get("fingerprint")
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = 60) -> List[Tuple[float, int]]:
+    """RRF：每個結果得分為 Σ 1 / (k + 名次)，只看名次、不需校正不同檢索器的分數尺度"""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    # 同分時維持插入順序（先列出的檢索器優先），不依 ID 大小排
+    return sorted(
+        ((score, doc_id) for doc_id, score in fused.items()), key=lambda item: item[0], reverse=True
+    )
+
+
+@dataclass
+class FileFingerprint:
+    """單一 PDF 的指紋與其區塊 ID，用來判斷檔案是否需要重新處理"""
+
+    size: int
+    mtime_ns: int
+    sha256: str
+    chunk_ids: List[int] = field(default_factory=list)
+
+
+@dataclass
+class IndexUpdate:
+    """一次增量同步的結果摘要"""
+
+    added: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    unchanged: int = 0
+    refreshed: int = 0  # 內容未變、只更新了指紋的檔案數
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+
+def _file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stable_chunk_id(source: str, content_hash: str, chunk_number: int) -> int:
+    """由 (檔名, 檔案雜湊, 區塊序號) 推導出固定的 63-bit 區塊 ID
+
+    同一份檔案不論何時重新處理，都會得到相同的 ID。
+    """
+    key = f"{source}\0{content_hash}\0{chunk_number}".encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big") >> 1
+
+
+class IncrementalIndexer:
+    """比對 PDF 的大小、修改時間與內容雜湊，只重新處理新增或變更的檔案
+
+    指紋記錄在索引資料夾的 ``manifest.json``；刪除的檔案會依 ID
+    從 ``VectorStore`` 移除對應向量。
+    """
+
+    MANIFEST_NAME = "manifest.json"
+
+    def __init__(
+        self,
+        index_dir: str | Path,
+        processor: PDFProcessor,
+        ingest: Callable[[Iterable[Tuple[Document, int]]], int],
+        settings: Dict[str, Any],
+    ):
+        self.index_dir = Path(index_dir)
+        self.processor = processor
+        # ingest 負責把 (區塊, ID) 串流分批嵌入並寫入向量庫
+        self.ingest = ingest
+        self.settings = settings
+        self.files: Dict[str, FileFingerprint] = {}
+        # 切割參數或嵌入模型改變時，舊向量全部失效，必須從頭建立
+        self.compatible = False
+        self._load_manifest()
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.index_dir / self.MANIFEST_NAME
+
+    def _load_manifest(self) -> None:
+        if not self.manifest_path.exists():
+            return
+        manifest = json.loads(self.manifest_path.read_text(encoding="utf-8"))
+        if manifest.get("settings") != self.settings:
+            print("切割參數、嵌入模型或向量索引設定已變更，將重新建立整個索引。")
+            return
+        self.compatible = True
+        self.files = {
+            name: FileFingerprint(**fingerprint)
+            for name, fingerprint in manifest.get("files", {}).items()
+        }
+
+    def save_manifest(self) -> None:
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        manifest = {
+            "settings": self.settings,
+            "files": {name: vars(fingerprint) for name, fingerprint in sorted(self.files.items())},
+        }
+        _save_text(self.manifest_path, json.dumps(manifest, ensure_ascii=False, indent=2))
+
+    def sync(self, store: VectorStore, pdf_files: Sequence[Path]) -> IndexUpdate:
+        """讓 ``store`` 與 ``pdf_files`` 的現況一致"""
+        update = IndexUpdate()
+        current = {path.name: path for path in pdf_files}
+        # 要移除的舊區塊 ID 最後一次移除：HNSW 每次移除都要重建整個圖
+        stale_ids: List[int] = []
+
+        for name in sorted(set(self.files) - set(current)):
+            print(f"移除已刪除的 PDF: {name}")
+            stale_ids.extend(self.files.pop(name).chunk_ids)
+            update.removed.append(name)
+
+        pending: List[Tuple[Path, os.stat_result, str]] = []
+        for name, path in sorted(current.items()):
+            stat = path.stat()
+            previous = self.files.get(name)
+            if previous and previous.size == stat.st_size and previous.mtime_ns == stat.st_mtime_ns:
+                update.unchanged += 1
+                continue
+
+            content_hash = _file_sha256(path)
+            if previous and previous.sha256 == content_hash:
+                # 只有修改時間變動（例如重新複製），內容相同不需重算
+                previous.size, previous.mtime_ns = stat.st_size, stat.st_mtime_ns
+                update.unchanged += 1
+                update.refreshed += 1
+                continue
+            pending.append((path, stat, content_hash))
+
+        completed: List[Tuple[str, FileFingerprint]] = []
+
+        def stream_chunks() -> Iterator[Tuple[Document, int]]:
+            fingerprints = {path: (stat, content_hash) for path, stat, content_hash in pending}
+            for extraction in self.processor.iter_pdfs(list(fingerprints)):
+                name = extraction.path.name
+                stat, content_hash = fingerprints[extraction.path]
+                print(f"{'更新' if name in self.files else '新增'} PDF: {name}")
+                if extraction.error is not None:
+                    # 保留舊向量與舊指紋，下次同步會再試一次
+                    print(f"  無法讀取 {name}: {extraction.error}")
+                    continue
+
+                chunk_ids: List[int] = []
+                for number, chunk in enumerate(self.processor.iter_chunks(extraction.text, name)):
+                    chunk_ids.append(stable_chunk_id(name, content_hash, number))
+                    yield chunk, chunk_ids[-1]
+                print(f"  切割成 {len(chunk_ids)} 個區塊")
+                completed.append(
+                    (
+                        name,
+                        FileFingerprint(
+                            size=stat.st_size,
+                            mtime_ns=stat.st_mtime_ns,
+                            sha256=content_hash,
+                            chunk_ids=chunk_ids,
+                        ),
+                    )
+                )
+
+        self.ingest(stream_chunks())
+
+        # 新向量都寫入後才移除舊版本：新舊 ID 由內容雜湊決定，不會互相衝突
+        for name, fingerprint in completed:
+            previous = self.files.get(name)
+            if previous:
+                stale_ids.extend(previous.chunk_ids)
+            self.files[name] = fingerprint
+            (update.changed if previous else update.added).append(name)
+        if stale_ids:
+            store.remove(stale_ids)
+        return update
+
+
+_OLLAMA_ERROR = "無法連線到 Ollama，請確認服務已啟動並安裝 gemma3:1b 模型。"
+
+
+@dataclass
+class PackedContext:
+    """``ContextPacker.pack`` 的結果
+
+    ``ranks`` 是每個保留段落在原本檢索結果中的名次（0 起算），
+    提示詞中的來源編號沿用這個名次，與畫面上列出的參考資料一致。
+    """
+
+    documents: List[Document]
+    ranks: List[int]
+    tokens: int
+    original_tokens: int
+    trimmed: int = 0
+    dropped: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.original_tokens - self.tokens
+
+    def summary(self) -> str:
+        return (
+            f"（上下文 {self.tokens} tokens，原本 {self.original_tokens}，省下 {self.tokens_saved}；"
+            f"裁切重疊 {self.trimmed} 段、捨棄 {self.dropped} 段）"
+        )
+
+
+# ContextPacker 剪裁的單位：CJK 每字一個，其他文字以空白分隔的一段為一個
+_PACK_UNIT = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]|[^\s\u3400-\u9fff\uf900-\ufaff]+")
+
+
+class ContextPacker:
+    """依 token 預算挑選要放進提示詞的段落
+
+    段落依檢索名次（分數高者優先）貪婪放入；同一份文件中與已選段落重疊的字
+    （依 metadata 的 ``start_char``，即合併空白後的字元位置判斷）會被剪掉，
+    最後一段放不下時裁到剛好填滿預算。沒有 ``start_char`` 的段落（舊版索引）不做剪裁。
+    計數使用 tiktoken，載入失敗（未安裝或離線無法下載編碼表）時改用粗估。
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 1500,
+        *,
+        encoding_name: str = "cl100k_base",
+        min_chunk_tokens: int = 64,
+    ):
+        self.max_tokens = max_tokens
+        self.min_chunk_tokens = min_chunk_tokens
+        self.tokens = TokenCounter(encoding_name)
+
+    def count(self, text: str) -> int:
+        return self.tokens.count(text)
+
+    def pack(self, contexts: Sequence[Document]) -> PackedContext:
+        """``contexts`` 需依分數由高到低排列（``search`` 的回傳順序）"""
+        covered: Dict[str, List[Tuple[int, int]]] = {}
+        documents: List[Document] = []
+        ranks: List[int] = []
+        used = original = trimmed = dropped = 0
+
+        for rank, doc in enumerate(contexts):
+            original += self.count(doc.content)
+            source = doc.metadata.get("source")
+            start_char = doc.metadata.get("start_char")
+            words = [
+                ((start_char or 0) + match.start(), match.group())
+                for match in _PACK_UNIT.finditer(doc.content)
+            ]
+            overlapped = False
+            if start_char is not None:
+                spans = covered.get(source, [])
+                kept = [
+                    (position, word)
+                    for position, word in words
+                    if not any(lo <= position < hi for lo, hi in spans)
+                ]
+                overlapped = len(kept) < len(words)
+                words = kept
+
+            budget = self.max_tokens - used
+            if not words or budget < self.min_chunk_tokens:
+                dropped += 1
                 continue
-            results.append((float(score), self.documents[idx]))
-        return results
+            if self.count(self._render(words)) > budget:
+                words = self._fit(words, budget)
+                if not words:
+                    dropped += 1
+                    continue
+
+            content = self._render(words)
+            used += self.count(content)
+            trimmed += overlapped
+            if start_char is not None:
+                covered.setdefault(source, []).append((words[0][0], words[-1][0] + len(words[-1][1])))
+            documents.append(
+                doc if content == doc.content else Document(content=content, metadata=doc.metadata)
+            )
+            ranks.append(rank)
+
+        return PackedContext(documents, ranks, used, original, trimmed, dropped)
+
+    def _fit(self, words: List[Tuple[int, str]], budget: int) -> List[Tuple[int, str]]:
+        """二分搜尋能放進 ``budget`` 的最多單位數"""
+        lo, hi = 0, len(words)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.count(self._render(words[:mid])) <= budget:
+                lo = mid
+            else:
+                hi = mid - 1
+        return words[:lo]
+
+    @staticmethod
+    def _render(words: Sequence[Tuple[int, str]]) -> str:
+        """把 (字元位置, 單位) 接回文字；原本相隔一格的補空白，中間被剪掉處以「…」標示"""
+        parts: List[str] = []
+        previous_end = None
+        for position, word in words:
+            if previous_end is not None and position != previous_end:
+                parts.append(" " if position == previous_end + 1 else " … ")
+            parts.append(word)
+            previous_end = position + len(word)
+        return "".join(parts)
+
+
+@dataclass
+class GenerationStats:
+    """一次 LLM 生成的時間統計（秒）"""
+
+    time_to_first_token: float | None = None
+    total_duration: float = 0.0
+    tokens: int = 0
+    tokens_per_second: float = 0.0
+    cached: bool = False
+    # 串流中途失敗時的例外；這時的回答不完整，不會寫入答案快取
+    error: Exception | None = None
+
+    def summary(self) -> str:
+        if self.cached:
+            return f"（答案快取命中，耗時 {self.total_duration * 1000:.1f} ms）"
+        ttft = "—" if self.time_to_first_token is None else f"{self.time_to_first_token:.2f} 秒"
+        return (
+            f"（首個 token {ttft}，共 {self.tokens} tokens，"
+            f"{self.tokens_per_second:.1f} tokens/秒，總耗時 {self.total_duration:.2f} 秒）"
+        )
+
+
+@dataclass
+class ComparisonTimings:
+    """``compare_with_baseline`` 的耗時（秒）：兩次生成同時進行，``wall`` 約等於較慢者"""
+
+    rag: float
+    baseline: float
+    wall: float
+
+    def summary(self) -> str:
+        saved = self.rag + self.baseline - self.wall
+        return (
+            f"（RAG {self.rag:.2f} 秒、baseline {self.baseline:.2f} 秒，"
+            f"同時執行總耗時 {self.wall:.2f} 秒，省下 {saved:.2f} 秒）"
+        )
+
+
+def _timed(fn: Callable[..., T], *args: Any, **kwargs: Any) -> Tuple[T, float]:
+    """執行 ``fn`` 並回傳 (結果, 耗時秒數)"""
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+class StreamingAnswer:
+    """``RAGPipeline.ask_stream`` 的結果：迭代時逐段取得回答
+
+    迭代結束後，``answer`` 為完整回答，``stats`` 記錄首個 token 時間、
+    每秒 token 數與總耗時。``on_complete`` 只在串流順利結束且回答非空時呼叫。
+    """
+
+    def __init__(
+        self,
+        pieces: Iterator[str],
+        contexts: List[Document],
+        stats: GenerationStats,
+        on_complete: Callable[[str], None] | None = None,
+    ):
+        self.contexts = contexts
+        self.stats = stats
+        self.answer = ""
+        self._pieces = pieces
+        self._on_complete = on_complete
+
+    def __iter__(self) -> Iterator[str]:
+        parts: List[str] = []
+        for piece in self._pieces:
+            parts.append(piece)
+            yield piece
+        self.answer = "".join(parts).strip()
+        if self._on_complete is not None and self.stats.error is None and self.answer:
+            self._on_complete(self.answer)
+
+
+@dataclass
+class PreparedAnswer:
+    """``RAGPipeline.prepare_answer`` 的結果：檢索與提示詞都已備妥，只差呼叫 LLM
+
+    ``answer`` 已有值時（沒有相關資料或答案快取命中）不必呼叫 LLM，``request`` 為 ``None``；
+    否則以 ``ollama.chat(**request)``（或 ``AsyncClient.chat``）生成，再交給
+    ``RAGPipeline.remember_answer`` 寫入答案快取。``packing`` 是這次請求的上下文裁切統計。
+    """
+
+    question: str
+    contexts: List[Document]
+    request: Dict[str, Any] | None = None
+    answer: str | None = None
+    cached: bool = False
+    packing: PackedContext | None = None
+    query_embedding: np.ndarray | None = None
+
+
+def _context_key(doc: Document) -> str:
+    return f"{doc.metadata.get('source', 'unknown')}#{doc.metadata.get('chunk_id')}"
 
 
 class RAGPipeline:
@@ -150,23 +2930,119 @@ class RAGPipeline:
         self,
         data_folder: str = "data",
         retriever_top_k: int = 3,
-        chunk_size: int = 600,
-        chunk_overlap: int = 100,
+        chunk_size: int | None = None,
+        chunk_overlap: int | None = None,
         llm_model: str = "gemma3:1b",
         baseline_system_prompt: str | None = None,
+        cache_dir: str | Path | None = None,
+        index_dir: str | Path | None = None,
+        pdf_workers: int = 1,
+        embed_batch_size: int = 256,
+        index_type: str = "flat",
+        nprobe: int = 16,
+        ef_search: int = 64,
+        vector_storage: str = "float32",
+        rescore: int = 0,
+        pca_dimension: int | None = None,
+        query_cache_size: int = 1024,
+        query_cache_ttl: float | None = None,
+        answer_cache_dir: str | Path | None = None,
+        answer_cache_threshold: float | None = None,
+        answer_cache_size: int = 1000,
+        context_token_budget: int | None = 1500,
+        rerank_model: str | None = None,
+        candidate_k: int = 20,
+        rerank_budget_ms: float | None = 200.0,
+        retrieval: str = "dense",
+        rrf_k: int = 60,
+        chunk_strategy: str = "words",
+        embedding_backend: str = "torch",
+        embed_threads: int | None = None,
+        embed_token_budget: int | None = None,
+        embed_workers: int = 1,
     ):
+        if retrieval not in RETRIEVAL_MODES:
+            raise ValueError(f"未知的檢索模式 {retrieval}，可用：{', '.join(RETRIEVAL_MODES)}")
         self.data_folder = Path(data_folder)
+        self.index_dir = Path(index_dir) if index_dir is not None else None
+        # 串流建立索引時，每累積這麼多區塊就計算一次嵌入並寫入向量庫
+        self.embed_batch_size = embed_batch_size
+        # "auto" 代表依區塊數量在 flat / hnsw / ivfpq 之間自動挑選
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        # float16 / int8 壓縮索引中的向量；rescore > 0 時以 float32 原始向量重新計分前幾名候選
+        self.vector_storage = vector_storage
+        self.rescore = rescore
+        # 指定時以 PCA 把索引中的向量降到這個維度（查詢也經過同一個投影）
+        self.pca_dimension = pca_dimension
         self.retriever_top_k = retriever_top_k
         self.llm_model = llm_model
         self.baseline_system_prompt = baseline_system_prompt or (
             "You are a well-read AI researcher. Answer using your prior knowledge."
         )
 
-        self.processor = PDFProcessor(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        self.embedder = EmbeddingModel()
-        self.vector_store = VectorStore(self.embedder.dimension)
-        self.corpus: List[Document] = []
+        # chunk_size / chunk_overlap 未指定時使用 CHUNK_DEFAULTS 中該策略的預設值
+        self.processor = PDFProcessor(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            max_workers=pdf_workers,
+            strategy=chunk_strategy,
+        )
+        self.embedder = EmbeddingModel(
+            query_cache_size=query_cache_size,
+            query_cache_ttl=query_cache_ttl,
+            backend=embedding_backend,
+            threads=embed_threads,
+            onnx_dir=Path(cache_dir or ".rag_cache") / "onnx",
+            token_budget=embed_token_budget,
+        )
+        self.vector_store = self._new_vector_store()
+        # 大於 1 時，第一次需要嵌入語料才啟動多行程嵌入，建立完索引即關閉
+        self.embed_workers = embed_workers
+        self.embed_threads = embed_threads
+        self.embedding_cache = (
+            EmbeddingCache(cache_dir, self.embedder.model_id, self.embedder.dimension)
+            if cache_dir is not None
+            else None
+        )
+        # 指定資料夾或相似度門檻其中之一就啟用語意答案快取
+        self.answer_cache = (
+            SemanticAnswerCache(
+                self.embedder.dimension,
+                threshold=answer_cache_threshold if answer_cache_threshold is not None else 0.95,
+                max_entries=answer_cache_size,
+                path=answer_cache_dir,
+            )
+            if answer_cache_dir is not None or answer_cache_threshold is not None
+            else None
+        )
         self.ready = False
+        self.last_comparison: ComparisonTimings | None = None
+        # 提示詞中參考資料的 token 上限；None 表示不限制，全部段落原文放入
+        self.context_packer = (
+            ContextPacker(context_token_budget) if context_token_budget is not None else None
+        )
+        self.last_packing: PackedContext | None = None
+        # 指定重排序模型時，先從 FAISS 取 candidate_k 筆候選，再以 cross-encoder 挑出 top_k
+        self.candidate_k = candidate_k
+        self.reranker = (
+            Reranker(rerank_model, budget_ms=rerank_budget_ms) if rerank_model is not None else None
+        )
+        # hybrid：BM25 與 FAISS 同時搜尋，再以 reciprocal rank fusion 合併
+        self.retrieval = retrieval
+        self.rrf_k = rrf_k
+        self.sparse_index: BM25Index | None = None
+        self._sparse_executor = (
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="bm25")
+            if retrieval == "hybrid"
+            else None
+        )
+
+    @property
+    def corpus(self) -> DocumentStore:
+        """目前知識庫中的所有區塊（欄式儲存，取用時才組出 ``Document``）"""
+        return self.vector_store.documents
 
     # ------------------------------------------------------------------
     # 資料處理
@@ -194,75 +3070,421 @@ class RAGPipeline:
             Document(content=course_text, metadata={"source": "demo", "chunk_id": 1}),
         ]
 
-    def _load_pdf_documents(self) -> List[Document]:
-        pdf_files = sorted(self.data_folder.glob("*.pdf"))
-        if not pdf_files:
-            return []
-
-        documents: List[Document] = []
-        for pdf_path in pdf_files:
+    def _iter_pdf_chunks(self, pdf_files: Sequence[Path]) -> Iterator[Tuple[Document, None]]:
+        if self.processor.max_workers > 1:
+            print(f"以 {self.processor.max_workers} 個行程平行讀取 {len(pdf_files)} 個 PDF")
+        for extraction in self.processor.iter_pdfs(pdf_files):
+            pdf_path = extraction.path
             print(f"讀取 PDF: {pdf_path.name}")
-            try:
-                text = self.processor.load_pdf(pdf_path)
-            except Exception as exc:  # pragma: no cover - 以防外部錯誤
-                print(f"  無法讀取 {pdf_path.name}: {exc}")
+            if extraction.error is not None:
+                print(f"  無法讀取 {pdf_path.name}: {extraction.error}")
                 continue
 
-            chunks = self.processor.chunk_text(text, source=pdf_path.name)
-            print(f"  切割成 {len(chunks)} 個區塊")
-            documents.extend(chunks)
-        return documents
+            chunk_count = 0
+            for chunk in self.processor.iter_chunks(extraction.text, source=pdf_path.name):
+                chunk_count += 1
+                yield chunk, None
+            print(f"  切割成 {chunk_count} 個區塊")
+
+    def _ingest(self, items: Iterable[Tuple[Document, int | None]]) -> int:
+        """串流建立索引：擷取與切割在背景執行緒進行，這裡每滿一批就嵌入並寫入
+
+        同一時間只有約兩批區塊與一批向量留在記憶體中。
+        ``items`` 中的 ID 要嘛全部為 None（自動配發），要嘛全部指定。
+        """
+        total = 0
+        batches = _batched(_prefetch(items, depth=2 * self.embed_batch_size), self.embed_batch_size)
+        for batch in batches:
+            documents = [doc for doc, _doc_id in batch]
+            ids = [doc_id for _doc, doc_id in batch]
+            embeddings = self._encode_corpus([doc.content for doc in documents])
+            self.vector_store.add(embeddings, documents, None if ids[0] is None else ids)
+            total += len(batch)
+        return total
 
     def prepare_corpus(self) -> None:
+        cache_stats = (
+            (self.embedding_cache.hits, self.embedding_cache.misses)
+            if self.embedding_cache is not None
+            else None
+        )
+        try:
+            if self.index_dir is not None and self.data_folder.exists():
+                self._sync_index()
+            if not self.ready:
+                self._build_in_memory()
+        finally:
+            self.embedder.close_pool()
+        if self.embedding_cache is not None and cache_stats is not None:
+            print(
+                f"向量快取：命中 {self.embedding_cache.hits - cache_stats[0]} 筆，"
+                f"新計算 {self.embedding_cache.misses - cache_stats[1]} 筆"
+            )
+        if self.embedder.corpus_stats.texts:
+            print(self.embedder.corpus_stats.summary())
+        self._on_corpus_loaded(self.index_dir)
+
+    def _on_corpus_loaded(self, index_dir: Path | None) -> None:
+        """語料確定後，更新依賴語料版本的答案快取與 BM25 索引
+
+        語料版本要雜湊所有區塊，只在第一次用到時計算一次；兩者都未啟用時完全不算。
+        """
+        fingerprint = functools.lru_cache(maxsize=None)(self.vector_store.fingerprint)
+        self._refresh_answer_cache(fingerprint)
+        self._refresh_sparse_index(fingerprint, index_dir)
+
+    def _refresh_answer_cache(self, fingerprint: Callable[[], str]) -> None:
+        if self.answer_cache is None:
+            return
+        version = hashlib.sha1(f"{self.llm_model}\0{fingerprint()}".encode("utf-8")).hexdigest()
+        self.answer_cache.invalidate(version)
+
+    def _refresh_sparse_index(self, fingerprint: Callable[[], str], index_dir: Path | None) -> None:
+        """載入與語料版本相符的 BM25 索引，不符或不存在時重建並存回 ``index_dir/bm25``"""
+        if self.retrieval != "hybrid":
+            return
+        bm25_dir = index_dir / "bm25" if index_dir is not None else None
+        if bm25_dir is not None and BM25Index.stored_fingerprint(bm25_dir) == fingerprint():
+            self.sparse_index = BM25Index.load(bm25_dir)
+            print(f"已載入 BM25 倒排索引：{len(self.sparse_index.vocabulary)} 個詞。")
+            return
+
+        started = time.perf_counter()
+        self.sparse_index = BM25Index.build(self.vector_store.documents, fingerprint=fingerprint())
+        print(
+            f"建立 BM25 倒排索引：{len(self.sparse_index)} 筆文件、"
+            f"{len(self.sparse_index.vocabulary)} 個詞，耗時 {time.perf_counter() - started:.2f} 秒"
+        )
+        if bm25_dir is not None:
+            self.sparse_index.save(bm25_dir)
+
+    def _new_vector_store(self) -> VectorStore:
+        return VectorStore(
+            self.embedder.dimension,
+            nprobe=self.nprobe,
+            ef_search=self.ef_search,
+            storage=self.vector_storage,
+            rescore=self.rescore,
+        )
+
+    def _maybe_build_ann(self) -> bool:
+        """依設定把向量庫換成近似索引；有重建時回傳 True"""
+        store = self.vector_store
+        store.set_search_params(nprobe=self.nprobe, ef_search=self.ef_search)
+        target = (
+            choose_index_type(len(store.documents)) if self.index_type == "auto" else self.index_type
+        )
+        dimension = min(self.pca_dimension or store.dimension, store.dimension)
+        if store.index_type == target and store.index_dimension == dimension:
+            return False
+        report = store.build_ann(target, dimension=dimension)
+        print(
+            f"已建立 {report.dimension} 維的 {report.factory} 索引：recall@{report.k} = {report.recall:.3f}，"
+            f"平均查詢 {report.ann_ms:.3f} ms（暴力搜尋 {report.flat_ms:.3f} ms）"
+        )
+        return True
+
+    def _build_in_memory(self) -> None:
+        self.vector_store = self._new_vector_store()
         if not self.data_folder.exists():
             print(f"找不到資料夾 {self.data_folder}，改用內建示範文本。")
-            documents = self._build_fallback_documents()
+            pdf_files: List[Path] = []
         else:
-            documents = self._load_pdf_documents()
-            if not documents:
+            pdf_files = sorted(self.data_folder.glob("*.pdf"))
+
+        print("開始串流建立向量索引...")
+        count = self._ingest(self._iter_pdf_chunks(pdf_files)) if pdf_files else 0
+        if count == 0:
+            if self.data_folder.exists():
                 print("資料夾內沒有有效的 PDF，改用內建示範文本。")
-                documents = self._build_fallback_documents()
+            count = self._ingest((doc, None) for doc in self._build_fallback_documents())
 
-        self.corpus = documents
-        print(f"共收集 {len(self.corpus)} 個文字區塊，開始建立向量索引...")
-        embeddings = self.embedder.encode([doc.content for doc in self.corpus])
-        self.vector_store.add(embeddings, self.corpus)
+        self._maybe_build_ann()
         self.ready = len(self.corpus) > 0
         print(f"完成：索引文件 {len(self.corpus)} 筆，向量維度 {self.embedder.dimension}。")
 
+    def _sync_index(self) -> None:
+        """增量模式：載入既有索引，只處理新增、變更與刪除的 PDF"""
+        settings = {**self.processor.settings, "embedding_model": self.embedder.model_id}
+        if self.vector_storage != "float32" or self.rescore:
+            # 壓縮格式變動時要重新寫入所有向量（嵌入快取仍可沿用）
+            settings.update(vector_storage=self.vector_storage, rescore=self.rescore)
+        if self.pca_dimension:
+            settings["pca_dimension"] = self.pca_dimension
+        indexer = IncrementalIndexer(self.index_dir, self.processor, self._ingest, settings)
+        if indexer.compatible and VectorStore.exists(self.index_dir):
+            self.vector_store = VectorStore.load(self.index_dir)
+        else:
+            indexer.files.clear()
+            self.vector_store = self._new_vector_store()
+
+        update = indexer.sync(self.vector_store, sorted(self.data_folder.glob("*.pdf")))
+        rebuilt = bool(self.vector_store.documents) and self._maybe_build_ann()
+        if update.has_changes or rebuilt or not indexer.compatible:
+            self.vector_store.save(self.index_dir)
+            indexer.save_manifest()
+        elif update.refreshed:
+            indexer.save_manifest()
+
+        self.ready = len(self.corpus) > 0
+        print(
+            f"增量索引完成：新增 {len(update.added)}、更新 {len(update.changed)}、"
+            f"刪除 {len(update.removed)}、未變動 {update.unchanged} 個檔案；"
+            f"共 {len(self.corpus)} 筆區塊。"
+        )
+        if not self.ready:
+            print("索引中沒有任何區塊，改用內建示範文本。")
+
+    def _encode_corpus(self, texts: Sequence[str]) -> np.ndarray:
+        if self.embedding_cache is None:
+            return self._embed_missing(texts)
+        return self.embedding_cache.get_or_encode(texts, self._embed_missing)
+
+    def _embed_missing(self, texts: Sequence[str]) -> np.ndarray:
+        """快取中沒有的區塊才會到這裡；數量多到值得分給多個行程時才啟動行程池"""
+        if self.embed_workers > 1 and len(texts) > 32:
+            self.embedder.start_pool(self.embed_workers, self.embed_threads)
+        return self.embedder.encode_corpus(texts)
+
+    def save_index(self, path: str | Path) -> None:
+        self.vector_store.save(path)
+        if self.sparse_index is not None:
+            self.sparse_index.save(Path(path) / "bm25")
+        print(f"索引已儲存至 {path}")
+
+    def load_index(self, path: str | Path, *, mmap: bool = True) -> None:
+        """直接載入既有索引，略過 PDF 解析與嵌入計算"""
+        store = VectorStore.load(path, mmap=mmap)
+        if store.dimension != self.embedder.dimension:
+            raise ValueError(
+                f"索引維度 {store.dimension} 與嵌入模型維度 {self.embedder.dimension} 不一致"
+            )
+        self.vector_store = store
+        self.ready = len(self.corpus) > 0
+        self._on_corpus_loaded(Path(path))
+        print(f"已載入索引 {path}：共 {len(self.corpus)} 筆文件。")
+
     # ------------------------------------------------------------------
     # 問答與比較
     # ------------------------------------------------------------------
-    def ask(self, question: str, *, verbose: bool = True) -> Tuple[str, List[Document]]:
+    def ask(
+        self, question: str, *, verbose: bool = True, where: MetadataFilter | None = None
+    ) -> Tuple[str, List[Document]]:
+        """``where`` 可限定只從特定論文或段落範圍中檢索"""
         if not self.ready:
             raise RuntimeError("尚未載入知識庫，請先呼叫 prepare_corpus()")
 
         if verbose:
             print(f"\n使用者問題：{question}")
 
-        query_embedding = self.embedder.encode([question])
-        results = self.vector_store.search(query_embedding, top_k=self.retriever_top_k)
+        query_embeddings, batch_results = self._retrieve([question], where)
+        return self._answer_from_results(question, batch_results[0], query_embeddings[0])
+
+    def prepare_answer(self, question: str, where: MetadataFilter | None = None) -> PreparedAnswer:
+        """檢索、查答案快取並組好 LLM 請求，但不呼叫 LLM
+
+        給自行呼叫 LLM 的程式（例如 ``rag_server`` 以 ``ollama.AsyncClient`` 生成）使用；
+        不修改 pipeline 的狀態，可以在多個執行緒同時呼叫。
+        """
+        query_embeddings, batch_results = self._retrieve([question], where)
+        return self._prepare(question, batch_results[0], query_embeddings[0])
+
+    def remember_answer(self, prepared: PreparedAnswer, answer: str) -> None:
+        """把 LLM 對 ``prepared`` 成功生成的回答寫入答案快取；空白回答不寫入
+
+        呼叫失敗時不要呼叫這個方法（``llm_error`` 的訊息不該被當成答案快取）。
+        """
+        if self.answer_cache is None or prepared.query_embedding is None or not answer:
+            return
+        context_keys = [_context_key(doc) for doc in prepared.contexts]
+        self.answer_cache.store(prepared.question, prepared.query_embedding, answer, context_keys)
+
+    @staticmethod
+    def llm_error(exc: Exception) -> str:
+        """LLM 呼叫失敗時回給使用者的訊息"""
+        return f"{_OLLAMA_ERROR}\n原始錯誤：{exc}"
+
+    def retrieve_many(
+        self, questions: Sequence[str], where: MetadataFilter | None = None
+    ) -> List[List[Tuple[float, Document]]]:
+        """批次檢索：所有問題一次編碼、一次搜尋，適合離線評估檢索品質"""
+        return self._retrieve(questions, where)[1]
+
+    def _retrieve(
+        self, questions: Sequence[str], where: MetadataFilter | None = None
+    ) -> Tuple[np.ndarray, List[List[Tuple[float, Document]]]]:
+        if not self.ready:
+            raise RuntimeError("尚未載入知識庫，請先呼叫 prepare_corpus()")
+        if not questions:
+            return np.empty((0, self.embedder.dimension), dtype=np.float32), []
+        depth = self.retriever_top_k
+        if self.reranker is not None:
+            depth = max(self.candidate_k, self.retriever_top_k)
+        # 融合前兩邊各多取一些，讓只出現在其中一邊前段的結果也有機會入選
+        pool = max(self.candidate_k, depth)
+        sparse_future: Future | None = None
+        if self.sparse_index is not None:
+            # BM25 不需要查詢向量：先交給背景執行緒，與嵌入計算、FAISS 搜尋同時進行
+            index = self.sparse_index
+            allowed = self.vector_store.matching_ids(where) if where is not None else None
+            sparse_future = self._sparse_executor.submit(
+                lambda: [index.search(question, pool, allowed) for question in questions]
+            )
+
+        query_embeddings = self.embedder.encode(questions, use_query_cache=True)
+        if sparse_future is None:
+            results = self.vector_store.search_batch(query_embeddings, top_k=depth, where=where)
+        else:
+            results = self._fuse(query_embeddings, sparse_future.result(), pool, depth, where)
+        if self.reranker is not None:
+            results = self.reranker.rerank_many(questions, results, self.retriever_top_k)
+        return query_embeddings, results
+
+    def _fuse(
+        self,
+        query_embeddings: np.ndarray,
+        sparse_results: Sequence[Sequence[Tuple[float, int]]],
+        pool: int,
+        top_k: int,
+        where: MetadataFilter | None = None,
+    ) -> List[List[Tuple[float, Document]]]:
+        """以 RRF 合併 FAISS 與 BM25 的名次，回傳 (RRF 分數, 文件)"""
+        documents = self.vector_store.documents
+        _scores, dense_ids = self.vector_store.search_ids(query_embeddings, pool, where)
+        batch_results: List[List[Tuple[float, Document]]] = []
+        for dense_row, sparse_row in zip(dense_ids, sparse_results):
+            dense_ranking = [int(doc_id) for doc_id in dense_row if doc_id in documents]
+            sparse_ranking = [doc_id for _score, doc_id in sparse_row if doc_id in documents]
+            fused = reciprocal_rank_fusion([dense_ranking, sparse_ranking], self.rrf_k)
+            batch_results.append([(score, documents[doc_id]) for score, doc_id in fused[:top_k]])
+        return batch_results
+
+    def ask_many(
+        self, questions: Sequence[str], where: MetadataFilter | None = None
+    ) -> List[Tuple[str, List[Document]]]:
+        """批次問答：檢索階段合併成一次編碼與一次搜尋，再逐題呼叫 LLM"""
+        query_embeddings, batch_results = self._retrieve(questions, where)
+        return [
+            self._answer_from_results(question, results, query_embedding)
+            for question, results, query_embedding in zip(questions, batch_results, query_embeddings)
+        ]
+
+    def _answer_from_results(
+        self,
+        question: str,
+        results: Sequence[Tuple[float, Document]],
+        query_embedding: np.ndarray | None = None,
+    ) -> Tuple[str, List[Document]]:
+        prepared = self._prepare(question, results, query_embedding)
+        self.last_packing = prepared.packing
+        if prepared.answer is not None:
+            return prepared.answer, prepared.contexts
+
+        try:
+            answer = self._call_llm(prepared.request)
+        except Exception as exc:  # pragma: no cover - 依賴外部服務
+            return self.llm_error(exc), prepared.contexts
+        self.remember_answer(prepared, answer)
+        return answer or "(無回應)", prepared.contexts
+
+    def _prepare(
+        self,
+        question: str,
+        results: Sequence[Tuple[float, Document]],
+        query_embedding: np.ndarray | None = None,
+    ) -> PreparedAnswer:
         if not results:
-            return "抱歉，目前沒有相關資料可以回答。", []
+            return PreparedAnswer(question, [], answer="抱歉，目前沒有相關資料可以回答。")
 
         contexts = [doc for _score, doc in results]
-        prompt = self._build_prompt(question, contexts)
-        answer = self._call_llm(prompt)
-        return answer, contexts
+        if self.answer_cache is not None and query_embedding is not None:
+            context_keys = [_context_key(doc) for doc in contexts]
+            cached = self.answer_cache.lookup(query_embedding, context_keys)
+            if cached is not None:
+                return PreparedAnswer(question, contexts, answer=cached["answer"], cached=True)
+
+        prompt, packing = self._build_prompt(question, contexts)
+        request = {
+            "model": self.llm_model,
+            "messages": self._rag_messages(prompt),
+            "options": {"temperature": 0.2, "top_p": 0.9},
+        }
+        return PreparedAnswer(
+            question, contexts, request, packing=packing, query_embedding=query_embedding
+        )
 
-    def compare_with_baseline(self, question: str) -> Tuple[str, str, List[Document]]:
-        rag_answer, contexts = self.ask(question, verbose=False)
-        baseline_answer = self._call_llm_baseline(question)
+    def ask_stream(self, question: str, where: MetadataFilter | None = None) -> StreamingAnswer:
+        """與 ``ask`` 相同，但 LLM 產生一段文字就交出一段
+
+        使用者不必等整段回答生成完畢；迭代結束後可從 ``stats`` 取得
+        time-to-first-token、tokens/秒與總耗時。
+        """
+        started = time.perf_counter()
+        prepared = self.prepare_answer(question, where)
+        self.last_packing = prepared.packing
+        stats = GenerationStats(cached=prepared.cached)
+        if prepared.answer is not None:
+            if prepared.cached:
+                stats.time_to_first_token = stats.total_duration = time.perf_counter() - started
+            return StreamingAnswer(iter([prepared.answer]), prepared.contexts, stats)
+
+        return StreamingAnswer(
+            self._stream_llm(prepared.request, stats),
+            prepared.contexts,
+            stats,
+            lambda answer: self.remember_answer(prepared, answer),
+        )
+
+    def compare_with_baseline(
+        self, question: str, where: MetadataFilter | None = None
+    ) -> Tuple[str, str, List[Document]]:
+        """同時產生 RAG 與 baseline 回答，耗時記錄在 ``last_comparison``"""
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            rag_future = executor.submit(_timed, self.ask, question, verbose=False, where=where)
+            baseline_future = executor.submit(_timed, self.ask_baseline, question)
+            (rag_answer, contexts), rag_seconds = rag_future.result()
+            baseline_answer, baseline_seconds = baseline_future.result()
+        self.last_comparison = ComparisonTimings(
+            rag=rag_seconds,
+            baseline=baseline_seconds,
+            wall=time.perf_counter() - started,
+        )
         return rag_answer, baseline_answer, contexts
 
+    def ask_baseline(self, question: str) -> str:
+        """不經檢索、直接以模型既有知識回答，作為 RAG 的對照"""
+        try:
+            response = ollama.chat(
+                model=self.llm_model,
+                messages=[
+                    {"role": "system", "content": self.baseline_system_prompt},
+                    {"role": "user", "content": question},
+                ],
+                options={"temperature": 0.4, "top_p": 0.9},
+            )
+        except Exception as exc:  # pragma: no cover
+            return self.llm_error(exc)
+
+        return response.get("message", {}).get("content", "(無回應)").strip()
+
     # ------------------------------------------------------------------
     # Prompt & LLM 呼叫
     # ------------------------------------------------------------------
-    def _build_prompt(self, question: str, contexts: Sequence[Document]) -> str:
+    def _build_prompt(
+        self, question: str, contexts: Sequence[Document]
+    ) -> Tuple[str, PackedContext | None]:
+        """回傳 (提示詞, 上下文裁切統計)；未設定 token 預算時統計為 ``None``"""
+        ranks: Sequence[int] = range(len(contexts))
+        packed = None
+        if self.context_packer is not None:
+            packed = self.context_packer.pack(contexts)
+            contexts, ranks = packed.documents, packed.ranks
+
         context_block = "\n\n".join(
-            f"[來源 {idx + 1}] ({doc.metadata.get('source', 'unknown')} 第{doc.metadata.get('chunk_id')}段)\n"
+            f"[來源 {rank + 1}] ({doc.metadata.get('source', 'unknown')} 第{doc.metadata.get('chunk_id')}段)\n"
             f"{doc.content}"
-            for idx, doc in enumerate(contexts)
+            for rank, doc in zip(ranks, contexts)
         )
 
         instructions = textwrap.dedent(
@@ -279,52 +3501,66 @@ class RAGPipeline:
             """
         ).strip()
 
-        return instructions
+        return instructions, packed
 
-    def _call_llm(self, prompt: str) -> str:
-        try:
-            response = ollama.chat(
-                model=self.llm_model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a helpful assistant that strictly follows the provided context.",
-                    },
-                    {"role": "user", "content": prompt},
-                ],
-                options={"temperature": 0.2, "top_p": 0.9},
-            )
-        except Exception as exc:  # pragma: no cover - 依賴外部服務
-            return (
-                "無法連線到 Ollama，請確認服務已啟動並安裝 gemma3:1b 模型。\n"
-                f"原始錯誤：{exc}"
-            )
+    @staticmethod
+    def _rag_messages(prompt: str) -> List[Dict[str, str]]:
+        return [
+            {
+                "role": "system",
+                "content": "You are a helpful assistant that strictly follows the provided context.",
+            },
+            {"role": "user", "content": prompt},
+        ]
 
-        return response.get("message", {}).get("content", "(無回應)").strip()
+    def _call_llm(self, request: Dict[str, Any]) -> str:
+        """回傳 LLM 的回答（可能是空字串）；連線失敗時直接拋出例外"""
+        response = ollama.chat(**request)
+        return response.get("message", {}).get("content", "").strip()
 
-    def _call_llm_baseline(self, question: str) -> str:
+    def _stream_llm(self, request: Dict[str, Any], stats: GenerationStats) -> Iterator[str]:
+        """以 ``stream=True`` 呼叫 Ollama，邊收邊交出文字並填入 ``stats``"""
+        started = time.perf_counter()
+        eval_count = eval_duration_ns = 0
+        pieces = 0
         try:
-            response = ollama.chat(
-                model=self.llm_model,
-                messages=[
-                    {"role": "system", "content": self.baseline_system_prompt},
-                    {"role": "user", "content": question},
-                ],
-                options={"temperature": 0.4, "top_p": 0.9},
-            )
-        except Exception as exc:  # pragma: no cover
-            return (
-                "無法連線到 Ollama，請確認服務已啟動並安裝 gemma3:1b 模型。\n"
-                f"原始錯誤：{exc}"
-            )
-
-        return response.get("message", {}).get("content", "(無回應)").strip()
+            stream = ollama.chat(**request, stream=True)
+            for chunk in stream:
+                piece = chunk.get("message", {}).get("content", "")
+                if piece:
+                    if stats.time_to_first_token is None:
+                        stats.time_to_first_token = time.perf_counter() - started
+                    pieces += 1
+                    yield piece
+                if chunk.get("done"):
+                    # 最後一個片段帶有 Ollama 自己統計的 token 數與生成時間（奈秒）
+                    eval_count = chunk.get("eval_count") or 0
+                    eval_duration_ns = chunk.get("eval_duration") or 0
+        except Exception as exc:  # pragma: no cover - 依賴外部服務
+            stats.error = exc
+            yield self.llm_error(exc)
+        finally:
+            stats.total_duration = time.perf_counter() - started
+            stats.tokens = eval_count or pieces
+            if eval_count and eval_duration_ns:
+                stats.tokens_per_second = eval_count / (eval_duration_ns / 1e9)
+            elif stats.time_to_first_token is not None:
+                generation_time = stats.total_duration - stats.time_to_first_token
+                stats.tokens_per_second = pieces / generation_time if generation_time > 0 else 0.0
 
 
 # ----------------------------------------------------------------------
 # 指令列介面
 # ----------------------------------------------------------------------
 
+def _parse_range(text: str) -> Tuple[int | None, int | None]:
+    """把 "3-5"、"3-"、"-5" 轉成閉區間，空白的一端代表不設限"""
+    low, sep, high = text.partition("-")
+    if not sep:
+        low = high = text
+    return (int(low) if low.strip() else None, int(high) if high.strip() else None)
+
+
 def build_arg_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Week 4 RAG 教學範例")
     parser.add_argument(
@@ -344,6 +3580,183 @@ def build_arg_parser() -> argparse.ArgumentParser:
         default=3,
         help="檢索的參考段落數量 (default: 3)",
     )
+    parser.add_argument(
+        "--cache-dir",
+        default=".rag_cache",
+        help="嵌入向量快取的資料夾，重新啟動時只計算新區塊（預設: .rag_cache）",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="停用嵌入向量快取，每次都重新計算",
+    )
+    parser.add_argument(
+        "--index-dir",
+        help="向量索引的儲存位置；啟動時只處理新增、變更或刪除的 PDF",
+    )
+    parser.add_argument(
+        "--no-sync",
+        action="store_true",
+        help="搭配 --index-dir：不檢查 PDF，直接以 mmap 載入既有索引（適合多個服務行程共用）",
+    )
+    parser.add_argument(
+        "--embed-batch-size",
+        type=int,
+        default=256,
+        help="串流建立索引時每批嵌入的區塊數，決定記憶體用量上限 (default: 256)",
+    )
+    parser.add_argument(
+        "--index-type",
+        choices=("auto", *INDEX_TYPES),
+        default="flat",
+        help="向量索引類型；auto 會依區塊數量自動選擇，並回報相對暴力搜尋的 recall@k",
+    )
+    parser.add_argument(
+        "--nprobe",
+        type=int,
+        default=16,
+        help="IVF 索引查詢時掃描的群數，越大越準也越慢 (default: 16)",
+    )
+    parser.add_argument(
+        "--ef-search",
+        type=int,
+        default=64,
+        help="HNSW 索引查詢時的候選數，越大越準也越慢 (default: 64)",
+    )
+    parser.add_argument(
+        "--vector-storage",
+        choices=VECTOR_STORAGES,
+        default="float32",
+        help="索引中向量的儲存格式；float16 / int8 分別只需 1/2、1/4 的記憶體 (default: float32)",
+    )
+    parser.add_argument(
+        "--rescore",
+        type=int,
+        default=0,
+        help="另存 float32 原始向量，先取 top_k 的 N 倍候選再以原始向量重新計分；0 表示不重新計分",
+    )
+    parser.add_argument(
+        "--pca-dim",
+        type=int,
+        help="以語料學出 PCA，把索引中的向量降到這個維度（如 128、64），並回報相對原始維度的 recall@k",
+    )
+    parser.add_argument(
+        "--query-cache-size",
+        type=int,
+        default=1024,
+        help="查詢向量 LRU 快取的容量，0 表示停用 (default: 1024)",
+    )
+    parser.add_argument(
+        "--query-cache-ttl",
+        type=float,
+        help="查詢向量快取的存活秒數，未指定則不過期",
+    )
+    parser.add_argument(
+        "--answer-cache-dir",
+        help="語意答案快取的儲存資料夾；相似問題且檢索結果相同時直接回傳舊答案",
+    )
+    parser.add_argument(
+        "--answer-cache-threshold",
+        type=float,
+        help="答案快取的問題相似度門檻（餘弦相似度，預設 0.95；指定即啟用快取）",
+    )
+    parser.add_argument(
+        "--context-tokens",
+        type=int,
+        default=1500,
+        help="提示詞中參考資料的 token 上限，0 表示不限制 (default: 1500)",
+    )
+    parser.add_argument(
+        "--source",
+        action="append",
+        help="只從指定的 PDF 檔名中檢索，可重複指定多個",
+    )
+    parser.add_argument(
+        "--chunk-range",
+        help="只檢索段落編號在此範圍內的區塊，例如 0-20",
+    )
+    parser.add_argument(
+        "--pages",
+        help="只檢索與此頁碼範圍有交集的區塊，例如 3-5",
+    )
+    parser.add_argument(
+        "--chunk-strategy",
+        choices=CHUNK_STRATEGIES,
+        default="words",
+        help="切割策略：words 依詞數、tokens 依 token 數、sentences 以句子裝填、"
+        "recursive 依段落與換行遞迴切割 (default: words)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        help="每個區塊的大小；words 以詞計算（預設 600），其餘策略以 token 計算（預設 256）",
+    )
+    parser.add_argument(
+        "--chunk-overlap",
+        type=int,
+        help="相鄰區塊重疊的大小，單位同 --chunk-size（預設 words 100、其餘 32）",
+    )
+    parser.add_argument(
+        "--retrieval",
+        choices=RETRIEVAL_MODES,
+        default="dense",
+        help="dense 只用向量檢索；hybrid 同時以 BM25 關鍵字檢索並用 RRF 融合 (default: dense)",
+    )
+    parser.add_argument(
+        "--rrf-k",
+        type=int,
+        default=60,
+        help="reciprocal rank fusion 的平滑常數 k (default: 60)",
+    )
+    parser.add_argument(
+        "--rerank-model",
+        help="cross-encoder 重排序模型（例如 cross-encoder/ms-marco-MiniLM-L-6-v2），指定即啟用",
+    )
+    parser.add_argument(
+        "--candidate-k",
+        type=int,
+        default=20,
+        help="重排序前從 FAISS 取出的候選數量 (default: 20)",
+    )
+    parser.add_argument(
+        "--rerank-budget-ms",
+        type=float,
+        default=200.0,
+        help="每個問題重排序最多增加的毫秒數，0 表示不限制 (default: 200)",
+    )
+    parser.add_argument(
+        "--embedding-backend",
+        choices=EMBEDDING_BACKENDS,
+        default="torch",
+        help="嵌入模型的推論後端；onnx / onnx-int8 以 onnxruntime 執行，適合只有 CPU 的機器 (default: torch)",
+    )
+    parser.add_argument(
+        "--embed-threads",
+        type=int,
+        help="嵌入模型使用的 CPU 執行緒數（搭配 --embed-workers 時為每個行程的執行緒數），未指定則由函式庫決定",
+    )
+    parser.add_argument(
+        "--embed-workers",
+        type=int,
+        default=1,
+        help="以多個行程平行嵌入語料，每個行程各載入一份模型 (default: 1)",
+    )
+    parser.add_argument(
+        "--embed-token-budget",
+        type=int,
+        help="依 token 長度分桶嵌入語料，每批補齊後的 token 上限（例如 8192）；未指定則每批固定 32 筆",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="逐字顯示 RAG 回答，並列出首個 token 時間與 tokens/秒",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=f"平行擷取 PDF 的行程數，1 表示不平行（本機 CPU 核心數: {os.cpu_count()}）",
+    )
     return parser
 
 
@@ -354,8 +3767,38 @@ def main() -> None:
     pipeline = RAGPipeline(
         data_folder=args.data_folder,
         retriever_top_k=args.top_k,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        index_dir=args.index_dir,
+        pdf_workers=args.workers,
+        embed_batch_size=args.embed_batch_size,
+        index_type=args.index_type,
+        nprobe=args.nprobe,
+        ef_search=args.ef_search,
+        vector_storage=args.vector_storage,
+        rescore=args.rescore,
+        pca_dimension=args.pca_dim,
+        query_cache_size=args.query_cache_size,
+        query_cache_ttl=args.query_cache_ttl,
+        answer_cache_dir=args.answer_cache_dir,
+        answer_cache_threshold=args.answer_cache_threshold,
+        context_token_budget=args.context_tokens or None,
+        rerank_model=args.rerank_model,
+        candidate_k=args.candidate_k,
+        rerank_budget_ms=args.rerank_budget_ms or None,
+        retrieval=args.retrieval,
+        rrf_k=args.rrf_k,
+        chunk_strategy=args.chunk_strategy,
+        chunk_size=args.chunk_size,
+        chunk_overlap=args.chunk_overlap,
+        embedding_backend=args.embedding_backend,
+        embed_threads=args.embed_threads,
+        embed_token_budget=args.embed_token_budget,
+        embed_workers=args.embed_workers,
     )
-    pipeline.prepare_corpus()
+    if args.no_sync and args.index_dir and VectorStore.exists(args.index_dir):
+        pipeline.load_index(args.index_dir)
+    else:
+        pipeline.prepare_corpus()
     if not pipeline.ready:
         print("尚未成功建立知識庫，請確認 data/ 內是否有 PDF 或使用 fallback 文本。")
         return
@@ -368,23 +3811,83 @@ def main() -> None:
         ]
     )
 
+    ranges: Dict[str, Tuple[int | None, int | None]] = {}
+    if args.chunk_range:
+        try:
+            ranges["chunk_id"] = _parse_range(args.chunk_range)
+        except ValueError:
+            parser.error(f"--chunk-range 格式應為 起-迄（例如 0-20），收到 {args.chunk_range!r}")
+    if args.pages:
+        try:
+            first_page, last_page = _parse_range(args.pages)
+        except ValueError:
+            parser.error(f"--pages 格式應為 起-迄（例如 3-5），收到 {args.pages!r}")
+        # 區塊可能跨頁：起始頁不晚於範圍結尾、結束頁不早於範圍開頭即有交集
+        ranges["page"] = (None, last_page)
+        ranges["page_end"] = (first_page, None)
+    where = (
+        MetadataFilter.where(source=args.source, **ranges) if args.source or ranges else None
+    )
+    if where is not None:
+        matched = len(pipeline.vector_store.matching_ids(where))
+        print(f"篩選條件符合 {matched} / {len(pipeline.vector_store.documents)} 筆區塊")
+
     for question in questions:
         print("\n" + "=" * 72)
         print(f"問題：{question}")
-
-        rag_answer, baseline_answer, contexts = pipeline.compare_with_baseline(question)
-
-        print("\n>>> 使用 RAG (含檢索上下文)：")
-        print(rag_answer)
+        pipeline.last_packing = None
+
+        if args.stream:
+            print("\n>>> 使用 RAG (含檢索上下文)：")
+            # baseline 在背景執行緒先送出，與串流中的 RAG 回答同時生成
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                baseline_future = executor.submit(pipeline.ask_baseline, question)
+                streaming = pipeline.ask_stream(question, where)
+                for piece in streaming:
+                    print(piece, end="", flush=True)
+                print()
+                print(streaming.stats.summary())
+                contexts = streaming.contexts
+                baseline_answer = baseline_future.result()
+        else:
+            rag_answer, baseline_answer, contexts = pipeline.compare_with_baseline(question, where)
+            print("\n>>> 使用 RAG (含檢索上下文)：")
+            print(rag_answer)
         if contexts:
             refs = ", ".join(
                 f"來源{idx + 1}:{doc.metadata.get('source', 'demo')}"
                 for idx, doc in enumerate(contexts)
             )
             print(f"參考資料：{refs}")
+        if pipeline.last_packing is not None:
+            print(pipeline.last_packing.summary())
 
         print("\n>>> 未使用 RAG (僅模型既有知識)：")
         print(baseline_answer)
+        if not args.stream and pipeline.last_comparison is not None:
+            print(pipeline.last_comparison.summary())
+
+    if pipeline.embedder.query_cache is not None:
+        stats = pipeline.embedder.query_cache.stats()
+        print(
+            f"\n查詢向量快取：命中率 {stats['hit_rate']:.0%}"
+            f"（命中 {stats['hits']}、未命中 {stats['misses']}、淘汰 {stats['evictions']}）"
+        )
+
+    if pipeline.answer_cache is not None:
+        stats = pipeline.answer_cache.stats()
+        print(
+            f"語意答案快取：命中率 {stats['hit_rate']:.0%}"
+            f"（命中 {stats['hits']}、未命中 {stats['misses']}、目前 {stats['size']} 筆）"
+        )
+
+    if pipeline.reranker is not None:
+        stats = pipeline.reranker.stats()
+        print(
+            f"重排序分數快取：命中率 {stats['hit_rate']:.0%}"
+            f"（命中 {stats['hits']}、新評分 {stats['misses']}、超出時間預算略過 {stats['skipped']}，"
+            f"每對約 {stats['pair_ms']:.1f} ms）"
+        )
 
     print("\n提示：可加入更多問題 (-q) 或更換資料夾 (--data-folder) 來測試其他論文。")
 
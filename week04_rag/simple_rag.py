@@ -5,8 +5,10 @@ Week 4 - 簡化版 RAG 系統
 """
 
 import re
+import time
 import ollama
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict, Any
 from pypdf import PdfReader
@@ -21,18 +23,44 @@ class Document:
         self.metadata = metadata or {}
 
 
+def _timed(fn, *args):
+    """執行 fn 並回傳 (結果, 耗時秒數)"""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
 class SimpleRAG:
     """簡單的 RAG 系統"""
 
-    def __init__(self, model_name: str = "gemma3:1b"):
-        """初始化 RAG 系統"""
+    # 向量的儲存格式：float16 省一半記憶體，int8 只需四分之一
+    STORAGE_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+    # int8 儲存時，每個維度的最大絕對值對應到 127
+    INT8_MAX = 127.0
+    # 非 float32 格式時，每次只把這麼多列轉回 float32 計算（約 3 MB，可放進 CPU 快取）
+    SCAN_BLOCK_ROWS = 2048
+
+    def __init__(self, model_name: str = "gemma3:1b", storage: str = "float32", verbose: bool = True):
+        """初始化 RAG 系統
+
+        Args:
+            model_name: Ollama 模型名稱
+            storage: 向量儲存格式（float32 / float16 / int8）
+            verbose: 是否在搜尋時印出每筆結果；大量查詢時建議設為 False
+        """
+        if storage not in self.STORAGE_DTYPES:
+            raise ValueError(f"storage 必須是 {', '.join(self.STORAGE_DTYPES)} 之一")
         self.llm_model = model_name
         self.embedding_model = SentenceTransformer(
             "sentence-transformers/all-MiniLM-L6-v2",
             device='cpu'
         )
+        self.storage = storage
+        self.verbose = verbose
         self.documents = []
         self.embeddings = None
+        # int8 格式下每個維度的縮放倍數
+        self.int8_scales = None
 
     def load_pdf(self, pdf_path: str) -> str:
         """讀取單個 PDF 檔案"""
@@ -96,18 +124,64 @@ class SimpleRAG:
         # 建立向量索引
         texts = [doc.content for doc in self.documents]
         print("建立向量索引...")
-        self.embeddings = self.embedding_model.encode(
+        embeddings = self.embedding_model.encode(
             texts,
             batch_size=32,
             show_progress_bar=True,
             normalize_embeddings=True
         )
-        print("向量索引建立完成！")
-
-    def search(self, query: str, top_k: int = 3) -> List[Document]:
-        """搜尋相關文件"""
+        self.embeddings = self._compress(np.asarray(embeddings, dtype=np.float32))
+        size_mb = self.embeddings.nbytes / 1024 / 1024
+        print(f"向量索引建立完成！（{self.storage} 格式，佔用 {size_mb:.1f} MB）")
+
+    def _compress(self, embeddings: np.ndarray) -> np.ndarray:
+        """依 storage 設定轉換向量格式"""
+        if self.storage == "int8":
+            # 每個維度各自縮放：多數維度的數值遠小於 1，共用同一個倍數會浪費大部分的 int8 範圍
+            peaks = np.abs(embeddings).max(axis=0)
+            self.int8_scales = (self.INT8_MAX / np.maximum(peaks, 1e-12)).astype(np.float32)
+            return np.round(embeddings * self.int8_scales).astype(np.int8)
+        return embeddings.astype(self.STORAGE_DTYPES[self.storage])
+
+    def _similarities(self, query_vector: np.ndarray) -> np.ndarray:
+        """計算查詢向量與所有文件向量的內積"""
+        if self.embeddings.dtype == np.float32:
+            return self.embeddings @ query_vector
+
+        if self.embeddings.dtype == np.int8:
+            # 把縮放倍數併入查詢向量，掃描時不必再逐列還原
+            query_vector = query_vector / self.int8_scales
+
+        # float16 / int8：分段轉回 float32 再相乘，重複使用同一塊暫存區
+        similarities = np.empty(len(self.embeddings), dtype=np.float32)
+        buffer = np.empty((self.SCAN_BLOCK_ROWS, self.embeddings.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.embeddings), self.SCAN_BLOCK_ROWS):
+            block = self.embeddings[start:start + self.SCAN_BLOCK_ROWS]
+            rows = len(block)
+            np.copyto(buffer[:rows], block, casting="unsafe")
+            similarities[start:start + rows] = buffer[:rows] @ query_vector
+        return similarities
+
+    @staticmethod
+    def _top_k_indices(similarities: np.ndarray, top_k: int) -> np.ndarray:
+        """用 argpartition 在 O(n) 時間挑出前 k 名，只對這 k 筆排序"""
+        top_k = min(top_k, len(similarities))
+        if top_k <= 0:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.argpartition(-similarities, top_k - 1)[:top_k]
+        return candidates[np.argsort(-similarities[candidates])]
+
+    def search(self, query: str, top_k: int = 3, verbose: bool = None) -> List[Document]:
+        """搜尋相關文件
+
+        Args:
+            query: 問題
+            top_k: 回傳幾筆文件
+            verbose: 是否印出每筆結果，預設沿用初始化時的設定
+        """
         if self.embeddings is None:
             return []
+        verbose = self.verbose if verbose is None else verbose
 
         # 將問題轉成向量
         query_embedding = self.embedding_model.encode(
@@ -116,15 +190,16 @@ class SimpleRAG:
         )
 
         # 計算相似度（內積）
-        similarities = np.dot(self.embeddings, query_embedding.T).flatten()
+        similarities = self._similarities(np.asarray(query_embedding[0], dtype=np.float32))
 
-        # 找出最相似的文件
-        top_indices = np.argsort(similarities)[::-1][:top_k]
+        # 找出最相似的文件（不需要把全部相似度排序）
+        top_indices = self._top_k_indices(similarities, top_k)
 
         results = []
         for idx in top_indices:
             results.append(self.documents[idx])
-            print(f"  相似度 {similarities[idx]:.3f}: {self.documents[idx].metadata['source']}")
+            if verbose:
+                print(f"  相似度 {similarities[idx]:.3f}: {self.documents[idx].metadata['source']}")
 
         return results
 
@@ -168,13 +243,8 @@ class SimpleRAG:
         except Exception as e:
             return f"LLM 呼叫失敗: {e}"
 
-    def compare_with_baseline(self, question: str) -> tuple:
-        """比較有/無 RAG 的回答"""
-        # 使用 RAG 的回答
-        rag_answer = self.answer_question(question)
-
-        # 不使用 RAG 的回答（純 LLM）
-        print("\n生成基準回答（無 RAG）...")
+    def _baseline_answer(self, question: str) -> str:
+        """不使用 RAG 的回答（純 LLM）"""
         try:
             baseline_response = ollama.chat(
                 model=self.llm_model,
@@ -182,10 +252,22 @@ class SimpleRAG:
                     {"role": "user", "content": question}
                 ]
             )
-            baseline_answer = baseline_response['message']['content']
+            return baseline_response['message']['content']
         except Exception as e:
-            baseline_answer = f"LLM 呼叫失敗: {e}"
+            return f"LLM 呼叫失敗: {e}"
 
+    def compare_with_baseline(self, question: str) -> tuple:
+        """比較有/無 RAG 的回答；等待 RAG 回答的同時，基準回答已在背景生成"""
+        start = time.perf_counter()
+        print("\n生成基準回答（無 RAG，背景執行）...")
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            baseline_future = executor.submit(_timed, self._baseline_answer, question)
+            rag_answer, rag_seconds = _timed(self.answer_question, question)
+            baseline_answer, baseline_seconds = baseline_future.result()
+        wall_seconds = time.perf_counter() - start
+
+        print(f"\n耗時：RAG {rag_seconds:.2f} 秒、基準 {baseline_seconds:.2f} 秒，"
+              f"同時執行總耗時 {wall_seconds:.2f} 秒")
         return rag_answer, baseline_answer
 
 
@@ -0,0 +1,22 @@
+"""week04_rag 的測試共用設定：讓測試可以直接 ``import rag_test``"""
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def unit_vectors(count: int, dimension: int, seed: int = 0) -> np.ndarray:
+    """正規化的隨機 float32 向量"""
+    vectors = np.random.default_rng(seed).standard_normal((count, dimension)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def vectors() -> np.ndarray:
+    return unit_vectors(600, 16)
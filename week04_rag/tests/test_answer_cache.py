@@ -0,0 +1,66 @@
+"""SemanticAnswerCache：命中條件、語料更新時失效、寫入磁碟後重新載入"""
+
+from __future__ import annotations
+
+import numpy as np
+
+from conftest import unit_vectors
+from rag_test import SemanticAnswerCache
+
+DIMENSION = 16
+
+
+def test_hit_requires_similar_question_and_same_contexts():
+    cache = SemanticAnswerCache(DIMENSION, threshold=0.95)
+    question, other = unit_vectors(2, DIMENSION)
+    cache.store("q", question, "answer", ["a.pdf#1", "b.pdf#2"])
+
+    assert cache.lookup(question, ["a.pdf#1", "b.pdf#2"])["answer"] == "answer"
+    assert cache.lookup(question, ["b.pdf#2", "a.pdf#1"]) is None
+    assert cache.lookup(other, ["a.pdf#1", "b.pdf#2"]) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_least_recently_used_answer_is_evicted():
+    cache = SemanticAnswerCache(DIMENSION, max_entries=2)
+    first, second, third = unit_vectors(3, DIMENSION)
+    cache.store("first", first, "1", ["a"])
+    cache.store("second", second, "2", ["a"])
+    cache.lookup(first, ["a"])
+    cache.store("third", third, "3", ["a"])
+
+    assert cache.lookup(first, ["a"]) is not None
+    assert cache.lookup(second, ["a"]) is None
+    assert cache.evictions == 1
+
+
+def test_invalidate_clears_only_when_corpus_changes(tmp_path):
+    cache = SemanticAnswerCache(DIMENSION, path=tmp_path)
+    (question,) = unit_vectors(1, DIMENSION)
+    cache.invalidate("v1")
+    cache.store("q", question, "answer", ["a"])
+
+    cache.invalidate("v1")
+    assert len(cache) == 1
+
+    cache.invalidate("v2")
+    assert len(cache) == 0
+    assert cache.lookup(question, ["a"]) is None
+    # 清空後立即寫回磁碟，重新啟動也不會讀到舊版本的答案
+    assert len(SemanticAnswerCache(DIMENSION, path=tmp_path)) == 0
+
+
+def test_flush_persists_answers_for_next_process(tmp_path):
+    cache = SemanticAnswerCache(DIMENSION, path=tmp_path, flush_every=100)
+    questions = unit_vectors(3, DIMENSION)
+    cache.invalidate("v1")
+    for number, question in enumerate(questions):
+        cache.store(f"q{number}", question, f"answer {number}", ["a"])
+    assert len(np.load(tmp_path / "vectors.npy")) == 0
+
+    cache.flush()
+    reloaded = SemanticAnswerCache(DIMENSION, path=tmp_path)
+
+    assert reloaded.corpus_version == "v1"
+    assert len(reloaded) == 3
+    assert reloaded.lookup(questions[2], ["a"])["answer"] == "answer 2"
@@ -0,0 +1,60 @@
+"""以字元區間切塊：words 策略與舊版切法一致，start_char / end_char 對得回原文"""
+
+from __future__ import annotations
+
+import random
+
+import pytest
+
+from benchmark_chunking import legacy_iter_chunks
+from rag_test import CHUNK_STRATEGIES, PDFProcessor, split_pages
+
+# 含全形空白、tab、空行與中英文句號，涵蓋各種空白合併與斷句情況
+WORDS = ["資料", "retrieval", "the", "模型。", "Hello.", "　x", "a\tb", "end.\n\n"]
+
+
+def sample_text(pages: int = 10, words_per_page: int = 300, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    return "".join(
+        f"\n[Page {page}]\n" + " ".join(rng.choice(WORDS) for _ in range(words_per_page))
+        for page in range(1, pages + 1)
+    ).strip()
+
+
+@pytest.mark.parametrize("chunk_size, chunk_overlap", [(120, 30), (50, 0), (600, 100)])
+def test_words_strategy_matches_legacy_chunker(chunk_size, chunk_overlap):
+    processor = PDFProcessor(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    text = sample_text()
+
+    legacy = [
+        (doc.content, doc.metadata["chunk_id"], doc.metadata["start_word"])
+        for doc in legacy_iter_chunks(processor, text, "x.pdf")
+    ]
+    spans = [
+        (doc.content, doc.metadata["chunk_id"], doc.metadata["start_word"])
+        for doc in processor.iter_chunks(text, "x.pdf")
+    ]
+    assert spans == legacy
+
+
+def test_short_text_yields_no_chunks():
+    processor = PDFProcessor(chunk_size=120, chunk_overlap=30)
+    assert list(processor.iter_chunks("too short", "x.pdf")) == []
+    assert list(legacy_iter_chunks(processor, "too short", "x.pdf")) == []
+
+
+@pytest.mark.parametrize("strategy", CHUNK_STRATEGIES)
+def test_char_spans_point_into_collapsed_text(strategy):
+    processor = PDFProcessor(strategy=strategy)
+    text = sample_text()
+    body = text if strategy == "words" else split_pages(text)[0]
+    collapsed = " ".join(body.split())
+
+    documents = list(processor.iter_chunks(text, "x.pdf"))
+
+    assert documents
+    for number, doc in enumerate(documents):
+        start, end = doc.metadata["start_char"], doc.metadata["end_char"]
+        assert doc.metadata["chunk_id"] == number
+        assert collapsed[start:end] == doc.content
+        assert 1 <= doc.metadata["page"] <= doc.metadata["page_end"] <= 10
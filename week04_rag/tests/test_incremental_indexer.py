@@ -0,0 +1,185 @@
+"""IncrementalIndexer.sync：新增、變更、刪除與只改修改時間的 PDF"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from rag_test import IncrementalIndexer, PDFProcessor, VectorStore
+
+DIMENSION = 16
+
+
+class TextProcessor(PDFProcessor):
+    """以純文字檔代替 PDF；內容以 ``BROKEN`` 開頭時模擬讀取失敗"""
+
+    def load_pdf(self, pdf_path: Path) -> str:
+        text = pdf_path.read_text(encoding="utf-8")
+        if text.startswith("BROKEN"):
+            raise ValueError("無法解析")
+        return text
+
+
+def embed(text: str) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:4], "big")
+    vector = np.random.default_rng(seed).standard_normal(DIMENSION).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def write_pdf(path: Path, topic: str, words: int = 400) -> Path:
+    path.write_text(" ".join(f"{topic}{i}" for i in range(words)), encoding="utf-8")
+    return path
+
+
+class Library:
+    """索引資料夾 + 向量庫 + 增量索引器，並記錄 ``store.remove`` 的呼叫次數"""
+
+    def __init__(self, root: Path, settings: dict | None = None):
+        self.pdf_dir = root / "pdfs"
+        self.pdf_dir.mkdir(parents=True, exist_ok=True)
+        self.store = VectorStore(DIMENSION)
+        self.remove_calls = 0
+        self._ingesting = False
+        remove = self.store.remove
+
+        def counting_remove(ids):
+            # add 以相同 ID 取代時也會呼叫 remove，只計算 sync 移除舊區塊的次數
+            if not self._ingesting:
+                self.remove_calls += 1
+            return remove(ids)
+
+        self.store.remove = counting_remove
+        processor = TextProcessor(chunk_size=100, chunk_overlap=20)
+        self.indexer = IncrementalIndexer(
+            root / "index", processor, self.ingest, settings or processor.settings
+        )
+
+    def ingest(self, chunks) -> int:
+        count = 0
+        self._ingesting = True
+        try:
+            for document, chunk_id in chunks:
+                self.store.add(embed(document.content)[None, :], [document], ids=[chunk_id])
+                count += 1
+        finally:
+            self._ingesting = False
+        return count
+
+    def sync(self):
+        update = self.indexer.sync(self.store, sorted(self.pdf_dir.glob("*.pdf")))
+        self.indexer.save_manifest()
+        return update
+
+    def sources(self) -> dict:
+        counts: dict = {}
+        for _doc_id, document in self.store.documents.items():
+            counts[document.metadata["source"]] = counts.get(document.metadata["source"], 0) + 1
+        return counts
+
+    def ids_for(self, name: str) -> list:
+        return self.indexer.files[name].chunk_ids
+
+
+@pytest.fixture
+def library(tmp_path) -> Library:
+    library = Library(tmp_path)
+    write_pdf(library.pdf_dir / "a.pdf", "alpha")
+    write_pdf(library.pdf_dir / "b.pdf", "beta")
+    return library
+
+
+def test_first_sync_indexes_every_file(library):
+    update = library.sync()
+
+    assert update.added == ["a.pdf", "b.pdf"]
+    assert update.has_changes
+    assert library.remove_calls == 0
+    assert library.sources() == {"a.pdf": 5, "b.pdf": 5}
+    assert sorted(library.store.documents.ids().tolist()) == sorted(
+        library.ids_for("a.pdf") + library.ids_for("b.pdf")
+    )
+
+
+def test_second_sync_without_changes_does_nothing(library):
+    library.sync()
+    update = library.sync()
+
+    assert not update.has_changes
+    assert update.unchanged == 2
+    assert library.remove_calls == 0
+
+
+def test_changed_added_and_deleted_files_in_one_sync(library):
+    library.sync()
+    old_b = library.ids_for("b.pdf")
+    (library.pdf_dir / "a.pdf").unlink()
+    write_pdf(library.pdf_dir / "b.pdf", "gamma", words=300)
+    write_pdf(library.pdf_dir / "c.pdf", "delta")
+
+    update = library.sync()
+
+    assert (update.added, update.changed, update.removed) == (["c.pdf"], ["b.pdf"], ["a.pdf"])
+    # 刪除檔案與變更檔案的舊區塊一起移除，HNSW 只需重建一次
+    assert library.remove_calls == 1
+    assert library.sources() == {"b.pdf": 4, "c.pdf": 5}
+    assert all(doc_id not in library.store.documents for doc_id in old_b)
+    assert library.store.documents[library.ids_for("b.pdf")[0]].content.startswith("gamma0 ")
+
+
+def test_touched_file_with_same_content_is_only_refreshed(library):
+    library.sync()
+    path = library.pdf_dir / "a.pdf"
+    before = library.ids_for("a.pdf")
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    update = library.sync()
+
+    assert not update.has_changes
+    assert (update.unchanged, update.refreshed) == (2, 1)
+    assert library.ids_for("a.pdf") == before
+    assert library.indexer.files["a.pdf"].mtime_ns == stat.st_mtime_ns + 10**9
+
+
+def test_unreadable_file_keeps_previous_vectors(library):
+    library.sync()
+    before = library.ids_for("a.pdf")
+    (library.pdf_dir / "a.pdf").write_text("BROKEN " * 50, encoding="utf-8")
+
+    update = library.sync()
+
+    assert not update.has_changes
+    assert library.remove_calls == 0
+    assert library.ids_for("a.pdf") == before
+    assert all(doc_id in library.store.documents for doc_id in before)
+
+
+def test_manifest_reload_and_settings_change(library, tmp_path):
+    library.sync()
+
+    reloaded = IncrementalIndexer(
+        tmp_path / "index", library.indexer.processor, library.ingest, library.indexer.settings
+    )
+    assert reloaded.compatible
+    assert reloaded.files == library.indexer.files
+
+    changed = IncrementalIndexer(
+        tmp_path / "index",
+        library.indexer.processor,
+        library.ingest,
+        {**library.indexer.settings, "chunk_size": 50},
+    )
+    assert not changed.compatible
+    assert changed.files == {}
+
+
+def test_chunk_ids_are_stable_across_rebuilds(library, tmp_path):
+    library.sync()
+    rebuilt = Library(tmp_path / "rebuilt")
+    rebuilt.indexer.sync(rebuilt.store, sorted(library.pdf_dir.glob("*.pdf")))
+
+    assert rebuilt.indexer.files == library.indexer.files
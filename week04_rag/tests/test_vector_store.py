@@ -0,0 +1,141 @@
+"""VectorStore 的增刪、篩選搜尋與存檔 / mmap 載入"""
+
+from __future__ import annotations
+
+import numpy as np
+import pytest
+
+from rag_test import Document, MetadataFilter, VectorStore
+
+SOURCES = ("a.pdf", "b.pdf", "c.pdf")
+
+
+def make_store(vectors: np.ndarray, **kwargs) -> VectorStore:
+    store = VectorStore(vectors.shape[1], **kwargs)
+    documents = [
+        Document(content=f"chunk {i}", metadata={"source": SOURCES[i % 3], "chunk_id": i})
+        for i in range(len(vectors))
+    ]
+    store.add(vectors, documents, ids=range(1000, 1000 + len(vectors)))
+    return store
+
+
+def with_index(store: VectorStore, index_type: str) -> VectorStore:
+    if index_type != "flat":
+        store.build_ann(index_type, nlist=8, pq_m=4, k=5, num_queries=20)
+        store.set_search_params(nprobe=8, ef_search=256)
+        assert store.index_type == index_type
+    return store
+
+
+def top_ids(store: VectorStore, queries: np.ndarray, k: int = 5, where=None) -> np.ndarray:
+    _scores, ids = store.search_ids(queries, k, where)
+    return ids
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf", "hnsw"])
+def test_remove_drops_vectors_and_documents(vectors, index_type):
+    store = with_index(make_store(vectors), index_type)
+    removed = list(range(1000, 1100))
+
+    assert store.remove(removed + [1, 2]) == 100
+    assert store.remove(removed) == 0
+    assert len(store.documents) == len(vectors) - 100
+    assert all(doc_id not in store.documents for doc_id in removed)
+
+    found = top_ids(store, vectors[:100], k=10)
+    assert not np.isin(found, removed).any()
+    # 沒被刪的向量仍然找得到自己
+    assert (top_ids(store, vectors[100:150], k=1)[:, 0] == np.arange(1100, 1150)).mean() > 0.9
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf", "hnsw"])
+def test_add_with_existing_ids_replaces(vectors, index_type):
+    store = with_index(make_store(vectors), index_type)
+    replacement = -vectors[:1]
+    store.add(replacement, [Document(content="new", metadata={"source": "a.pdf"})], ids=[1000])
+
+    assert len(store.documents) == len(vectors)
+    assert store.documents[1000].content == "new"
+    assert top_ids(store, replacement, k=1)[0, 0] == 1000
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf", "hnsw"])
+def test_filtered_search_returns_only_matching_ids(vectors, index_type):
+    store = with_index(make_store(vectors), index_type)
+    where = MetadataFilter.where(source="b.pdf", chunk_id=(0, 299))
+
+    results = store.search_batch(vectors[:5], top_k=7, where=where)
+
+    for rows in results:
+        assert len(rows) == 7
+        for _score, doc in rows:
+            assert doc.metadata["source"] == "b.pdf"
+            assert doc.metadata["chunk_id"] <= 299
+    expected = [1000 + i for i in range(300) if i % 3 == 1]
+    assert store.matching_ids(where).tolist() == expected
+
+
+def test_filter_cache_is_bounded(vectors):
+    store = make_store(vectors)
+    for low in range(store.filter_cache_size * 2):
+        store.matching_ids(MetadataFilter.where(chunk_id=(low, None)))
+    assert len(store._filter_ids) == store.filter_cache_size
+
+    store.remove([1000])
+    assert 1000 not in store.matching_ids(MetadataFilter.where(source="a.pdf")).tolist()
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+@pytest.mark.parametrize(
+    "index_type, kwargs",
+    [
+        ("flat", {}),
+        ("flat", {"storage": "int8", "rescore": 4}),
+        ("ivf", {"storage": "float16"}),
+        ("hnsw", {}),
+    ],
+)
+def test_save_load_round_trip(vectors, tmp_path, mmap, index_type, kwargs):
+    store = with_index(make_store(vectors, **kwargs), index_type)
+    store.remove(range(1000, 1010))
+    where = MetadataFilter.where(source="c.pdf")
+    expected = top_ids(store, vectors[:20])
+    expected_filtered = top_ids(store, vectors[:20], where=where)
+    store.save(tmp_path)
+
+    loaded = VectorStore.load(tmp_path, mmap=mmap)
+    loaded.set_search_params(nprobe=8, ef_search=256)
+
+    assert loaded.index_type == index_type
+    assert loaded.storage == store.storage
+    assert len(loaded.documents) == len(store.documents)
+    assert loaded.documents[1500].metadata == {"source": SOURCES[500 % 3], "chunk_id": 500}
+    assert np.array_equal(top_ids(loaded, vectors[:20]), expected)
+    assert np.array_equal(top_ids(loaded, vectors[:20], where=where), expected_filtered)
+    assert loaded.fingerprint() == store.fingerprint()
+
+    # mmap 載入的唯讀索引仍可增刪，並覆寫回同一個資料夾
+    assert loaded.remove([1010, 1011]) == 2
+    loaded.add(vectors[:1], [Document(content="again", metadata={"source": "a.pdf"})], ids=[1000])
+    loaded.save(tmp_path)
+    reloaded = VectorStore.load(tmp_path, mmap=mmap)
+    assert len(reloaded.documents) == len(vectors) - 11
+    assert reloaded.documents[1000].content == "again"
+    assert 1010 not in reloaded.documents
+
+
+def test_int8_ranges_trained_on_all_buffered_batches(vectors):
+    # 分批加入時，int8 的範圍要以累積的所有向量估計，而不是只用第一批
+    batched = VectorStore(vectors.shape[1], storage="int8")
+    for start in range(0, len(vectors), 50):
+        batched.add(
+            vectors[start : start + 50] * (1 + start / 100),
+            [Document(content=str(i)) for i in range(start, start + 50)],
+        )
+    whole = VectorStore(vectors.shape[1], storage="int8")
+    whole.add(
+        np.concatenate([vectors[start : start + 50] * (1 + start / 100) for start in range(0, 600, 50)]),
+        [Document(content=str(i)) for i in range(600)],
+    )
+    assert np.array_equal(top_ids(batched, vectors[:50]), top_ids(whole, vectors[:50]))